@@ -1,301 +1,4903 @@
 import os
+import io
 import re
+import sys
 import time
+import csv
+import json
+import select
+import asyncio
+import threading
+import ctypes
+import ctypes.util
+import argparse
+import functools
+import gc
+import errno
+import collections
+import contextlib
+import zlib
+import hashlib
 import datetime
 import shutil
+import socket
+import sqlite3
+import tempfile
+import cProfile
+import pstats
+import tracemalloc
+import socketserver
+import hmac
+import ipaddress
+import multiprocessing
+import multiprocessing.connection
+import http.server
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from colorama import init, Fore, Style
-from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject, IndirectObject,
+    FloatObject, NameObject, NullObject, NumberObject, StreamObject
+)
+from PyPDF2.generic import ContentStream
+
+try:
+    import pikepdf
+except ImportError:
+    # необязательный движок для --engine pikepdf
+    pikepdf = None
+
+try:
+    from PIL import Image
+except ImportError:
+    # необязательна: нужна только для облегчения штампов (--stamp-dpi)
+    Image = None
 
 init(autoreset=True)
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DIR_RAILWAY = os.path.join(BASE_DIR, "Railway")
+DIR_TEMPLATE = os.path.join(BASE_DIR, "Template")
+DIR_STAMP = os.path.join(BASE_DIR, "Stamp")
+DIR_READY = os.path.join(BASE_DIR, "Ready")
+DIR_MERGED = os.path.join(BASE_DIR, "Merged Railway")
+
+DIR_RAILWAY_DONE = os.path.join(DIR_RAILWAY, "Done")
+DIR_READY_DONE = os.path.join(DIR_READY, "Done")
+# сюда сторож (--file-timeout, --file-memory) убирает накладные, на которых сборка зависла или упала
+DIR_RAILWAY_QUARANTINE = os.path.join(DIR_RAILWAY, "Quarantine")
+# готовые накладные под ключом из хешей исходных данных (--cache)
+DIR_CACHE = os.path.join(BASE_DIR, "Cache")
+
+TEMPLATE_3_6_PATH = os.path.join(DIR_TEMPLATE, "3-6.pdf")
+
+NO_INSTRUCTION_FLAG = "NO_INSTRUCTION"
+JOURNAL_FILENAME = "railway_journal.jsonl"
+ROUTES_FILENAME = "routes.csv"  # таблица маршрутов инструкций в папке Template (см. InstructionRoutes)
+PARTIAL_SUFFIX = ".part"
+
+SCENARIO_TWO_SIDED = "two-sided"
+SCENARIO_ONE_SIDED = "one-sided"
+BACKGROUND_XOBJECT_NAME = "/RailwayBg"
+STAMP_XOBJECT_NAME = "/RailwayStamp"
+PAGE_GEOMETRY_KEYS = ("/MediaBox", "/CropBox", "/BleedBox", "/TrimBox", "/ArtBox", "/Rotate")
+# Оценка памяти на сборку: байт на байт исходника (разобранные объекты плюс
+# копия самого большого потока при записи)
+MEMORY_PER_INPUT_BYTE = 2
+
+# Настройки запуска; переопределяются аргументами командной строки (см. parse_args)
+SETTINGS = {
+    "base_dir": BASE_DIR,  # рабочая папка с Railway, Template, Stamp, Ready, Merged Railway
+    "workers": 1,  # число процессов для сценариев 1–3; 0 — по числу ядер
+    "nup": 1,  # страниц исходника на печатный лист: 1, 2 или 4
+    "merge_chunk_size": 4,  # сколько накладных скреплять в один пакет
+    "package_keep_ready": False,  # сценарии 4/5: сохранять копии накладных в Ready/Done
+    "routes_path": None,  # таблица маршрутов инструкций; None — Template/routes.csv, если есть
+    "pdf_engine": "pypdf2",  # движок PDF: "pypdf2" или "pikepdf" (нужен pip install pikepdf)
+    "stamp_overlay": True,  # штамп — общий Form XObject поверх страницы; False — всегда merge_page
+    "dedup": True,  # не записывать одинаковые объекты повторно (фон, 3-6, штампы, шрифты)
+    "stamp_dpi": 0,  # облегчать штампы: изображения — до этого разрешения печати, dpi (0 — как есть)
+    "stamp_format": "jpeg",  # сжатие облегчённых изображений штампа: "jpeg" или "flate" (без потерь)
+    "stamp_gray": False,  # облегчённые штампы — в оттенках серого
+    "compress_streams": False,  # сжимать потоки без сжатия и пережимать потоки содержимого
+    "object_streams": False,  # упаковывать объекты в сжатые потоки объектов, таблицу ссылок — в xref-поток
+    "linearize": False,  # линеаризовать результаты («быстрый веб-просмотр»); нужен pikepdf
+    "pipeline_depth": 2,  # сценарии 1/2 в одном процессе: сколько накладных читать заранее (0 — без конвейера)
+    "memory_budget_mb": 0,  # память на сборку накладных (на все процессы), МБ; 0 — без ограничения
+    "cache_size_mb": 0,  # сценарии 1/2: кэш готовых накладных в папке Cache, МБ (0 — без кэша)
+    "file_timeout": 0,  # сценарии 1/2: предел времени на одну накладную, с (0 — без сторожа)
+    "file_memory_mb": 0,  # сценарии 1/2: предел памяти процесса на одну накладную, МБ (0 — без сторожа)
+    "file_retries": 2,  # под сторожем: сколько раз повторять накладную после временного сбоя
+    "claims": False,  # несколько обработчиков на общих папках: брать файлы через заявки (FileClaims)
+    "claim_ttl": 300.0,  # через сколько секунд без обновления заявка считается брошенной
+    "trace_path": None,  # JSON Lines файл с метриками по каждому файлу (None — не писать)
+    "history": True,  # записывать запуски и файлы в SQLite-историю (см. JobHistory)
+    "history_path": None,  # файл истории; None — railway_history.sqlite3 в рабочей папке
+    "profile_dir": None,  # папка профиля cProfile/tracemalloc по задачам (None — без профилирования)
+    "profile_slowest": 0,  # сводка профиля только по N самым долгим задачам (0 — по всем)
+    "watch_poll": 2.0,  # режим наблюдения: интервал опроса папок, с
+    "watch_settle": 2.0,  # сколько секунд файл не должен меняться, чтобы считаться дописанным
+    "watch_merge_idle": 30.0,  # через сколько секунд тишины скреплять неполный пакет (0 — никогда)
+}
+
+
+def print_step(text): print(f"\n{Fore.YELLOW}🟧 {text}{Style.RESET_ALL}")
+def print_info(text): print(f"{Fore.CYAN}ℹ️  {text}{Style.RESET_ALL}")
+def print_success(text): print(f"{Fore.GREEN}✅ {text}{Style.RESET_ALL}")
+def print_error(text): print(f"{Fore.RED}❌ {text}{Style.RESET_ALL}")
+def print_bold_input(prompt_text): return input(f"{Style.BRIGHT}{prompt_text}{Style.RESET_ALL} ")
+
+
+def ensure_directories():
+    folders = [
+        DIR_RAILWAY, DIR_TEMPLATE, DIR_STAMP, DIR_READY, DIR_MERGED,
+        DIR_RAILWAY_DONE, DIR_READY_DONE
+    ]
+    for folder in folders:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+
+def configure_paths(base_dir):
+    """Переключает все рабочие папки (и зависящие от них индекс штампов и журнал) на base_dir."""
+    global DIR_RAILWAY, DIR_TEMPLATE, DIR_STAMP, DIR_READY, DIR_MERGED
+    global DIR_RAILWAY_DONE, DIR_READY_DONE, DIR_RAILWAY_QUARANTINE, TEMPLATE_3_6_PATH
+    global DIR_CACHE, STAMP_INDEX, JOURNAL
+
+    base_dir = os.path.abspath(base_dir)
+    SETTINGS["base_dir"] = base_dir
+    DIR_RAILWAY = os.path.join(base_dir, "Railway")
+    DIR_TEMPLATE = os.path.join(base_dir, "Template")
+    DIR_STAMP = os.path.join(base_dir, "Stamp")
+    DIR_READY = os.path.join(base_dir, "Ready")
+    DIR_MERGED = os.path.join(base_dir, "Merged Railway")
+    DIR_RAILWAY_DONE = os.path.join(DIR_RAILWAY, "Done")
+    DIR_READY_DONE = os.path.join(DIR_READY, "Done")
+    DIR_RAILWAY_QUARANTINE = os.path.join(DIR_RAILWAY, "Quarantine")
+    DIR_CACHE = os.path.join(base_dir, "Cache")
+    TEMPLATE_3_6_PATH = os.path.join(DIR_TEMPLATE, "3-6.pdf")
+    # индекс штампов живёт столько же, сколько процесс: сервер, переключаясь
+    # между папками, не теряет уже разобранные штампы
+    STAMP_INDEX = STAMP_INDEXES.setdefault(DIR_STAMP, StampIndex(DIR_STAMP))
+    JOURNAL = JobJournal(os.path.join(base_dir, JOURNAL_FILENAME))
+
+
+def move_file_to_done(src_path, done_folder):
+    if not os.path.exists(done_folder):
+        os.makedirs(done_folder)
+    filename = os.path.basename(src_path)
+    dst_path = os.path.join(done_folder, filename)
+    try:
+        shutil.move(src_path, dst_path)
+        return True
+    except Exception as e:
+        print_error(f"Не удалось переместить {filename} в Done: {e}")
+        return False
+
+
+def extract_number_from_filename(filename):
+    numbers = re.findall(r'\d+', filename)
+    return int(numbers[0]) if numbers else None
+
+
+def get_file_creation_date(filepath):
+    timestamp = os.path.getmtime(filepath)
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Открывает path + '.part' на запись и после успешной записи атомарно
+    переименовывает его в path. При ошибке или падении процесса на месте
+    path никогда не остаётся недописанный файл.
+    """
+    tmp_path = path + PARTIAL_SUFFIX
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# ----------------------------------------------------------------------
+# Метрики: время по этапам, счётчики, скорость и трассировка
+# ----------------------------------------------------------------------
+def current_rss(pid="self"):
+    """Память процесса pid (RSS) в байтах или None, если её не узнать (не Linux)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class FileMetrics:
+    """Время по этапам (чтение, штамп, сборка, запись, перенос) и счётчики для одного файла."""
+
+    def __init__(self, name, kind="file"):
+        self.name = name
+        self.kind = kind
+        self.stages = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.details = {}  # подписи файла для истории и трассировки: инструкция, штамп
+        self.started = time.perf_counter()
+        self.rss_start = self.peak_rss = current_rss()
+        self.profile = None  # TaskProfile при --profile
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+            self.sample_memory()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def sample_memory(self):
+        """Запоминает пик памяти; замеры — на границах этапов и после каждой записанной страницы."""
+        rss = current_rss()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+        if self.profile is not None:
+            self.profile.sample()
+
+    def as_dict(self):
+        result = {
+            "kind": self.kind,
+            "name": self.name,
+            "total_s": round(time.perf_counter() - self.started, 4),
+            "stages_s": {k: round(v, 4) for k, v in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+        if self.details:
+            result["details"] = dict(self.details)
+        if self.peak_rss is not None:
+            result["memory_mb"] = {
+                "start": round(self.rss_start / 1e6, 1),
+                "peak": round(self.peak_rss / 1e6, 1),
+            }
+        return result
+
+
+# текущие метрики — свои у каждого потока: этапы конвейера идут в разных потоках
+_metrics_local = threading.local()
+
+
+def _current_metrics():
+    return getattr(_metrics_local, "current", None)
+
+
+@contextlib.contextmanager
+def track_metrics(metrics):
+    """Делает metrics текущими в этом потоке: stage() и count() внутри блока пишут в них."""
+    previous, _metrics_local.current = _current_metrics(), metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_local.current = previous
+
+
+def stage(name):
+    metrics = _current_metrics()
+    return metrics.stage(name) if metrics else contextlib.nullcontext()
+
+
+def count(name, value=1):
+    metrics = _current_metrics()
+    if metrics:
+        metrics.count(name, value)
+
+
+def note(name, value):
+    metrics = _current_metrics()
+    if metrics:
+        metrics.details[name] = value
+
+
+def sample_memory():
+    metrics = _current_metrics()
+    if metrics:
+        metrics.sample_memory()
+
+
+STAGE_LABELS = {
+    "read": "чтение",
+    "stamp": "поиск штампа",
+    "compose": "сборка страниц",
+    "write": "запись",
+    "merge": "скрепление",
+    "linearize": "линеаризация",
+    "cache": "кэш",
+    "move": "перенос в Done",
+}
+
+
+class BatchProgress:
+    """Живая строка скорости и оставшегося времени плюс итог по этапам в конце пакета."""
+
+    def __init__(self, total, unit="файл"):
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_saved = 0
+        self.errors = 0
+        self.skipped = 0  # --claims: взяты другими обработчиками
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_cached = 0
+        self.peak_memory = None  # (МБ, имя) — файл с наибольшим пиком памяти
+        self.stages = collections.defaultdict(float)
+        self.started = time.perf_counter()
+
+    def update(self, metrics):
+        self.done += 1
+        counters = metrics.get("counters", {})
+        self.pages += counters.get("pages_in", 0)
+        self.bytes_in += counters.get("bytes_in", 0)
+        self.bytes_out += counters.get("bytes_out", 0)
+        self.bytes_saved += counters.get("bytes_saved", 0)
+        self.errors += counters.get("errors", 0)
+        self.skipped += counters.get("skipped", 0)
+        self.cache_hits += counters.get("cache_hits", 0)
+        self.cache_misses += counters.get("cache_misses", 0)
+        self.bytes_cached += counters.get("bytes_cached", 0)
+        for name, value in metrics.get("stages_s", {}).items():
+            self.stages[name] += value
+        memory = metrics.get("memory_mb")
+        if memory and (self.peak_memory is None or memory["peak"] > self.peak_memory[0]):
+            self.peak_memory = (memory["peak"], metrics.get("name"))
+
+        elapsed = time.perf_counter() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        memory_note = f" · память {memory['peak']:.0f} МБ" if memory else ""
+        print(
+            f"{Style.DIM}  ⏱ {self.done}/{self.total} · {rate:.1f} {self.unit}/с · "
+            f"{self.pages / elapsed if elapsed else 0:.1f} стр/с{memory_note} · "
+            f"осталось ~{int(eta // 60)}:{int(eta % 60):02d}{Style.RESET_ALL}"
+        )
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        stage_total = sum(self.stages.values()) or 1.0
+        parts = [
+            f"{STAGE_LABELS.get(name, name)} {value:.2f} с ({value / stage_total:.0%})"
+            for name, value in sorted(self.stages.items(), key=lambda kv: -kv[1])
+        ]
+        print_info(
+            f"Время: {elapsed:.1f} с, страниц: {self.pages}, "
+            f"прочитано {self.bytes_in / 1e6:.1f} МБ, записано {self.bytes_out / 1e6:.1f} МБ "
+            f"(сэкономлено {self.bytes_saved / 1e6:.1f} МБ), ошибок: {self.errors}"
+        )
+        if parts:
+            print_info("Этапы: " + ", ".join(parts))
+        if self.skipped:
+            print_info(f"Пропущено (взяты другими обработчиками): {self.skipped}")
+        if self.cache_hits or self.cache_misses:
+            print_info(
+                f"Кэш: {self.cache_hits} из {self.cache_hits + self.cache_misses} без пересборки "
+                f"({self.bytes_cached / 1e6:.1f} МБ готовых файлов)"
+            )
+        if self.peak_memory:
+            print_info(f"Пик памяти: {self.peak_memory[0]:.0f} МБ ({self.peak_memory[1]})")
+
+
+def write_trace(metrics, scenario):
+    """Дописывает метрики файла в JSON Lines трассировку (если включена --trace)."""
+    path = SETTINGS["trace_path"]
+    if not path:
+        return
+    entry = {"ts": time.time(), "scenario": scenario}
+    entry.update(metrics)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+# ----------------------------------------------------------------------
+# Профилирование (--profile): куда уходят время и память внутри задач
+# ----------------------------------------------------------------------
+PROFILE_TOP = 20  # строк в каждом отчёте
+PROFILE_TRACE_FRAMES = 8  # глубина стеков tracemalloc
+PROFILE_TASKS_FOLDER = "tasks"  # внутри папки профиля: профили отдельных задач
+PROFILE_STATS_FILENAME = "profile.pstats"
+PROFILE_COLLAPSED_FILENAME = "profile.collapsed"
+COLLAPSED_MAX_DEPTH = 60
+
+
+def profile_tasks_folder():
+    return os.path.join(SETTINGS["profile_dir"], PROFILE_TASKS_FOLDER)
+
+
+class TaskProfile:
+    """
+    Профиль одной задачи (накладной, пакета, скрепления) в том процессе, где
+    она выполняется: основном, процессе пула или под сторожем. cProfile
+    считает время по функциям, tracemalloc снимает картину памяти в момент,
+    когда Python выделил больше всего (замеры — вместе с sample_memory).
+    По выходе в папке профиля остаются <задача>.prof (pstats) и <задача>.json
+    (время задачи и главные места выделения памяти).
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.profiler = cProfile.Profile()
+        self.peak = 0
+        self.snapshot = None
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        # учитываются только выделения этой задачи
+        tracemalloc.clear_traces()
+        self.metrics.profile = self
+        self.profiler.enable()
+        return self
+
+    def sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        # снимок дорогой: переснимаем, только когда память заметно выросла
+        if current > self.peak * 1.1:
+            self.peak = current
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+        self.sample()
+        self.metrics.profile = None
+        sites = []
+        for stat in self.snapshot.statistics("lineno")[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            sites.append({"site": f"{frame.filename}:{frame.lineno}", "size": stat.size, "count": stat.count})
+
+        folder = profile_tasks_folder()
+        os.makedirs(folder, exist_ok=True)
+        name = re.sub(r"[^\w.-]+", "_", self.metrics.name)
+        base = os.path.join(folder, f"{self.metrics.kind}-{name}-{os.getpid()}")
+        self.profiler.dump_stats(base + ".prof")
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump({
+                "kind": self.metrics.kind,
+                "name": self.metrics.name,
+                "total_s": round(time.perf_counter() - self.metrics.started, 4),
+                "peak_traced_mb": round(self.peak / 1e6, 1),
+                "sites": sites,
+            }, f, ensure_ascii=False)
+        return False
+
+
+def profile_task(metrics):
+    """TaskProfile для задачи при --profile, иначе пустой контекст."""
+    return TaskProfile(metrics) if SETTINGS["profile_dir"] else contextlib.nullcontext()
+
+
+def function_label(func):
+    """Подпись функции из pstats: «имя (файл:строка)», для встроенных — только имя."""
+    filename, lineno, name = func
+    if filename == "~":
+        return name
+    return f"{name} ({short_path(filename)}:{lineno})"
+
+
+def short_path(path):
+    """Два последних элемента пути: модуль и пакет, без site-packages и домашних папок."""
+    parts = path.replace("\\", "/").rsplit("/", 2)
+    return "/".join(parts[-2:])
+
+
+def write_collapsed_stacks(stats, path):
+    """
+    Пишет стеки в свёрнутом формате flamegraph.pl / speedscope / inferno:
+    «функция;вызванная;... микросекунды». cProfile хранит только пары
+    вызывающий — вызванный, поэтому стеки восстанавливаются по графу вызовов,
+    а время вызванной функции делится между путями пропорционально вызовам
+    с каждого из них — картина приближённая.
+    """
+    callees = collections.defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    total = sum(tt for _, _, tt, _, _ in stats.stats.values())
+    # пути дешевле этого не разворачиваются: иначе их число растёт экспоненциально
+    threshold = max(1e-6, total * 1e-5)
+    lines = collections.Counter()
+
+    def walk(func, frames, seen, share):
+        _, _, tt, _, _ = stats.stats[func]
+        frames = frames + [function_label(func).replace(";", ",")]
+        if tt * share > 0:
+            lines[";".join(frames)] += tt * share
+        if len(frames) >= COLLAPSED_MAX_DEPTH:
+            return
+        for callee, edge_ct in callees.get(func, {}).items():
+            callee_ct = stats.stats[callee][3]
+            if callee in seen or not callee_ct or edge_ct * share < threshold:
+                continue
+            walk(callee, frames, seen | {callee}, share * edge_ct / callee_ct)
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [], {func}, 1.0)
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, seconds in sorted(lines.items()):
+            if round(seconds * 1e6):
+                f.write(f"{stack} {round(seconds * 1e6)}\n")
+
+
+def report_profile(folder, slowest=0):
+    """
+    Сводит профили задач из folder (slowest > 0 — только N самых долгих),
+    пишет profile.pstats и profile.collapsed и печатает функции с наибольшим
+    суммарным временем и места, где в пике задачи выделено больше всего памяти.
+    """
+    tasks_folder = os.path.join(folder, PROFILE_TASKS_FOLDER)
+    tasks = []
+    if os.path.isdir(tasks_folder):
+        for name in sorted(os.listdir(tasks_folder)):
+            base = os.path.join(tasks_folder, name)[:-len(".json")]
+            if name.endswith(".json") and os.path.exists(base + ".prof"):
+                with open(base + ".json", encoding="utf-8") as f:
+                    tasks.append({**json.load(f), "prof": base + ".prof"})
+    print_step("Профиль")
+    if not tasks:
+        print_info("Профиль пуст: ни одна накладная или пакет не обрабатывались")
+        return
+
+    tasks.sort(key=lambda t: -t["total_s"])
+    selected = tasks[:slowest] if slowest > 0 else tasks
+    stats = pstats.Stats(selected[0]["prof"])
+    for task in selected[1:]:
+        stats.add(task["prof"])
+    stats_path = os.path.join(folder, PROFILE_STATS_FILENAME)
+    collapsed_path = os.path.join(folder, PROFILE_COLLAPSED_FILENAME)
+    stats.dump_stats(stats_path)
+    write_collapsed_stacks(stats, collapsed_path)
+
+    if slowest > 0:
+        print_info(f"Самые долгие задачи ({len(selected)} из {len(tasks)}):")
+        for task in selected:
+            print(f"  {task['total_s']:8.3f} с  {task['name']}")
+    print_info(f"Функции по суммарному времени ({len(selected)} задач):")
+    rows = sorted(stats.stats.items(), key=lambda kv: -kv[1][3])
+    for func, (_, calls, tt, ct, _) in rows[:PROFILE_TOP]:
+        print(f"  {ct:8.3f} с  сам {tt:7.3f} с  {calls:>9} выз.  {function_label(func)}")
+
+    # у каждого места — наибольший объём в пике одной задачи (пики разных задач не складываются)
+    sites = {}
+    for task in selected:
+        for site in task["sites"]:
+            if site["site"] not in sites or site["size"] > sites[site["site"]][0]:
+                sites[site["site"]] = (site["size"], site["count"], task["name"])
+    print_info("Места выделения памяти в пике задачи:")
+    for site, (size, blocks, name) in sorted(sites.items(), key=lambda kv: -kv[1][0])[:PROFILE_TOP]:
+        print(f"  {size / 1e6:8.2f} МБ  {blocks:>9} блоков  {short_path(site)}  ({name})")
+    print_info(f"Сохранено: {stats_path} (python -m pstats, snakeviz), {collapsed_path} (flamegraph.pl, speedscope)")
+
+
+@contextlib.contextmanager
+def profiled_run():
+    """
+    Профилирует запуск при --profile: каждая задача пишет свой профиль
+    (TaskProfile), а по окончании — в том числе по Ctrl+C — печатается сводка
+    (report_profile). Конвейер на это время выключается: cProfile видит
+    только поток, в котором включён.
+    """
+    folder = SETTINGS["profile_dir"]
+    if not folder:
+        yield
+        return
+    shutil.rmtree(os.path.join(folder, PROFILE_TASKS_FOLDER), ignore_errors=True)
+    depth = SETTINGS["pipeline_depth"]
+    SETTINGS["pipeline_depth"] = 0
+    print_info(f"Профилирование: профили задач пишутся в {folder}")
+    try:
+        yield
+    finally:
+        SETTINGS["pipeline_depth"] = depth
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        report_profile(folder, SETTINGS["profile_slowest"])
+
+
+# ----------------------------------------------------------------------
+# История запусков: SQLite для планирования мощностей
+# ----------------------------------------------------------------------
+HISTORY_FILENAME = "railway_history.sqlite3"
+HISTORY_BATCH = 100  # строк на одну транзакцию: запись не тормозит обработку
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    scenario TEXT NOT NULL,
+    host TEXT,
+    workers INTEGER,
+    tasks INTEGER,
+    succeeded INTEGER,
+    failed INTEGER,
+    skipped INTEGER,
+    pages INTEGER,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    elapsed_s REAL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    ts REAL NOT NULL,
+    kind TEXT,
+    name TEXT,
+    number INTEGER,
+    instruction TEXT,
+    stamp TEXT,
+    outcome TEXT,
+    pages_in INTEGER,
+    pages_out INTEGER,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    total_s REAL,
+    stages_json TEXT,
+    peak_mb REAL,
+    cache_hit INTEGER
+);
+CREATE INDEX IF NOT EXISTS items_run ON items(run_id);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started_at);
+"""
+
+
+def history_path():
+    return SETTINGS["history_path"] or os.path.join(SETTINGS["base_dir"], HISTORY_FILENAME)
+
+
+class JobHistory:
+    """
+    История запусков в SQLite (railway_history.sqlite3 в рабочей папке):
+    строка runs на каждый пакетный запуск (сценарии 1–5, скрепление) и
+    строка items на каждую накладную или пакет — номер, инструкция, штамп,
+    страницы, байты, время по этапам, исход. Строки items копятся в памяти
+    и пишутся одной транзакцией по HISTORY_BATCH штук и в конце запуска.
+    """
+
+    def __init__(self, path, scenario, tasks, workers):
+        self.path = path
+        self.started = time.time()
+        self._rows = []
+        self.conn = sqlite3.connect(path, timeout=30)
+        try:
+            self.conn.executescript(HISTORY_SCHEMA)
+            with self.conn:
+                self.run_id = self.conn.execute(
+                    "INSERT INTO runs (started_at, scenario, host, workers, tasks) VALUES (?, ?, ?, ?, ?)",
+                    (self.started, scenario, socket.gethostname(), workers, tasks),
+                ).lastrowid
+        except sqlite3.Error:
+            self.conn.close()
+            raise
+
+    def add(self, result, metrics):
+        counters = metrics.get("counters", {})
+        details = metrics.get("details", {})
+        if result.get("skipped"):
+            outcome = "skipped"
+        elif counters.get("quarantined"):
+            outcome = "quarantined"
+        elif not result["ok"]:
+            outcome = "error"
+        else:
+            outcome = "partial" if counters.get("errors") else "ok"
+        kind, name = metrics.get("kind"), metrics.get("name")
+        self._rows.append((
+            self.run_id, time.time(), kind, name,
+            extract_number_from_filename(name) if kind == "file" and name else None,
+            details.get("instruction"), details.get("stamp"), outcome,
+            counters.get("pages_in"), counters.get("pages_out"),
+            counters.get("bytes_in"), counters.get("bytes_out"),
+            metrics.get("total_s"), json.dumps(metrics.get("stages_s", {})),
+            metrics.get("memory_mb", {}).get("peak"), counters.get("cache_hits", 0),
+        ))
+        if len(self._rows) >= HISTORY_BATCH:
+            self.flush()
+
+    def flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        # база занята другим запуском дольше timeout — строки теряются, обработка продолжается
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO items (run_id, ts, kind, name, number, instruction, stamp, outcome, "
+                    "pages_in, pages_out, bytes_in, bytes_out, total_s, stages_json, peak_mb, cache_hit) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error as e:
+            print_error(f"История запусков: не записано строк {len(rows)}: {e}")
+
+    def finish(self, progress, succeeded, skipped):
+        """Дописывает оставшиеся строки и итог запуска, закрывает базу."""
+        self.flush()
+        finished = time.time()
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE runs SET finished_at = ?, succeeded = ?, failed = ?, skipped = ?, pages = ?, "
+                    "bytes_in = ?, bytes_out = ?, elapsed_s = ? WHERE id = ?",
+                    (finished, succeeded, progress.total - succeeded - skipped, skipped, progress.pages,
+                     progress.bytes_in, progress.bytes_out, round(finished - self.started, 3), self.run_id),
+                )
+        except sqlite3.Error as e:
+            print_error(f"История запусков: итог запуска не записан: {e}")
+        finally:
+            self.conn.close()
+
+
+def open_history(scenario, tasks, workers):
+    """JobHistory для нового запуска или None (история выключена или база недоступна)."""
+    if not SETTINGS["history"]:
+        return None
+    try:
+        return JobHistory(history_path(), scenario, tasks, workers)
+    except sqlite3.Error as e:
+        print_error(f"История запусков не пишется ({history_path()}): {e}")
+        return None
+
+
+def percentile(values, q):
+    """Перцентиль q (0–100) по ближайшему рангу; values отсортированы."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(len(values) * q / 100 + 0.5) - 1))]
+
+
+def print_history_report(days=30):
+    """
+    Сводка истории за days дней по дням и сценариям: запуски, файлы,
+    страницы, страниц в час работы, ошибки и перцентили времени на файл
+    (p50/p90/p99); ниже — медианы накладных со штампом и без и самые долгие
+    накладные с их штампами.
+    """
+    path = history_path()
+    if not os.path.exists(path):
+        print_info(f"Истории запусков пока нет: {path}")
+        return
+    since = time.time() - days * 86400
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        runs = conn.execute(
+            "SELECT date(started_at, 'unixepoch', 'localtime'), scenario, COUNT(*), SUM(pages), "
+            "SUM(elapsed_s), SUM(failed) FROM runs WHERE started_at >= ? AND finished_at IS NOT NULL "
+            "GROUP BY 1, 2 ORDER BY 1, 2",
+            (since,),
+        ).fetchall()
+        items = conn.execute(
+            "SELECT date(r.started_at, 'unixepoch', 'localtime'), r.scenario, i.total_s, i.stamp, i.kind, "
+            "i.name, i.pages_in FROM items i JOIN runs r ON r.id = i.run_id "
+            "WHERE r.started_at >= ? AND i.outcome IN ('ok', 'partial') AND i.cache_hit = 0",
+            (since,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    print_step(f"История запусков за {days} дн.: {path}")
+    if not runs:
+        print_info("Запусков за этот период нет.")
+        return
+    latencies = collections.defaultdict(list)
+    by_stamp = {True: [], False: []}
+    files = []
+    for day, scenario, total_s, stamp, kind, name, pages in items:
+        latencies[day, scenario].append(total_s)
+        latencies[None, scenario].append(total_s)
+        if kind == "file":
+            by_stamp[bool(stamp)].append(total_s)
+            files.append((total_s, name, stamp, pages))
+
+    totals = {}
+    for day, scenario, count_runs, pages, elapsed, failed in runs:
+        total = totals.setdefault(scenario, [0, 0, 0.0, 0])
+        for i, value in enumerate((count_runs, pages or 0, elapsed or 0.0, failed or 0)):
+            total[i] += value
+    header = (
+        f"  {'День':<10}  {'Сценарий':<20} {'Запусков':>8} {'Файлов':>7} {'Страниц':>8} "
+        f"{'Стр/ч':>8} {'Ошибок':>6} {'p50 с':>7} {'p90 с':>7} {'p99 с':>7}"
+    )
+
+    def row(day, scenario, count_runs, pages, elapsed, failed):
+        values = sorted(latencies[day, scenario])
+        rate = pages / elapsed * 3600 if elapsed else 0
+        print(
+            f"  {day or 'всего':<10}  {scenario:<20} {count_runs:>8} {len(values):>7} {pages:>8} "
+            f"{rate:>8.0f} {failed:>6} {percentile(values, 50):>7.2f} {percentile(values, 90):>7.2f} "
+            f"{percentile(values, 99):>7.2f}"
+        )
+
+    print_info("По дням и сценариям (Файлов — накладные и пакеты, собранные без кэша):")
+    print(header)
+    for day, scenario, count_runs, pages, elapsed, failed in runs:
+        row(day, scenario, count_runs, pages or 0, elapsed or 0.0, failed or 0)
+    print_info("По сценариям за весь период:")
+    print(header)
+    for scenario, (count_runs, pages, elapsed, failed) in sorted(totals.items()):
+        row(None, scenario, count_runs, pages, elapsed, failed)
+
+    if files:
+        print_info(
+            f"Медиана на накладную: со штампом {percentile(sorted(by_stamp[True]), 50):.2f} с "
+            f"({len(by_stamp[True])}), без штампа {percentile(sorted(by_stamp[False]), 50):.2f} с "
+            f"({len(by_stamp[False])})"
+        )
+        print_info("Самые долгие накладные:")
+        for total_s, name, stamp, pages in sorted(files, key=lambda f: -f[0])[:10]:
+            print(f"  {total_s:7.2f} с  {name}  (листов: {pages}, штамп: {stamp or 'нет'})")
+
+
+# ----------------------------------------------------------------------
+# Журнал заданий: восстановление после прерванного запуска
+# ----------------------------------------------------------------------
+class JobJournal:
+    """
+    Журнал переходов состояний (JSON Lines, только дозапись). Для накладной
+    ("file") и пакета скрепления ("chunk") пишется:
+        started — начата сборка, результат пишется во временный .part;
+        written — результат атомарно переименован на место;
+        done    — исходники перенесены в Done;
+        rolled_back — незавершённая сборка отменена при восстановлении.
+    Каждая запись — одна строка одним вызовом write в режиме дозаписи,
+    поэтому процессы пула могут писать в журнал одновременно. При --claims
+    журнал общий для нескольких обработчиков: запись и очистка идут под
+    блокировкой (файл <журнал>.lock, созданный с O_EXCL, как заявки FileClaims).
+    """
+
+    FINAL_STATES = ("done", "rolled_back")
+    LOCK_SUFFIX = ".lock"
+    # блокировка держится на одну запись или одну очистку: если она старше,
+    # её владелец умер, не успев её снять
+    LOCK_STALE = 30.0
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, kind, item, state, **details):
+        entry = {"ts": time.time(), "kind": kind, "item": item, "state": state}
+        entry.update(details)
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._locked():
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Исключительная блокировка журнала на время блока (только при --claims)."""
+        if not SETTINGS["claims"]:
+            yield
+            return
+        lock = self.path + self.LOCK_SUFFIX
+        while True:
+            try:
+                os.close(os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                break
+            except FileExistsError:
+                pass
+            try:
+                stale = time.time() - os.stat(lock).st_mtime > self.LOCK_STALE
+            except FileNotFoundError:
+                continue
+            if not stale:
+                time.sleep(0.01)
+                continue
+            # как FileClaims._expire: снимает переименованием ровно один из ждущих,
+            # а свежую блокировку, взятую между проверкой и переименованием, возвращает
+            moved = f"{lock}.{socket.gethostname()}.{os.getpid()}.stale"
+            try:
+                os.rename(lock, moved)
+            except OSError:
+                continue
+            if time.time() - os.stat(moved).st_mtime > self.LOCK_STALE:
+                os.remove(moved)
+                print_info(f"Снята брошенная блокировка журнала {os.path.basename(lock)}")
+            else:
+                with contextlib.suppress(OSError):
+                    os.rename(moved, lock)
+        try:
+            yield
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lock)
+
+    def seal(self):
+        """Завершает строку, оборванную падением, чтобы новые записи не склеились с ней."""
+        with self._locked():
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                return
+            with open(self.path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def in_flight(self):
+        """Последние записи по элементам, которые не дошли до done/rolled_back."""
+        if not os.path.exists(self.path):
+            return []
+        last = {}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # недописанная последняя строка после падения
+                    continue
+                key = (entry.get("kind"), entry.get("item"))
+                # подробности (inputs, output) есть только в записи started — последующие их дополняют
+                last[key] = {**last.get(key, {}), **entry}
+        return [e for e in last.values() if e["state"] not in self.FINAL_STATES]
+
+    def compact(self):
+        """
+        Оставляет в журнале только незавершённые элементы (по одной сводной
+        записи на элемент), а если их нет — удаляет журнал. Новый журнал пишется
+        во временный файл и подменяет старый через os.replace. При --claims всё
+        это — под блокировкой: соседние обработчики в это время не дописывают,
+        поэтому их записи не пропадут вместе со старым файлом.
+        """
+        with self._locked():
+            if not os.path.exists(self.path):
+                return
+            pending = self.in_flight()
+            if not pending:
+                os.remove(self.path)
+                return
+            temp_path = f"{self.path}.{os.getpid()}{PARTIAL_SUFFIX}"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for entry in pending:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+
+JOURNAL = JobJournal(os.path.join(BASE_DIR, JOURNAL_FILENAME))
+
+
+def recover_interrupted_jobs():
+    """
+    Доводит до конца или откатывает элементы, прерванные прошлым запуском:
+    - результат уже на месте (written) — исходники переносятся в Done;
+    - результат не дописан (started) — удаляется временный .part, исходники
+      остаются на месте и будут обработаны заново.
+    При --claims элементы, которые сейчас собирает другой обработчик (его
+    заявки живы), не трогаются.
+    """
+    JOURNAL.seal()
+    pending = JOURNAL.in_flight()
+    if not pending:
+        JOURNAL.compact()
+        return
+
+    print_step("Восстановление после прерванного запуска")
+    for entry in pending:
+        inputs = [path for path in entry.get("inputs", []) if os.path.exists(path)]
+        with claimed(inputs, entry["item"]) as ok:
+            if ok:
+                _recover_entry(entry, inputs)
+
+    JOURNAL.compact()
+
+
+def _recover_entry(entry, inputs):
+    kind, item = entry["kind"], entry["item"]
+    output = entry.get("output")
+    done_folder = entry.get("done_folder")
+
+    if entry["state"] == "written":
+        moved = all(move_file_to_done(path, done_folder) for path in inputs)
+        if moved:
+            JOURNAL.record(kind, item, "done")
+            print_success(f"Завершено: {item} (исходники перенесены в Done)")
+        else:
+            print_error(f"Не удалось завершить: {item}")
+    else:
+        if output and os.path.exists(output + PARTIAL_SUFFIX):
+            os.remove(output + PARTIAL_SUFFIX)
+        JOURNAL.record(kind, item, "rolled_back")
+        print_info(f"Отменено и будет выполнено заново: {item}")
+
+
+# ----------------------------------------------------------------------
+# Заявки: несколько обработчиков (процессов, машин) на общих папках
+# ----------------------------------------------------------------------
+CLAIMS_FOLDER = ".claims"  # внутри папки исходников: <имя>.claim на каждый взятый в работу файл
+CLAIM_SUFFIX = ".claim"
+
+
+class FileClaims:
+    """
+    Заявки на исходники в общих папках Railway и Ready, чтобы несколько
+    запусков (процессы пула, соседние рабочие места) не брали один файл.
+    Заявка — файл <папка>/.claims/<имя>.claim, созданный с O_EXCL: из
+    нескольких претендентов его создаст ровно один, в том числе на сетевых
+    дисках. Пока файл в работе, фоновый поток раз в ttl/4 обновляет mtime
+    заявок. Заявка, которую не обновляли дольше ttl (обработчик умер или
+    машина выключена), или заявка умершего процесса этой же машины снимается
+    переименованием — из нескольких снимающих это удаётся одному.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{self.pid}"
+        self._held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    @staticmethod
+    def claim_path(path):
+        folder, name = os.path.split(os.path.abspath(path))
+        return os.path.join(folder, CLAIMS_FOLDER, name + CLAIM_SUFFIX)
+
+    def acquire(self, paths):
+        """
+        Берёт заявки на все paths сразу (пакет — целиком) и возвращает True.
+        Если хоть один файл взят другим обработчиком или уже исчез (его
+        обработали, пока список устаревал), взятые заявки снимаются — False.
+        """
+        taken = []
+        for path in paths:
+            if not self._acquire_one(path):
+                self.release(taken)
+                return False
+            taken.append(path)
+        if not all(os.path.exists(path) for path in paths):
+            self.release(taken)
+            return False
+        return True
+
+    def _acquire_one(self, path):
+        claim = self.claim_path(path)
+        os.makedirs(os.path.dirname(claim), exist_ok=True)
+        for attempt in range(2):
+            try:
+                fd = os.open(claim, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if attempt or not self._expire(claim):
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"owner": self.owner, "host": self.host, "pid": self.pid, "ts": time.time()}, f)
+            with self._lock:
+                self._held.add(claim)
+            self._start_heartbeat()
+            return True
+        return False
+
+    @staticmethod
+    def _read(claim):
+        try:
+            with open(claim, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # заявка только что создана и ещё не дописана или уже снята
+            return {}
+
+    def _is_dead(self, info):
+        """Владелец — процесс этой машины, которого больше нет (проверяется только на POSIX)."""
+        if os.name != "posix" or info.get("host") != self.host or not info.get("pid"):
+            return False
+        try:
+            os.kill(info["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def _expire(self, claim):
+        """Снимает просроченную заявку claim; True — можно пробовать взять файл снова."""
+        try:
+            age = time.time() - os.stat(claim).st_mtime
+        except FileNotFoundError:
+            return True
+        info = self._read(claim)
+        if age < self.ttl and not self._is_dead(info):
+            return False
+        stale = f"{claim}.{self.host}.{self.pid}.stale"
+        try:
+            os.rename(claim, stale)
+        except FileNotFoundError:
+            # снял кто-то другой: он же, скорее всего, и взял файл — попробуем ещё раз
+            return True
+        except OSError:
+            return False
+        # между проверкой и переименованием заявку могли снять и взять заново —
+        # тогда возвращаем свежую на место
+        if time.time() - os.stat(stale).st_mtime < self.ttl and not self._is_dead(self._read(stale)):
+            with contextlib.suppress(OSError):
+                os.rename(stale, claim)
+            return False
+        os.remove(stale)
+        reason = f"не обновлялась {age:.0f} с" if age >= self.ttl else "процесс завершился"
+        print_info(
+            f"Снята заявка {info.get('owner', '?')} на {os.path.basename(claim)[:-len(CLAIM_SUFFIX)]} ({reason})"
+        )
+        return True
+
+    def release(self, paths, force=False):
+        """Снимает свои заявки на paths; force — и чужие (файл убран сторожем, владелец убит)."""
+        for path in paths:
+            claim = self.claim_path(path)
+            with self._lock:
+                self._held.discard(claim)
+            if not force and self._read(claim).get("owner") not in (self.owner, None):
+                # заявку сочли просроченной и отдали другому обработчику
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(claim)
+
+    def sweep(self, folder):
+        """Удаляет просроченные заявки на файлы, которых в folder больше нет."""
+        claims_folder = os.path.join(folder, CLAIMS_FOLDER)
+        if not os.path.isdir(claims_folder):
+            return
+        for name in os.listdir(claims_folder):
+            if name.endswith(CLAIM_SUFFIX) and not os.path.exists(os.path.join(folder, name[:-len(CLAIM_SUFFIX)])):
+                claim = os.path.join(claims_folder, name)
+                with contextlib.suppress(FileNotFoundError):
+                    if time.time() - os.stat(claim).st_mtime >= self.ttl or self._is_dead(self._read(claim)):
+                        os.remove(claim)
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._beat, name="railway-claims", daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.ttl / 4)
+            with self._lock:
+                held = list(self._held)
+            for claim in held:
+                with contextlib.suppress(OSError):
+                    os.utime(claim)
+
+
+_claims = None
+
+
+def file_claims():
+    """FileClaims этого процесса при --claims, иначе None (процессы пула заводят свои)."""
+    global _claims
+    if not SETTINGS["claims"]:
+        return None
+    if _claims is None or _claims.pid != os.getpid() or _claims.ttl != SETTINGS["claim_ttl"]:
+        _claims = FileClaims(SETTINGS["claim_ttl"])
+    return _claims
+
+
+@contextlib.contextmanager
+def claimed(paths, item):
+    """
+    Берёт заявки на paths на время блока (при --claims). Отдаёт False, если
+    элемент item уже обрабатывается в другом месте — тогда его пропускают.
+    """
+    claims = file_claims()
+    if claims is None:
+        yield True
+        return
+    if not claims.acquire(paths):
+        print_info(f"Пропуск: {item} — уже взят другим обработчиком")
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        claims.release(paths)
+
+
+# ----------------------------------------------------------------------
+# Кэш шаблонов: инструкции и 3-6.pdf разбираются один раз за сессию
+# ----------------------------------------------------------------------
+STAMP_CACHE_MB = 64  # разобранные штампы в памяти (на кэш), МБ: при --serve/--watch их тысячи
+
+
+class TemplateCache:
+    """
+    Хранит разобранные PdfReader для файлов шаблонов (инструкции, 3-6.pdf).
+    Запись актуальна, пока у файла не изменились mtime и размер. Если mtime
+    изменился, файл перечитывается и сверяется хэш содержимого: при другом
+    хэше шаблон разбирается заново, при том же — используется старый разбор.
+
+    parse — чем разбирать содержимое файла (PdfReader или pikepdf.open).
+    max_bytes — предел суммарного размера файлов в кэше: сверх него вытесняются
+    давно не использованные записи (последняя остаётся всегда); 0 — без
+    предела, для шаблонов, которых всего несколько.
+    """
+
+    def __init__(self, parse=PdfReader, max_bytes=0):
+        self.parse = parse
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._preloaded = collections.OrderedDict()
+        self._bytes = 0
+        # preload зовёт поток чтения конвейера, get_reader — поток сборки
+        self._lock = threading.Lock()
+
+    def preload(self, path):
+        """
+        Читает файл заранее (конвейер делает это в своём потоке), чтобы
+        get_reader разобрал его без обращения к диску. Сам разбор остаётся
+        за get_reader — PdfReader нельзя делить между потоками.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        with self._lock:
+            self._preloaded[path] = (stat.st_mtime_ns, stat.st_size, data)
+            # прочитанное заранее, но так и не разобранное (накладная упала) не копится
+            while self.max_bytes and len(self._preloaded) > 1 and \
+                    sum(len(item[2]) for item in self._preloaded.values()) > self.max_bytes:
+                self._preloaded.popitem(last=False)
+
+    def _entry(self, path):
+        """Актуальная запись кэша для path (файл при необходимости разбирается заново)."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                self._entries.move_to_end(path)
+            preloaded = self._preloaded.pop(path, None)
+        if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry
+
+        if preloaded and preloaded[:2] == (stat.st_mtime_ns, stat.st_size):
+            data = preloaded[2]
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        if entry and entry["digest"] == digest:
+            entry["mtime"], entry["size"] = stat.st_mtime_ns, stat.st_size
+            return entry
+
+        entry = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "digest": digest,
+            "reader": self.parse(io.BytesIO(data)),
+            "bytes": len(data),
+            # то, что движок строит из разобранного файла (Form XObject страниц)
+            "memo": {},
+        }
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old:
+                self._bytes -= old["bytes"]
+            self._entries[path] = entry
+            self._bytes += entry["bytes"]
+            while self.max_bytes and self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["bytes"]
+        return entry
+
+    def get_reader(self, path):
+        return self._entry(path)["reader"]
+
+    def memo(self, path):
+        """Словарь для производных от разобранного файла; сбрасывается вместе с записью."""
+        return self._entry(path)["memo"]
+
+    def get_page(self, path, index=0):
+        reader = self.get_reader(path)
+        return reader.pages[index] if len(reader.pages) > index else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._preloaded.clear()
+            self._bytes = 0
+
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+# ----------------------------------------------------------------------
+# Индекс штампов: номер -> путь, без сканирования папки на каждую накладную
+# ----------------------------------------------------------------------
+class StampIndex:
+    """
+    Индекс папки со штампами. Строится одним проходом os.scandir и
+    обновляется только при изменении mtime папки (добавление, удаление,
+    переименование файлов); номера уже известных файлов повторно не разбираются.
+    Отрицательные результаты ("штампа нет") тоже кэшируются до следующего обновления.
+    Первая страница каждого штампа разбирается один раз и переиспользуется.
+    """
+
+    # на сетевых дисках и FAT точность mtime бывает до 2 секунд: если папка
+    # менялась совсем недавно, на её mtime не полагаемся и пересканируем
+    MTIME_SLACK = 2.0
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._dir_mtime = None
+        self._names = {}
+        self._by_number = {}
+        self._missing = set()
+        self._duplicates = {}
+        self._pages = TemplateCache(max_bytes=STAMP_CACHE_MB * 1024 * 1024)
+        # (путь, mtime, размер, настройки) -> файл, который накладывается вместо штампа
+        self._overlays = {}
+        # find() зовут и поток чтения конвейера, и поток сборки
+        self._lock = threading.RLock()
+        self._overlay_lock = threading.Lock()
+
+    def _is_fresh(self):
+        try:
+            mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return False
+        if mtime != self._dir_mtime:
+            return False
+        return time.time() - mtime / 1e9 > self.MTIME_SLACK
+
+    def refresh(self, force=False):
+        with self._lock:
+            self._refresh(force)
+
+    def _refresh(self, force):
+        if not force and self._is_fresh():
+            return
+        if not os.path.exists(self.folder):
+            self._dir_mtime = None
+            self._names, self._by_number, self._duplicates = {}, {}, {}
+            self._missing.clear()
+            return
+
+        self._dir_mtime = os.stat(self.folder).st_mtime_ns
+        names = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(".pdf") and entry.is_file():
+                    if entry.name in self._names:
+                        names[entry.name] = self._names[entry.name]
+                    else:
+                        names[entry.name] = extract_number_from_filename(entry.name)
+        self._names = names
+
+        by_number = {}
+        duplicates = {}
+        for name in sorted(names):
+            number = names[name]
+            if number is None:
+                continue
+            if number in by_number:
+                duplicates.setdefault(number, [by_number[number]]).append(name)
+            else:
+                by_number[number] = name
+        self._by_number = by_number
+        self._missing.clear()
+
+        if duplicates != self._duplicates:
+            for number, dup_names in sorted(duplicates.items()):
+                print_error(
+                    f"Несколько штампов с номером {number}: {', '.join(dup_names)}. "
+                    f"Используется {dup_names[0]}"
+                )
+        self._duplicates = duplicates
+
+    def find(self, file_number):
+        if file_number is None:
+            return None
+        with self._lock:
+            self._refresh(False)
+            if file_number in self._missing:
+                return None
+            name = self._by_number.get(file_number)
+            if name is None:
+                self._missing.add(file_number)
+                return None
+        return os.path.join(self.folder, name)
+
+    def duplicates(self):
+        with self._lock:
+            self._refresh(False)
+            return dict(self._duplicates)
+
+    def overlay_path(self, stamp_path):
+        """
+        Файл, который накладывается вместо stamp_path: с --stamp-dpi —
+        облегчённая копия (см. optimized_stamp), готовится при первой встрече
+        штампа; иначе сам штамп.
+        """
+        if SETTINGS["stamp_dpi"] <= 0:
+            return stamp_path
+        st = os.stat(stamp_path)
+        memo_key = (stamp_path, st.st_mtime_ns, st.st_size, stamp_options())
+        # отдельная блокировка: пока штамп облегчается, find() из другого потока не ждёт
+        with self._overlay_lock:
+            if memo_key not in self._overlays:
+                self._overlays[memo_key] = optimized_stamp(stamp_path, st)
+            return self._overlays[memo_key]
+
+    def get_page(self, stamp_path):
+        """
+        Первая страница штампа; разбирается один раз, пока файл не изменится
+        и пока его не вытеснили из кэша более свежие штампы (STAMP_CACHE_MB).
+        """
+        return self._pages.get_page(self.overlay_path(stamp_path))
+
+    def preload(self, stamp_path):
+        """Заранее читает файл штампа с диска для следующего get_page (см. TemplateCache.preload)."""
+        self._pages.preload(self.overlay_path(stamp_path))
+
+
+STAMP_INDEX = StampIndex(DIR_STAMP)
+STAMP_INDEXES = {DIR_STAMP: STAMP_INDEX}
+
+
+def find_stamp_path(file_number):
+    return STAMP_INDEX.find(file_number)
+
+
+# ----------------------------------------------------------------------
+# Облегчение штампов: скан в 600 dpi -> изображение в разрешении печати
+# ----------------------------------------------------------------------
+OPTIMIZED_STAMP_FOLDER = ".optimized"  # внутри папки штампов: облегчённые копии (StampIndex их не видит)
+STAMP_OPTIMIZER_VERSION = 1  # меняется вместе с алгоритмом, чтобы старые копии пересобирались
+STAMP_JPEG_QUALITY = 85
+STAMP_WHITE_LEVEL = 245  # светлее — фон скана, обрезается (для изображений без маски прозрачности)
+STAMP_ALPHA_LEVEL = 8  # прозрачнее — фон, обрезается (для изображений с маской /SMask)
+STAMP_CROP_MARGIN = 2  # поля вокруг содержимого после обрезки, пикселей исходника
+IDENTITY_MATRIX = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+# цветовое пространство -> (число компонентов, режим PIL)
+IMAGE_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+DEVICE_COLORSPACES = {"/DeviceGray": 1, "/DeviceRGB": 3, "/DeviceCMYK": 4}
+
+
+def stamp_options():
+    """Настройки облегчения штампов — часть имени облегчённой копии."""
+    return SETTINGS["stamp_dpi"], SETTINGS["stamp_format"], bool(SETTINGS["stamp_gray"])
+
+
+def optimized_stamp(stamp_path, st):
+    """
+    Путь облегчённой копии штампа в Stamp/.optimized; при первой встрече
+    штампа (или после его изменения) копия собирается optimize_stamp.
+    Имя копии включает хеш mtime, размера и настроек, старые копии того же
+    штампа удаляются. Если облегчить не удалось — сам штамп.
+    """
+    folder = os.path.join(os.path.dirname(stamp_path), OPTIMIZED_STAMP_FOLDER)
+    name = os.path.basename(stamp_path)
+    key = hashlib.sha1(
+        repr((STAMP_OPTIMIZER_VERSION, st.st_mtime_ns, st.st_size, stamp_options())).encode("utf-8")
+    ).hexdigest()[:12]
+    output_path = os.path.join(folder, f"{os.path.splitext(name)[0]}~{key}.pdf")
+    if os.path.exists(output_path):
+        return output_path
+
+    try:
+        os.makedirs(folder, exist_ok=True)
+        # несколько процессов могут облегчать один штамп: каждый пишет своё
+        # временное имя, os.replace атомарен
+        temp_path = f"{output_path}.{os.getpid()}{PARTIAL_SUFFIX}"
+        try:
+            with open(temp_path, "wb") as f:
+                images = optimize_stamp(stamp_path, f)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except Exception as e:
+        print_error(f"Не удалось облегчить штамп {name}: {e}. Используется исходный")
+        return stamp_path
+
+    prefix = f"{os.path.splitext(name)[0]}~"
+    for entry in os.listdir(folder):
+        path = os.path.join(folder, entry)
+        if entry.startswith(prefix) and entry.endswith(".pdf") and path != output_path:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+    if images:
+        size = os.path.getsize(output_path)
+        print(
+            f"    {Fore.MAGENTA}+ Штамп облегчён:{Style.RESET_ALL} {name} "
+            f"({st.st_size / 1024:.0f} КБ → {size / 1024:.0f} КБ, изображений: {images})"
+        )
+    return output_path
+
+
+def optimize_stamp(stamp_path, stream):
+    """
+    Пишет в stream первую страницу штампа с облегчёнными изображениями
+    (см. optimize_image) и возвращает, сколько изображений заменено.
+    Обрезку по содержимому компенсирует матрица перед каждым Do, поэтому
+    штамп ложится на накладную на прежнее место и в прежнем размере.
+    """
+    writer = PdfWriter()
+    page = writer.add_page(PdfReader(stamp_path).pages[0])
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    contents = page.get_contents()
+    if not xobjects or contents is None:
+        writer.write(stream)
+        return 0
+    xobjects = xobjects.get_object()
+
+    content = ContentStream(contents, writer)
+    crops = {}
+    for name, (width, height) in image_placements(content, xobjects).items():
+        result = optimize_image(xobjects[name].get_object(), width, height)
+        if result is None:
+            continue
+        image, mask, crop = result
+        if mask is not None:
+            image[NameObject("/SMask")] = writer._add_object(mask)
+        xobjects[NameObject(name)] = writer._add_object(image)
+        crops[name] = crop
+
+    if crops:
+        operations = []
+        for operands, operator in content.operations:
+            if operator == b"Do" and operands[0] in crops:
+                x, y, width, height = crops[operands[0]]
+                matrix = [FloatObject(round(v, 6)) for v in (width, 0, 0, height, x, y)]
+                operations += [([], b"q"), (matrix, b"cm"), (operands, operator), ([], b"Q")]
+            else:
+                operations.append((operands, operator))
+        content.operations = operations
+        page[NameObject("/Contents")] = writer._add_object(content)
+    # PdfWriter пишет все свои объекты, в том числе заменённые изображения;
+    # копия страницы в новом писателе забирает только то, на что она ссылается.
+    # Дедупликация и линеаризация применятся потом, к результату
+    output = PdfWriter()
+    output.add_page(page)
+    output.write(stream)
+    return len(crops)
+
+
+def _multiply(m, ctm):
+    a, b, c, d, e, f = m
+    A, B, C, D, E, F = ctm
+    return (a * A + b * C, a * B + b * D, c * A + d * C, c * B + d * D, e * A + f * C + E, e * B + f * D + F)
+
+
+def image_placements(content, xobjects):
+    """
+    Растровые изображения страницы и самый крупный размер, в котором каждое
+    рисуется (пунктов по ширине и высоте), по матрицам q/Q/cm перед Do.
+    """
+    ctm = IDENTITY_MATRIX
+    saved = []
+    sizes = {}
+    for operands, operator in content.operations:
+        if operator == b"q":
+            saved.append(ctm)
+        elif operator == b"Q":
+            ctm = saved.pop() if saved else IDENTITY_MATRIX
+        elif operator == b"cm":
+            ctm = _multiply([float(v) for v in operands], ctm)
+        elif operator == b"Do":
+            name = operands[0]
+            xobject = xobjects.get(name)
+            if xobject is None or xobject.get_object().get("/Subtype") != "/Image":
+                continue
+            width, height = (ctm[0] ** 2 + ctm[1] ** 2) ** 0.5, (ctm[2] ** 2 + ctm[3] ** 2) ** 0.5
+            old_width, old_height = sizes.get(name, (0, 0))
+            sizes[name] = (max(old_width, width), max(old_height, height))
+    return {name: size for name, size in sizes.items() if size[0] > 0 and size[1] > 0}
+
+
+def image_components(colorspace):
+    """Число компонентов цвета для DeviceGray/RGB/CMYK и ICCBased; для прочих (Indexed, Lab...) — None."""
+    colorspace = colorspace.get_object() if colorspace is not None else None
+    if isinstance(colorspace, ArrayObject) and colorspace and colorspace[0] == "/ICCBased":
+        return colorspace[1].get_object().get("/N")
+    return DEVICE_COLORSPACES.get(colorspace)
+
+
+def decode_image(xobject):
+    """
+    Изображение PIL из потока /Image: 8 бит на компонент, Flate или без
+    сжатия, либо JPEG (DCTDecode); для прочих (JBIG2, CCITT, палитры,
+    /Decode) — None, такие изображения остаются как есть.
+    """
+    if xobject.get("/BitsPerComponent") != 8 or "/Decode" in xobject or xobject.get("/ImageMask"):
+        return None
+    components = image_components(xobject.get("/ColorSpace"))
+    mode = IMAGE_MODES.get(components)
+    if mode is None:
+        return None
+    filters = xobject.get("/Filter")
+    if isinstance(filters, ArrayObject):
+        filters = filters[0] if len(filters) == 1 else ArrayObject(filters)
+    width, height = xobject["/Width"], xobject["/Height"]
+    if filters == "/DCTDecode":
+        image = Image.open(io.BytesIO(xobject._data))
+        # у CMYK-JPEG из Photoshop инвертированы каналы; такие не трогаем
+        return image if image.mode == mode and image.size == (width, height) and mode != "CMYK" else None
+    if filters not in (None, "/FlateDecode"):
+        return None
+    data = xobject.get_data()
+    if len(data) < width * height * components:
+        return None
+    return Image.frombytes(mode, (width, height), data[:width * height * components])
+
+
+def encode_image(image, colorspace, jpeg):
+    """Поток /Image из изображения PIL: JPEG (для серых и RGB) или Flate."""
+    stream = EncodedStreamObject()
+    if jpeg and image.mode in ("L", "RGB"):
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=STAMP_JPEG_QUALITY, optimize=True)
+        stream._data = buffer.getvalue()
+        stream[NameObject("/Filter")] = NameObject("/DCTDecode")
+    else:
+        stream._data = zlib.compress(image.tobytes(), 9)
+        stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+    stream.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(image.width),
+        NameObject("/Height"): NumberObject(image.height),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+        NameObject("/ColorSpace"): colorspace,
+    })
+    return stream
+
+
+def optimize_image(xobject, width_pt, height_pt):
+    """
+    Облегчает изображение штампа, которое рисуется размером width_pt x height_pt:
+    обрезает по содержимому (светлый фон скана или прозрачные края маски),
+    уменьшает до SETTINGS["stamp_dpi"], при stamp_gray переводит в оттенки
+    серого и пережимает (stamp_format). Возвращает (изображение, маска или None,
+    (x, y, ширина, высота) обрезки в долях исходного) или None, если
+    изображение не поддерживается или облегчённое не меньше исходного.
+    """
+    image = decode_image(xobject)
+    if image is None or "/Mask" in xobject:
+        return None
+    mask = None
+    original_size = len(xobject._data)
+    if "/SMask" in xobject:
+        smask = xobject["/SMask"].get_object()
+        mask = decode_image(smask)
+        if mask is None or mask.mode != "L" or "/Matte" in smask:
+            return None
+        original_size += len(smask._data)
+        if mask.size != image.size:
+            mask = mask.resize(image.size, Image.BILINEAR)
+
+    width, height = image.size
+    if mask is not None:
+        content = mask.point(lambda a: 255 if a > STAMP_ALPHA_LEVEL else 0)
+    else:
+        content = image.convert("L").point(lambda v: 255 if v < STAMP_WHITE_LEVEL else 0)
+    box = content.getbbox() or (0, 0, width, height)
+    x0, y0 = max(0, box[0] - STAMP_CROP_MARGIN), max(0, box[1] - STAMP_CROP_MARGIN)
+    x1, y1 = min(width, box[2] + STAMP_CROP_MARGIN), min(height, box[3] + STAMP_CROP_MARGIN)
+    image = image.crop((x0, y0, x1, y1))
+    if mask is not None:
+        mask = mask.crop((x0, y0, x1, y1))
+
+    # разрешение, в котором изображение ляжет на бумагу, — по менее плотной оси
+    dpi = min(width * 72 / width_pt, height * 72 / height_pt)
+    scale = SETTINGS["stamp_dpi"] / dpi
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+        if mask is not None:
+            mask = mask.resize(size, Image.LANCZOS)
+    colorspace = xobject["/ColorSpace"]
+    if SETTINGS["stamp_gray"] and image.mode != "L":
+        image = image.convert("L")
+    if image.mode == "L":
+        colorspace = NameObject("/DeviceGray")
+
+    jpeg = SETTINGS["stamp_format"] == "jpeg"
+    new_image = encode_image(image, colorspace, jpeg)
+    new_mask = encode_image(mask, NameObject("/DeviceGray"), False) if mask is not None else None
+    new_size = len(new_image._data) + (len(new_mask._data) if new_mask is not None else 0)
+    if new_size >= original_size:
+        return None
+    for key in ("/Interpolate", "/Intent"):
+        if key in xobject:
+            new_image[NameObject(key)] = xobject[key]
+    # обрезанный край в системе координат изображения: строки идут сверху вниз
+    crop = (x0 / width, 1 - y1 / height, (x1 - x0) / width, (y1 - y0) / height)
+    return new_image, new_mask, crop
+
+
+def page_to_form_xobject(writer, page, background=None, stamp=None, bbox=None):
+    """
+    Помещает содержимое страницы в writer как Form XObject и возвращает ссылку.
+    С background под содержимое подкладывается фон инструкции, а рамка
+    берётся от фона — так же, как у обычной страницы с фоном. Со stamp
+    поверх содержимого рисуется штамп (StampLayer). bbox — другая рамка
+    вместо MediaBox страницы.
+    """
+    form = DecodedStreamObject()
+    contents = page.get_contents()
+    data = contents.get_data() if contents is not None else b""
+    resources = page.get("/Resources")
+    bbox = page.mediabox if bbox is None else bbox
+    if stamp is not None:
+        data = b"q\n" + data + stamp.draw_operator()
+    if background is not None:
+        data = background.draw_operator() + data
+        bbox = background.page.mediabox
+    form.set_data(data)
+    form = form.flate_encode()
+
+    resources = resources.get_object().clone(writer) if resources is not None else DictionaryObject()
+    if background is not None:
+        resources = background.add_to_resources(resources)
+    if stamp is not None:
+        resources = stamp.add_to_resources(resources)
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject(bbox),
+        NameObject("/Resources"): resources,
+    })
+    return writer._add_object(form)
+
+
+def resources_with_xobject(resources, name, xobject):
+    """Копия словаря ресурсов с добавленным XObject под именем name."""
+    result = DictionaryObject()
+    if resources is not None:
+        result.update(resources.get_object())
+    xobjects = DictionaryObject()
+    if "/XObject" in result:
+        xobjects.update(result["/XObject"])
+    xobjects[NameObject(name)] = xobject
+    result[NameObject("/XObject")] = xobjects
+    return result
+
+
+def content_references(writer, page):
+    """Ссылки на потоки содержимого страницы из writer — без разбора и пережатия самих потоков."""
+    if "/Contents" not in page:
+        return []
+    raw = page.raw_get("/Contents")
+    obj = raw.get_object()
+    if isinstance(obj, ArrayObject):
+        return list(obj)
+    if isinstance(raw, IndirectObject):
+        return [raw]
+    return [writer._add_object(obj)]
+
+
+def _shared_stream(writer, data):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return writer._add_object(stream)
+
+
+class BackgroundLayer:
+    """
+    Фон инструкции, помещённый в PdfWriter один раз как Form XObject.
+    Каждая страница документа лишь ссылается на него из короткого потока
+    "q /RailwayBg Do Q", поэтому размер файла не растёт с числом страниц.
+    """
+
+    def __init__(self, writer, bg_page):
+        self.page = bg_page
+        self.writer = writer
+        self.xobject = page_to_form_xobject(writer, bg_page)
+        self.draw = _shared_stream(writer, self.draw_operator())
+
+    @staticmethod
+    def draw_operator():
+        return f"q {BACKGROUND_XOBJECT_NAME} Do Q\n".encode("ascii")
+
+    def add_to_resources(self, resources):
+        """Копия словаря ресурсов с добавленным XObject фона."""
+        return resources_with_xobject(resources, BACKGROUND_XOBJECT_NAME, self.xobject)
+
+    def apply(self, page):
+        """Подкладывает фон под содержимое страницы, уже добавленной в writer."""
+        page[NameObject("/Resources")] = self.add_to_resources(page.get("/Resources"))
+        page[NameObject("/Contents")] = ArrayObject([self.draw] + content_references(self.writer, page))
+
+        # геометрия страницы берётся от фона, как при прежнем merge_page на фон
+        for box in PAGE_GEOMETRY_KEYS:
+            if box in self.page:
+                page[NameObject(box)] = self.page.raw_get(box)
+            elif box in page:
+                del page[box]
+
+
+class StampLayer:
+    """
+    Штамп, помещённый в PdfWriter один раз как Form XObject с рамкой по
+    TrimBox штампа (ту же обрезку делает merge_page). Потоки содержимого
+    страницы не разбираются и не пережимаются: вокруг них в /Contents
+    добавляются общие потоки "q" и "Q q /RailwayStamp Do Q", поэтому
+    наложение стоит одинаково на простой и на тяжёлой странице.
+    Аннотации штампа так не перенести — для таких штампов needs_merge,
+    и они накладываются через merge_page.
+    """
+
+    def __init__(self, writer, stamp_page):
+        self.page = stamp_page
+        self.writer = writer
+        self.needs_merge = "/Annots" in stamp_page
+        if self.needs_merge:
+            return
+        self.xobject = page_to_form_xobject(writer, stamp_page, bbox=stamp_page.trimbox)
+        self.push = _shared_stream(writer, b"q\n")
+        self.draw = _shared_stream(writer, self.draw_operator())
+
+    @staticmethod
+    def draw_operator():
+        # Q закрывает q, открытый перед содержимым страницы
+        return f"\nQ\nq {STAMP_XOBJECT_NAME} Do Q\n".encode("ascii")
+
+    def add_to_resources(self, resources):
+        """Копия словаря ресурсов с добавленным XObject штампа."""
+        return resources_with_xobject(resources, STAMP_XOBJECT_NAME, self.xobject)
+
+    def apply(self, page):
+        """Накладывает штамп поверх содержимого страницы, уже добавленной в writer."""
+        page[NameObject("/Resources")] = self.add_to_resources(page.get("/Resources"))
+        page[NameObject("/Contents")] = ArrayObject(
+            [self.push] + content_references(self.writer, page) + [self.draw]
+        )
+
+
+# ----------------------------------------------------------------------
+# Раскладка страниц: декларативное описание вместо цепочки PdfWriter
+# ----------------------------------------------------------------------
+# Описание раскладки:
+#   "backs"       — номер листа исходника -> номер страницы шаблона (3-6.pdf, с 0) на обороте;
+#   "blank_backs" — остальным листам добавляется пустой оборот;
+#   "order"       — порядок листов: None — как в файле, "reverse" — обратный,
+#                   либо список номеров листов (с 1).
+ONE_SIDED_LAYOUT = {"backs": {}, "blank_backs": False, "order": None}
+DUPLEX_LAYOUT = {"backs": {3: 0, 6: 1}, "blank_backs": True, "order": None}
+
+NUP_CHOICES = (1, 2, 4)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_layout(backs, blank_backs, order, page_count):
+    if order is None:
+        sheets = range(page_count)
+    elif order == "reverse":
+        sheets = reversed(range(page_count))
+    else:
+        sheets = [n - 1 for n in order if 1 <= n <= page_count]
+
+    backs = dict(backs)
+    plan = []
+    for idx in sheets:
+        if idx + 1 in backs:
+            back = ("template", backs[idx + 1])
+        elif blank_backs:
+            back = ("blank", None)
+        else:
+            back = None
+        plan.append((("page", idx), back))
+    return tuple(plan)
+
+
+def compile_layout(layout, page_count):
+    """
+    Превращает описание раскладки в план: кортеж листов (лицо, оборот), где
+    каждый элемент — ("page", индекс), ("blank", None) или ("template", индекс),
+    а оборота может не быть (None). План для одного и того же числа страниц
+    строится один раз.
+    """
+    order = layout.get("order")
+    if isinstance(order, list):
+        order = tuple(order)
+    return _compile_layout(
+        tuple(sorted(layout.get("backs", {}).items())),
+        bool(layout.get("blank_backs")),
+        order,
+        page_count,
+    )
+
+
+def _nup_grid(nup, width, height):
+    """Размер листа и сетка (колонки, строки) для n-up при странице width x height."""
+    if nup == 2:
+        return height, width, 2, 1
+    return width, height, 2, 2
+
+
+class Imposer:
+    """
+    Раскладывает по nup логических страниц на один печатный лист (2-up — два
+    уменьшенных листа рядом на альбомном листе, 4-up — сетка 2x2). Каждая
+    логическая страница становится Form XObject, лист — коротким потоком с
+    матрицами размещения. Для двухсторонних раскладок на лицевую сторону
+    идут лица, на обратную — их обороты в зеркальном порядке колонок, чтобы
+    после переворота листа по вертикальной оси каждый оборот оказался за своим лицом.
+    """
+
+    def __init__(self, writer, nup, width, height):
+        self.writer = writer
+        self.nup = nup
+        self.sheet_w, self.sheet_h, self.cols, self.rows = _nup_grid(nup, width, height)
+
+    def add_sheet(self, cells, mirrored=False):
+        """cells — список (form_ref, bbox) или None для пустой ячейки."""
+        cell_w = self.sheet_w / self.cols
+        cell_h = self.sheet_h / self.rows
+        xobjects = DictionaryObject()
+        ops = []
+        for pos, cell in enumerate(cells):
+            if cell is None:
+                continue
+            form_ref, bbox = cell
+            row, col = divmod(pos, self.cols)
+            if mirrored:
+                col = self.cols - 1 - col
+            x0, y0, x1, y1 = (float(v) for v in bbox)
+            scale = min(cell_w / (x1 - x0), cell_h / (y1 - y0))
+            tx = col * cell_w + (cell_w - (x1 - x0) * scale) / 2 - x0 * scale
+            ty = self.sheet_h - (row + 1) * cell_h + (cell_h - (y1 - y0) * scale) / 2 - y0 * scale
+            name = f"/RailwayP{pos}"
+            xobjects[NameObject(name)] = form_ref
+            ops.append(f"q {scale:.6f} 0 0 {scale:.6f} {tx:.4f} {ty:.4f} cm {name} Do Q")
+
+        page = PageObject.create_blank_page(None, self.sheet_w, self.sheet_h)
+        content = DecodedStreamObject()
+        content.set_data(("\n".join(ops) + "\n").encode("ascii"))
+        page[NameObject("/Contents")] = self.writer._add_object(content)
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/XObject"): xobjects})
+        self.writer.add_page(page)
+
+
+def load_stamp_page(file_number):
+    """Первая страница штампа для номера накладной или None."""
+    stamp_path = find_stamp_path(file_number)
+    if not stamp_path:
+        return None
+    try:
+        stamp_page = STAMP_INDEX.get_page(stamp_path)
+        if stamp_page is not None:
+            print(f"    {Fore.MAGENTA}+ Штамп:{Style.RESET_ALL} {os.path.basename(stamp_path)}")
+        return stamp_page
+    except Exception as e:
+        print_error(f"Ошибка при чтении штампа: {e}")
+        return None
+
+
+# ----------------------------------------------------------------------
+# compose_document: фон снизу, страница, штамп сверху — за один проход
+# ----------------------------------------------------------------------
+def compose_document(input_pdf_path, instruction_path, layout=ONE_SIDED_LAYOUT,
+                     template_path=None, nup=1):
+    """
+    Возвращает PdfWriter, собранный за один проход по плану раскладки (compile_layout):
+    - для каждого листа исходного PDF:
+        1) на исходную страницу накладывается штамп (если найден) поверх содержимого
+        2) под содержимое подкладывается фон инструкции (если выбрана) — общий
+           Form XObject, который разбирается один раз (TEMPLATE_CACHE) и
+           хранится в документе в единственном экземпляре
+    - пустые обороты добавляются из одной общей пустой страницы, обороты из
+      шаблона (template_path) — страницами шаблона из TEMPLATE_CACHE
+    - при nup 2 или 4 страницы раскладываются по нескольку на печатный лист (Imposer)
+    Этот метод избегает использования merge_transformed_page и совместим со сборками PyPDF2,
+    где merge_transformed_page отсутствует.
+    """
+    [output_writer] = compose_parts(input_pdf_path, instruction_path, layout, template_path, nup)
+    return output_writer
+
+
+def file_memory_budget():
+    """Бюджет памяти на сборку одного файла в байтах (--memory-budget поровну на процессы) или None."""
+    if not SETTINGS["memory_budget_mb"]:
+        return None
+    return SETTINGS["memory_budget_mb"] * 1e6 / resolve_workers()
+
+
+def fits_memory_budget(input_pdf_path, memory_budget):
+    return not memory_budget or os.path.getsize(input_pdf_path) * MEMORY_PER_INPUT_BYTE <= memory_budget
+
+
+def release_objects(reader):
+    """
+    Сбрасывает кэш разобранных объектов PdfReader, кроме потоков объектов
+    (/ObjStm): PyPDF2 достаёт каждый упакованный объект, распаковывая весь
+    его поток, и без кэша делал бы это заново для каждого объекта.
+    """
+    resolved = reader.resolved_objects
+    keep = {
+        key: obj for key, obj in resolved.items()
+        if isinstance(obj, StreamObject) and obj.get("/Type") == "/ObjStm"
+    }
+    resolved.clear()
+    resolved.update(keep)
+
+
+def compose_parts(input_pdf_path, instruction_path, layout=ONE_SIDED_LAYOUT,
+                  template_path=None, nup=1, memory_budget=None, data=None):
+    """
+    Собирает документ так же, как compose_document, и выдаёт его частями:
+    целиком одним PdfWriter, а если файл не укладывается в memory_budget
+    байт — по нескольку листов исходника за раз. Исходник читается лениво из
+    открытого файла (PdfReader по пути сначала читает файл в память
+    целиком), а после каждой части кэш его разобранных объектов сбрасывается.
+    Части пишутся подряд в один StreamingPdfWriter (write_parts). data —
+    содержимое файла, если оно уже прочитано заранее (конвейер).
+    """
+    filename = os.path.basename(input_pdf_path)
+    file_number = extract_number_from_filename(filename)
+
+    with io.BytesIO(data) if data is not None else open(input_pdf_path, "rb") as source:
+        with stage("read"):
+            reader = PdfReader(source)
+            page_count = len(reader.pages)
+        count("pages_in", page_count)
+
+        with stage("stamp"):
+            stamp_page = load_stamp_page(file_number)
+
+        plan = compile_layout(layout, page_count)
+        part_size = len(plan) or 1
+        if not fits_memory_budget(input_pdf_path, memory_budget):
+            page_bytes = os.path.getsize(input_pdf_path) * MEMORY_PER_INPUT_BYTE / max(page_count, 1)
+            # части кратны nup, чтобы печатные листы не разрывались между частями
+            part_size = max(nup, int(memory_budget // page_bytes) // nup * nup)
+            if part_size < len(plan):
+                print_info(
+                    f"Файл {os.path.getsize(input_pdf_path) / 1e6:.1f} МБ не укладывается в бюджет памяти, "
+                    f"сборка частями по {part_size} лист."
+                )
+
+        for start in range(0, len(plan) or 1, part_size):
+            output_writer = PdfWriter()
+            with stage("compose"):
+                _compose_pages(
+                    output_writer, reader, filename, stamp_page, instruction_path,
+                    template_path, nup, plan[start:start + part_size]
+                )
+            count("pages_out", len(output_writer.pages))
+            yield output_writer
+            # часть записана — её и разобранные объекты исходника можно отпустить
+            del output_writer
+            release_objects(reader)
+            if part_size < len(plan):
+                # PdfWriter держит циклические ссылки (страницы <-> /Parent), и без
+                # сборки мусора его потоки дожили бы до случайного прохода gc
+                gc.collect()
+            sample_memory()
+
+
+def _compose_pages(output_writer, reader, filename, stamp_page, instruction_path,
+                   template_path, nup, plan):
+    """Раскладывает страницы документа в output_writer по плану (см. compose_document)."""
+
+    # фон инструкции (если выбрана) берём из кэша шаблонов; если в файле нет страниц —
+    # просто используем оригинал
+    background = None
+    if instruction_path != NO_INSTRUCTION_FLAG:
+        bg_page = TEMPLATE_CACHE.get_page(instruction_path)
+        if bg_page is not None:
+            background = BackgroundLayer(output_writer, bg_page)
+
+    template_reader = TEMPLATE_CACHE.get_reader(template_path) if template_path else None
+
+    # штамп накладывается общим Form XObject, а через merge_page — только если
+    # так его не наложить (StampLayer.needs_merge) или overlay выключен
+    stamp = None
+    if stamp_page and SETTINGS["stamp_overlay"]:
+        stamp = StampLayer(output_writer, stamp_page)
+        if stamp.needs_merge:
+            stamp = None
+    merge_stamp = stamp_page if stamp is None else None
+
+    stamped = set()
+
+    def source_page(page_idx):
+        orig_page = reader.pages[page_idx]
+        if merge_stamp and page_idx not in stamped:
+            stamped.add(page_idx)
+            try:
+                orig_page.merge_page(merge_stamp)
+            except Exception as e:
+                print_error(f"Ошибка при наложении штампа (стр. {page_idx + 1}): {e}")
+        return orig_page
+
+    if nup == 1:
+        blanks = {}
+        for entry in (e for sheet in plan for e in sheet if e is not None):
+            kind, idx = entry
+            try:
+                if kind == "page":
+                    target_page = output_writer.add_page(source_page(idx))
+                    if stamp:
+                        try:
+                            stamp.apply(target_page)
+                        except Exception as e:
+                            print_error(f"Ошибка при наложении штампа (стр. {idx + 1}): {e}")
+                    if background:
+                        try:
+                            background.apply(target_page)
+                        except Exception as e:
+                            print_error(f"Не удалось наложить страницу поверх фона (стр. {idx + 1}): {e}")
+                elif kind == "template":
+                    output_writer.add_page(template_reader.pages[idx])
+                else:
+                    # пустая страница размером с предыдущую; одна на каждый размер
+                    last = output_writer.pages[-1].mediabox if len(output_writer.pages) else None
+                    size = (last.width, last.height) if last else (595, 842)
+                    if size not in blanks:
+                        blanks[size] = PageObject.create_blank_page(None, *size)
+                    output_writer.add_page(blanks[size])
+            except Exception as e:
+                page_label = idx + 1 if kind == "page" else kind
+                print_error(f"Критическая ошибка при обработке страницы {page_label} файла {filename}: {e}")
+        return
+
+    # n-up: логические страницы превращаются в Form XObject и раскладываются по листам
+    first = background.page if background else (reader.pages[0] if reader.pages else None)
+    if first is None:
+        return
+    imposer = Imposer(output_writer, nup, float(first.mediabox.width), float(first.mediabox.height))
+    templates = {}
+
+    def cell(entry):
+        if entry is None or entry[0] == "blank":
+            return None
+        kind, idx = entry
+        try:
+            if kind == "template":
+                if idx not in templates:
+                    page = template_reader.pages[idx]
+                    templates[idx] = (page_to_form_xobject(output_writer, page), page.mediabox)
+                return templates[idx]
+            page = source_page(idx)
+            bbox = background.page.mediabox if background else page.mediabox
+            return page_to_form_xobject(output_writer, page, background, stamp), bbox
+        except Exception as e:
+            page_label = idx + 1 if kind == "page" else kind
+            print_error(f"Критическая ошибка при обработке страницы {page_label} файла {filename}: {e}")
+            return None
+
+    duplex = any(back is not None for _, back in plan)
+    if duplex:
+        for start in range(0, len(plan), nup):
+            group = plan[start:start + nup]
+            imposer.add_sheet([cell(front) for front, _ in group])
+            imposer.add_sheet([cell(back) for _, back in group], mirrored=True)
+    else:
+        fronts = [front for front, _ in plan]
+        for start in range(0, len(fronts), nup):
+            imposer.add_sheet([cell(front) for front in fronts[start:start + nup]])
+
+
+def prepare_base_pages(input_pdf_path, instruction_path):
+    """Односторонняя раскладка: фон, страница и штамп для каждого листа исходника."""
+    return compose_document(input_pdf_path, instruction_path)
+
+
+def compose_two_sided(input_path, instruction_path, template_3_6_path, nup=1):
+    """
+    Двухсторонняя накладная по DUPLEX_LAYOUT: пустые обороты у всех листов,
+    кроме 3-го и 6-го, обороты 3-го и 6-го — страницы из 3-6.pdf.
+    """
+    return compose_document(input_path, instruction_path, DUPLEX_LAYOUT, template_3_6_path, nup)
+
+
+def compose_railway_parts(input_path, instruction_path, template_3_6_path=None, data=None):
+    """Части накладной для сценариев 1/2 (compose_parts) в пределах бюджета памяти на файл."""
+    layout = DUPLEX_LAYOUT if template_3_6_path else ONE_SIDED_LAYOUT
+    return compose_parts(
+        input_path, instruction_path, layout, template_3_6_path, SETTINGS["nup"],
+        file_memory_budget(), data
+    )
+
+
+# ----------------------------------------------------------------------
+# Движки PDF: PyPDF2 (по умолчанию) и pikepdf (qpdf) — выбор через --engine
+# ----------------------------------------------------------------------
+# Итог записи пакета: сколько страниц и сколько сэкономлено дедупликацией и сжатием
+WriteStats = collections.namedtuple(
+    "WriteStats", "page_count dedup_objects dedup_bytes compress_bytes objstm_bytes saved_bytes",
+    defaults=(0, 0, 0, 0, 0),
+)
+
+
+class PyPDF2Engine:
+    """
+    Движок по умолчанию: накладная собирается compose_parts (фон и штамп —
+    BackgroundLayer/StampLayer, обороты — пустые страницы и страницы 3-6),
+    результат и пакеты пишутся StreamingPdfWriter с дедупликацией.
+    """
+
+    name = "pypdf2"
+
+    def render(self, input_path, instruction_path, template_3_6_path, stream, data=None):
+        """Собирает накладную (без template_3_6_path — одностороннюю) и пишет её в stream."""
+        parts = compose_railway_parts(input_path, instruction_path, template_3_6_path, data)
+        return write_parts(parts, stream)
+
+    def concatenate(self, paths, stream):
+        """Скрепляет файлы paths в один PDF в stream; возвращает StreamingPdfWriter с итогами."""
+        with linearized_output(stream) as target:
+            writer = StreamingPdfWriter(target)
+            for path in paths:
+                writer.add_file(path)
+            writer.close()
+        return writer
+
+
+class PikepdfEngine:
+    """
+    Движок на pikepdf (библиотека qpdf на C++): тот же план раскладки
+    (compile_layout), что и у PyPDF2Engine, но страницы копируются,
+    накладываются и пишутся qpdf. Фон инструкции, штамп и страницы 3-6
+    превращаются в Form XObject один раз и копируются в каждый документ
+    один раз. qpdf читает исходник с диска по мере надобности, поэтому
+    --memory-budget этому движку не нужен. Аннотации штампов не переносятся.
+    """
+
+    name = "pikepdf"
+
+    def __init__(self):
+        # разобранные Pdf; в memo записи — {номер страницы: Form XObject}.
+        # Шаблонов несколько, они держатся всегда; штампов тысячи — их кэш ограничен
+        self._templates = TemplateCache(parse=pikepdf.open)
+        self._stamps = TemplateCache(parse=pikepdf.open, max_bytes=STAMP_CACHE_MB * 1024 * 1024)
+
+    def open(self, path, data=None):
+        return pikepdf.open(io.BytesIO(data) if data is not None else path)
+
+    def template(self, path, stamp=False):
+        """
+        Шаблон (или штамп при stamp=True), разобранный один раз; перечитывается,
+        если файл изменился. Файл читается целиком, чтобы не держать его
+        открытым между накладными.
+        """
+        return (self._stamps if stamp else self._templates).get_reader(path)
+
+    def form(self, output, path, index=0, stamp=False):
+        """Страница index шаблона path как Form XObject в output или None, если такой страницы нет."""
+        cache = self._stamps if stamp else self._templates
+        pdf = cache.get_reader(path)
+        if index >= len(pdf.pages):
+            return None
+        forms = cache.memo(path)
+        if index not in forms:
+            forms[index] = pdf.make_indirect(pdf.pages[index].as_form_xobject())
+        # qpdf копирует объект из одного файла в другой только один раз
+        return output.copy_foreign(forms[index])
+
+    def overlay(self, page, background=None, stamp=None):
+        """
+        Штамп (Form XObject) — поверх содержимого страницы, фон — под ним,
+        оба без масштабирования; рамка страницы после фона — рамка фона.
+        Как и StampLayer, содержимое страницы не разбирается: вокруг него
+        в /Contents добавляются короткие потоки (Page.add_overlay qpdf
+        склеивал бы и пересобирал всё содержимое страницы).
+        """
+        if stamp is not None:
+            name = self._add_form(page, stamp, STAMP_XOBJECT_NAME)
+            page.contents_add(b"q\n", prepend=True)
+            page.contents_add(b"\nQ\n" + name)
+        if background is not None:
+            page.contents_add(self._add_form(page, background, BACKGROUND_XOBJECT_NAME), prepend=True)
+            for box in PAGE_GEOMETRY_KEYS:
+                if box in page.obj:
+                    del page.obj[box]
+            page.obj.MediaBox = pikepdf.Array(background.BBox)
+
+    @staticmethod
+    def _add_form(page, form, name):
+        """Добавляет форму в ресурсы страницы и возвращает операторы, рисующие её в её же рамке."""
+        name = page.add_resource(form, pikepdf.Name.XObject, pikepdf.Name(name))
+        rect = pikepdf.Rectangle(*form.BBox)
+        return page.calc_form_xobject_placement(form, name, rect, allow_shrink=False, allow_expand=False) + b"\n"
+
+    def add_page(self, output, source, index, background=None, stamp=None):
+        output.pages.append(source.pages[index])
+        page = output.pages[-1]
+        self.overlay(page, background, stamp)
+        return page
+
+    def add_blank(self, output):
+        """Пустая страница размером с предыдущую."""
+        width, height = 595, 842
+        if len(output.pages):
+            x0, y0, x1, y1 = (float(v) for v in output.pages[-1].mediabox)
+            width, height = x1 - x0, y1 - y0
+        output.add_blank_page(page_size=(width, height))
+
+    def add_template_page(self, output, path, index):
+        output.pages.append(self.template(path).pages[index])
+
+    def save(self, output, stream):
+        # без --compress потоки (сканы, шрифты) копируются как есть, как и у
+        # StreamingPdfWriter: по умолчанию qpdf сжимал бы и пережимал каждый
+        compress = SETTINGS["compress_streams"]
+        object_streams = pikepdf.ObjectStreamMode.generate if SETTINGS["object_streams"] \
+            else pikepdf.ObjectStreamMode.preserve
+        output.save(
+            stream, compress_streams=compress, recompress_flate=compress,
+            stream_decode_level=None if compress else pikepdf.StreamDecodeLevel.none,
+            object_stream_mode=object_streams, linearize=SETTINGS["linearize"],
+        )
+
+    def render(self, input_path, instruction_path, template_3_6_path, stream, data=None):
+        """Собирает накладную (без template_3_6_path — одностороннюю) и пишет её в stream."""
+        filename = os.path.basename(input_path)
+        layout = DUPLEX_LAYOUT if template_3_6_path else ONE_SIDED_LAYOUT
+        with stage("read"):
+            source = self.open(input_path, data)
+        with source, pikepdf.new() as output:
+            count("pages_in", len(source.pages))
+            with stage("stamp"):
+                stamp_path = find_stamp_path(extract_number_from_filename(filename))
+                if stamp_path:
+                    try:
+                        overlay_path = STAMP_INDEX.overlay_path(stamp_path)
+                        self.template(overlay_path, stamp=True)
+                        print(f"    {Fore.MAGENTA}+ Штамп:{Style.RESET_ALL} {os.path.basename(stamp_path)}")
+                    except Exception as e:
+                        print_error(f"Ошибка при чтении штампа: {e}")
+                        stamp_path = None
+
+            with stage("compose"):
+                background = None
+                if instruction_path != NO_INSTRUCTION_FLAG:
+                    background = self.form(output, instruction_path)
+                stamp = self.form(output, overlay_path, stamp=True) if stamp_path else None
+                plan = compile_layout(layout, len(source.pages))
+                self._compose_pages(
+                    output, source, filename, background, stamp, template_3_6_path, SETTINGS["nup"], plan
+                )
+            count("pages_out", len(output.pages))
+            with stage("write"):
+                self.save(output, stream)
+        sample_memory()
+        return 0
+
+    def _compose_pages(self, output, source, filename, background, stamp, template_path, nup, plan):
+        """Раскладывает страницы в output по плану — так же, как _compose_pages для PyPDF2."""
+
+        def report(entry, e):
+            page_label = entry[1] + 1 if entry[0] == "page" else entry[0]
+            print_error(f"Критическая ошибка при обработке страницы {page_label} файла {filename}: {e}")
+
+        if nup == 1:
+            for entry in (e for sheet in plan for e in sheet if e is not None):
+                kind, idx = entry
+                try:
+                    if kind == "page":
+                        self.add_page(output, source, idx, background, stamp)
+                    elif kind == "template":
+                        self.add_template_page(output, template_path, idx)
+                    else:
+                        self.add_blank(output)
+                except Exception as e:
+                    report(entry, e)
+            return
+
+        # n-up: логические страницы становятся Form XObject и раскладываются по листам
+        if background is not None:
+            x0, y0, x1, y1 = (float(v) for v in background.BBox)
+        elif len(source.pages):
+            x0, y0, x1, y1 = (float(v) for v in source.pages[0].mediabox)
+        else:
+            return
+        sheet_w, sheet_h, cols, rows = _nup_grid(nup, x1 - x0, y1 - y0)
+        cell_w, cell_h = sheet_w / cols, sheet_h / rows
+
+        def cell(entry):
+            if entry is None or entry[0] == "blank":
+                return None
+            try:
+                if entry[0] == "template":
+                    return self.form(output, template_path, entry[1])
+                page = self.add_page(output, source, entry[1], background, stamp)
+                form = output.make_indirect(page.as_form_xobject())
+                del output.pages[-1]
+                return form
+            except Exception as e:
+                report(entry, e)
+                return None
+
+        def add_sheet(forms, mirrored=False):
+            sheet = output.add_blank_page(page_size=(sheet_w, sheet_h))
+            for pos, form in enumerate(forms):
+                if form is None:
+                    continue
+                row, col = divmod(pos, cols)
+                if mirrored:
+                    col = cols - 1 - col
+                top = sheet_h - row * cell_h
+                # qpdf вписывает форму в ячейку с сохранением пропорций и по центру, как Imposer
+                sheet.add_overlay(form, pikepdf.Rectangle(col * cell_w, top - cell_h, (col + 1) * cell_w, top))
+
+        if any(back is not None for _, back in plan):
+            for start in range(0, len(plan), nup):
+                group = plan[start:start + nup]
+                add_sheet([cell(front) for front, _ in group])
+                add_sheet([cell(back) for _, back in group], mirrored=True)
+        else:
+            fronts = [front for front, _ in plan]
+            for start in range(0, len(fronts), nup):
+                add_sheet([cell(front) for front in fronts[start:start + nup]])
+
+    def concatenate(self, paths, stream):
+        """Скрепляет файлы paths в один PDF в stream; возвращает WriteStats."""
+        with contextlib.ExitStack() as sources, pikepdf.new() as output:
+            for path in paths:
+                # qpdf дочитывает страницы при сохранении, поэтому исходники открыты до конца записи
+                output.pages.extend(sources.enter_context(pikepdf.open(path)).pages)
+            self.save(output, stream)
+            return WriteStats(len(output.pages))
+
+
+PDF_ENGINES = {PyPDF2Engine.name: PyPDF2Engine, PikepdfEngine.name: PikepdfEngine}
+_engines = {}
+
+
+def engine_available(name):
+    return name == PyPDF2Engine.name or (name == PikepdfEngine.name and pikepdf is not None)
+
+
+def get_engine(name=None):
+    """Движок PDF из SETTINGS["pdf_engine"] (или name); один экземпляр на процесс — с его кэшами."""
+    name = name or SETTINGS["pdf_engine"]
+    if name not in _engines:
+        if not engine_available(name):
+            raise RuntimeError(f"движок '{name}' недоступен: pip install {name}")
+        _engines[name] = PDF_ENGINES[name]()
+    return _engines[name]
+
+
+# ----------------------------------------------------------------------
+# Кэш результатов: те же исходные данные — готовая накладная без пересборки
+# ----------------------------------------------------------------------
+CACHE_FORMAT = b"railway-cache-1"  # меняется вместе с раскладкой страниц, чтобы старые результаты не выдавались
+CACHE_STATS_FILENAME = "stats.json"
+# настройки, от которых зависит результат, — часть ключа
+CACHE_KEY_SETTINGS = (
+    "nup", "pdf_engine", "stamp_overlay", "dedup", "compress_streams", "object_streams", "linearize",
+    "stamp_dpi", "stamp_format", "stamp_gray",
+)
+
+# хеши шаблонов и штампов: (путь, mtime, размер) -> sha256
+_static_digests = {}
+
+
+def file_digest(path):
+    """SHA-256 содержимого файла (шестнадцатеричный)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def static_digest(path):
+    """file_digest для инструкций, 3-6.pdf и штампов: пока файл не менялся, читается один раз."""
+    st = os.stat(path)
+    memo_key = (path, st.st_mtime_ns, st.st_size)
+    if memo_key not in _static_digests:
+        _static_digests[memo_key] = file_digest(path)
+    return _static_digests[memo_key]
+
+
+class DerivationCache:
+    """
+    Готовые накладные в папке Cache под ключом — хешем всего, от чего зависит
+    результат: содержимого исходника, штампа, инструкции и 3-6.pdf (если они
+    участвуют), сценария и настроек сборки. Смена инструкции меняет ключи
+    только у накладных с этой инструкцией. Файлы вытесняются по давности
+    использования (mtime обновляется при каждом попадании), когда их
+    суммарный размер превышает предел. Запись — через временный файл и
+    os.replace, поэтому процессы пула не мешают друг другу.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def key(self, filename, input_path, instruction_path, template_3_6_path=None, data=None):
+        h = hashlib.sha256(CACHE_FORMAT)
+        source_digest = hashlib.sha256(data).hexdigest() if data is not None else file_digest(input_path)
+        h.update(source_digest.encode())
+        if instruction_path == NO_INSTRUCTION_FLAG:
+            instruction_path = None
+        stamp_path = find_stamp_path(extract_number_from_filename(filename))
+        for path in (stamp_path, instruction_path, template_3_6_path):
+            h.update(b"|" + (static_digest(path).encode() if path else b"-"))
+        scenario = SCENARIO_TWO_SIDED if template_3_6_path else SCENARIO_ONE_SIDED
+        settings = {name: SETTINGS[name] for name in CACHE_KEY_SETTINGS}
+        h.update(json.dumps([scenario, settings], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".pdf")
+
+    def open(self, key):
+        """Открытый на чтение готовый результат или None, если его нет."""
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return f
+
+    def store(self, key, pdf):
+        """Кладёт результат в кэш: pdf — байты или путь к готовому файлу."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=PARTIAL_SUFFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(pdf, bytes):
+                    f.write(pdf)
+                else:
+                    with open(pdf, "rb") as source:
+                        shutil.copyfileobj(source, f, 1 << 20)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def entries(self):
+        """(mtime, размер, путь) всех результатов в кэше."""
+        found = []
+        if not os.path.isdir(self.folder):
+            return found
+        for entry in os.scandir(self.folder):
+            if not entry.is_dir():
+                continue
+            for item in os.scandir(entry.path):
+                if item.name.endswith(".pdf"):
+                    with contextlib.suppress(FileNotFoundError):
+                        st = item.stat()
+                        found.append((st.st_mtime, st.st_size, item.path))
+        return found
+
+    def evict(self, limit_bytes):
+        """Удаляет давно не использованные результаты, пока кэш больше limit_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = removed_bytes = 0
+        for _, size, path in entries:
+            if total <= limit_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # файл занят (Windows) или уже удалён другим процессом
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
+
+    def stats(self):
+        path = os.path.join(self.folder, CACHE_STATS_FILENAME)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, **counters):
+        """Добавляет счётчики пакета к накопленной статистике (stats.json)."""
+        stats = self.stats()
+        for name, value in counters.items():
+            stats[name] = stats.get(name, 0) + value
+        os.makedirs(self.folder, exist_ok=True)
+        with atomic_output(os.path.join(self.folder, CACHE_STATS_FILENAME)) as f:
+            f.write(json.dumps(stats, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+def derivation_cache():
+    """Кэш результатов текущей рабочей папки или None, если он выключен."""
+    return DerivationCache(DIR_CACHE) if SETTINGS["cache_size_mb"] > 0 else None
+
+
+def print_cache_stats():
+    cache = DerivationCache(DIR_CACHE)
+    stats = cache.stats()
+    entries = cache.entries()
+    size = sum(size for _, size, _ in entries)
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    limit = SETTINGS["cache_size_mb"]
+    print_step(f"Кэш результатов: {DIR_CACHE}")
+    print_info(
+        f"Файлов: {len(entries)}, занято {size / 1e6:.1f} МБ"
+        + (f" из {limit:g} МБ" if limit > 0 else " (кэш выключен, включается --cache МБ)")
+    )
+    if hits + misses:
+        print_info(f"Попаданий: {hits} из {hits + misses} ({hits / (hits + misses):.0%}), промахов: {misses}")
+    else:
+        print_info("Обращений к кэшу ещё не было.")
+    print_info(f"Выдано готовыми: {stats.get('bytes_saved', 0) / 1e6:.1f} МБ")
+    if stats.get("evicted"):
+        print_info(f"Вытеснено: {stats['evicted']} файл., {stats.get('evicted_bytes', 0) / 1e6:.1f} МБ")
+
+
+def process_railway_file(filename, instruction_path, template_3_6_path=None):
+    """
+    Обрабатывает одну накладную из Railway: пишет результат в Ready и
+    переносит исходник в Railway/Done. Без template_3_6_path — односторонняя.
+    """
+    render_railway_file(filename, instruction_path, template_3_6_path)
+    store_railway_file(filename)
+
+
+def render_railway_file(filename, instruction_path, template_3_6_path=None, data=None):
+    """
+    Сборка накладной — первая половина process_railway_file. Если исходник
+    уже прочитан в память (data, конвейер), результат возвращается байтами
+    для store_railway_file; иначе пишется сразу в Ready и возвращается None.
+    """
+    input_path = os.path.join(DIR_RAILWAY, filename)
+    output_path = os.path.join(DIR_READY, filename)
+
+    print(f"Обработка: {filename}...")
+    stamp_path = find_stamp_path(extract_number_from_filename(filename))
+    note("instruction", describe_instruction(instruction_path))
+    note("stamp", os.path.basename(stamp_path) if stamp_path else None)
+    JOURNAL.record(
+        "file", filename, "started",
+        inputs=[input_path], output=output_path, done_folder=DIR_RAILWAY_DONE
+    )
+    cache = derivation_cache()
+    key = None
+    if cache:
+        with stage("cache"):
+            key = cache.key(filename, input_path, instruction_path, template_3_6_path, data)
+            cached = cache.open(key)
+        if cached is not None:
+            with cached:
+                print(f"    {Fore.MAGENTA}+ Из кэша:{Style.RESET_ALL} исходные данные не менялись")
+                count("cache_hits")
+                count("bytes_cached", os.fstat(cached.fileno()).st_size)
+                if data is not None:
+                    return cached.read()
+                with stage("write"), atomic_output(output_path) as f:
+                    shutil.copyfileobj(cached, f, 1 << 20)
+            return None
+        count("cache_misses")
+
+    engine = get_engine()
+    if data is None:
+        with atomic_output(output_path) as f:
+            engine.render(input_path, instruction_path, template_3_6_path, f)
+        if key:
+            with stage("cache"):
+                cache.store(key, output_path)
+        return None
+    buffer = io.BytesIO()
+    engine.render(input_path, instruction_path, template_3_6_path, buffer, data)
+    if key:
+        with stage("cache"):
+            cache.store(key, buffer.getvalue())
+    return buffer.getvalue()
+
+
+def store_railway_file(filename, pdf=None):
+    """
+    Вторая половина process_railway_file: записывает собранный в памяти
+    результат (pdf) в Ready и переносит исходник в Railway/Done.
+    """
+    input_path = os.path.join(DIR_RAILWAY, filename)
+    output_path = os.path.join(DIR_READY, filename)
+    if pdf is not None:
+        with stage("write"), atomic_output(output_path) as f:
+            f.write(pdf)
+    JOURNAL.record("file", filename, "written")
+    count("bytes_in", os.path.getsize(input_path))
+    count("bytes_out", os.path.getsize(output_path))
+
+    print_success(f"Готово -> {DIR_READY}")
+    with stage("move"):
+        moved = move_file_to_done(input_path, DIR_RAILWAY_DONE)
+    if moved:
+        JOURNAL.record("file", filename, "done")
+
+
+# ошибки ввода-вывода, которые проходят сами: сетевая папка, файл занят антивирусом и т. п.
+TRANSIENT_ERRNOS = {
+    errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EACCES, errno.ETIMEDOUT,
+    getattr(errno, "ESTALE", errno.EIO),
+}
+
+
+def is_transient_error(e):
+    """Стоит ли повторить задачу после ошибки e (см. run_guarded)."""
+    if isinstance(e, (TimeoutError, ConnectionError, InterruptedError)):
+        return True
+    return isinstance(e, OSError) and e.errno in TRANSIENT_ERRNOS
+
+
+def _task_result(ok, metrics, buffer, **extra):
+    """
+    Результат задачи пакетного запуска для run_batch: успех, пропуск (файл
+    взят другим обработчиком), вывод (buffer — при capture, иначе None) и метрики.
+    """
+    return {
+        "ok": ok,
+        "skipped": bool(metrics.counters.get("skipped")),
+        "log": buffer.getvalue() if buffer is not None else "",
+        "metrics": metrics.as_dict(),
+        **extra,
+    }
+
+
+def _railway_task(filename, instruction_path, template_3_6_path, capture=False):
+    """
+    Обёртка над process_railway_file для пакетного запуска. При capture=True
+    весь вывод собирается в строку, чтобы печатать его целиком, без
+    перемешивания со строками других процессов.
+    """
+    buffer = io.StringIO() if capture else None
+    ok = False
+    transient = False
+    metrics = FileMetrics(filename)
+    with contextlib.redirect_stdout(buffer) if capture else contextlib.nullcontext(), \
+            track_metrics(metrics), profile_task(metrics):
+        try:
+            with claimed([os.path.join(DIR_RAILWAY, filename)], filename) as mine:
+                if mine:
+                    process_railway_file(filename, instruction_path, template_3_6_path)
+                else:
+                    metrics.count("skipped")
+            ok = True
+        except Exception as e:
+            metrics.count("errors")
+            transient = is_transient_error(e)
+            print_error(f"Ошибка с файлом {filename}: {e}")
+    return _task_result(ok, metrics, buffer, filename=filename, transient=transient)
+
+
+# ----------------------------------------------------------------------
+# Конвейер: чтение следующих накладных, сборка и запись — одновременно
+# ----------------------------------------------------------------------
+class ThreadOutput:
+    """
+    Замена sys.stdout на время работы конвейера: вывод потока, которому
+    назначен буфер (capture), собирается в этот буфер, остальной печатается
+    как обычно. Так вывод по каждому файлу печатается целиком, как из пула.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self._local, "buffer", None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        previous = getattr(self._local, "buffer", None)
+        self._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = previous
+
+
+def _prefetch_railway_file(job):
+    """
+    Берёт заявку на накладную (при --claims), читает её в память (если она
+    укладывается в бюджет) и заранее — её штамп.
+    """
+    input_path = os.path.join(DIR_RAILWAY, job["filename"])
+    claims = file_claims()
+    if claims:
+        if not claims.acquire([input_path]):
+            print_info(f"Пропуск: {job['filename']} — уже взят другим обработчиком")
+            job["skipped"] = True
+            job["metrics"].count("skipped")
+            return
+        job["claimed"] = [input_path]
+    with stage("read"):
+        if fits_memory_budget(input_path, file_memory_budget()):
+            with open(input_path, "rb") as f:
+                job["data"] = f.read()
+        stamp_path = find_stamp_path(extract_number_from_filename(job["filename"]))
+        if stamp_path:
+            STAMP_INDEX.preload(stamp_path)
+
+
+def _render_railway_job(job):
+    job["pdf"] = render_railway_file(
+        job["filename"], job["instruction_path"], job["template_3_6_path"], job.pop("data", None)
+    )
+
+
+def _store_railway_job(job):
+    store_railway_file(job["filename"], job.pop("pdf", None))
+
+
+def run_railway_pipeline(tasks, depth=None):
+    """
+    Обрабатывает задачи run_railway_batch конвейером из трёх этапов, каждый
+    в своём потоке: чтение следующих накладных и их штампов, сборка текущей,
+    запись и перенос в Done готовых. Пока одна накладная собирается, следующие
+    читаются с диска, а предыдущие записываются — задержки сетевого диска
+    перекрываются работой процессора. Очереди между этапами (asyncio.Queue)
+    ограничены depth, поэтому вперёд читается не больше depth файлов.
+    Результаты отдаются в порядке tasks в том же виде, что у _railway_task.
+    """
+    depth = SETTINGS["pipeline_depth"] if depth is None else depth
+    loop = asyncio.new_event_loop()
+    output = ThreadOutput(sys.stdout)
+    executors = [ThreadPoolExecutor(1, f"railway-{name}") for name in ("read", "compose", "write")]
+
+    def run_stage(job, func):
+        if job["error"] is not None or job.get("skipped"):
+            return
+        with output.capture(job["log"]), track_metrics(job["metrics"]):
+            try:
+                func(job)
+            except Exception as e:
+                job["error"] = e
+                job["metrics"].count("errors")
+                print_error(f"Ошибка с файлом {job['filename']}: {e}")
+
+    async def read_stage(target):
+        try:
+            for filename, instruction_path, template_3_6_path in tasks:
+                job = {
+                    "filename": filename,
+                    "instruction_path": instruction_path,
+                    "template_3_6_path": template_3_6_path,
+                    "log": io.StringIO(),
+                    "metrics": FileMetrics(filename),
+                    "error": None,
+                }
+                await loop.run_in_executor(executors[0], run_stage, job, _prefetch_railway_file)
+                await target.put(job)
+        finally:
+            await target.put(None)
+
+    async def next_stage(source, target, executor, func):
+        try:
+            while True:
+                job = await source.get()
+                if job is None:
+                    break
+                await loop.run_in_executor(executor, run_stage, job, func)
+                await target.put(job)
+        finally:
+            await target.put(None)
+
+    async def start():
+        prefetched, rendered, finished = asyncio.Queue(depth), asyncio.Queue(depth), asyncio.Queue()
+        stages = [
+            asyncio.ensure_future(read_stage(prefetched)),
+            asyncio.ensure_future(next_stage(prefetched, rendered, executors[1], _render_railway_job)),
+            asyncio.ensure_future(next_stage(rendered, finished, executors[2], _store_railway_job)),
+        ]
+        return stages, finished
+
+    sys.stdout = output
+    stages, finished = loop.run_until_complete(start())
+    try:
+        while True:
+            job = loop.run_until_complete(finished.get())
+            if job is None:
+                break
+            if job.get("claimed"):
+                file_claims().release(job["claimed"])
+            yield {
+                "filename": job["filename"],
+                "ok": job["error"] is None,
+                "skipped": job.get("skipped", False),
+                "log": job["log"].getvalue(),
+                "metrics": job["metrics"].as_dict(),
+            }
+        for task in stages:
+            if task.done() and task.exception():
+                raise task.exception()
+    finally:
+        sys.stdout = output.stream
+        for task in stages:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*stages, return_exceptions=True))
+        for executor in executors:
+            executor.shutdown(wait=True)
+        loop.close()
+
+
+# ----------------------------------------------------------------------
+# Маршруты инструкций: своя инструкция для каждой накладной
+# ----------------------------------------------------------------------
+def find_instruction(value):
+    """Путь к инструкции (имя в Template или путь), NO_INSTRUCTION_FLAG для 'none' или None."""
+    if value.lower() == "none":
+        return NO_INSTRUCTION_FLAG
+    for candidate in (value, os.path.join(DIR_TEMPLATE, value)):
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+    return None
+
+
+class InstructionRoutes:
+    """
+    Таблица маршрутов (CSV, разделитель ";" или ","): в строке правило и
+    инструкция — имя файла в Template, путь или none. Правила:
+        1234       — накладная с этим номером;
+        1000-1999  — номер в диапазоне, включительно;
+        KZ*        — имя файла начинается с KZ (без учёта регистра);
+        *          — все остальные.
+    Точный номер важнее остальных правил, диапазоны и префиксы проверяются
+    в порядке строк, "*" — последним. Накладная без подходящего правила
+    получает инструкцию, выбранную для всего запуска. Строки с # — комментарии.
+    """
+
+    HEADERS = ("правило", "rule", "номер", "number")
+
+    def __init__(self, path):
+        self.path = path
+        self.numbers = {}
+        self.rules = []  # (проверка(номер, имя файла), инструкция) в порядке строк
+        self.default = None
+        self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8-sig", newline="") as f:
+            text = f.read()
+        first_line = next((line for line in text.splitlines() if line.strip()), "")
+        delimiter = ";" if ";" in first_line else ","
+        name = os.path.basename(self.path)
+
+        for line_no, row in enumerate(csv.reader(io.StringIO(text), delimiter=delimiter), 1):
+            cells = [cell.strip() for cell in row]
+            if not cells or not cells[0] or cells[0].startswith("#"):
+                continue
+            rule = cells[0]
+            if rule.lower() in self.HEADERS:
+                continue
+            if len(cells) < 2 or not cells[1]:
+                raise ValueError(f"{name}, строка {line_no}: нужны правило и инструкция")
+            instruction = find_instruction(cells[1])
+            if instruction is None:
+                raise ValueError(f"{name}, строка {line_no}: инструкция '{cells[1]}' не найдена")
+
+            bounds = re.fullmatch(r"(\d+)\s*-\s*(\d+)", rule)
+            if rule == "*":
+                self.default = instruction
+            elif rule.isdigit():
+                number = int(rule)
+                if self.numbers.get(number, instruction) != instruction:
+                    raise ValueError(f"{name}, строка {line_no}: номеру {number} уже назначена другая инструкция")
+                self.numbers[number] = instruction
+            elif bounds:
+                low, high = int(bounds.group(1)), int(bounds.group(2))
+                self.rules.append((
+                    lambda number, filename, low=low, high=high:
+                        number is not None and low <= number <= high,
+                    instruction,
+                ))
+            elif rule.endswith("*"):
+                prefix = rule[:-1].lower()
+                self.rules.append((lambda number, filename, prefix=prefix: filename.lower().startswith(prefix),
+                                   instruction))
+            else:
+                raise ValueError(f"{name}, строка {line_no}: непонятное правило '{rule}'")
+
+    def __len__(self):
+        return len(self.numbers) + len(self.rules) + (self.default is not None)
+
+    def route(self, filename, default=None):
+        """Инструкция для накладной filename; default — если ни одно правило не подошло."""
+        number = extract_number_from_filename(filename)
+        if number in self.numbers:
+            return self.numbers[number]
+        for matches, instruction in self.rules:
+            if matches(number, filename):
+                return instruction
+        return self.default if self.default is not None else default
+
+
+# разобранные таблицы: путь -> (mtime, размер, InstructionRoutes)
+_routes_cache = {}
+
+
+def current_routes():
+    """
+    Таблица маршрутов рабочей папки (--routes или Template/routes.csv) или
+    None, если её нет. Разбирается заново, только когда файл изменился;
+    ошибка в таблице — ValueError с номером строки.
+    """
+    path = SETTINGS["routes_path"] or os.path.join(DIR_TEMPLATE, ROUTES_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    cached = _routes_cache.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    routes = InstructionRoutes(path)
+    _routes_cache[path] = (stat.st_mtime_ns, stat.st_size, routes)
+    return routes
+
+
+def route_instruction(filename, instruction_path):
+    """Инструкция для накладной по таблице маршрутов; без таблицы — instruction_path."""
+    routes = current_routes()
+    return routes.route(filename, instruction_path) if routes else instruction_path
+
+
+def describe_instruction(instruction_path):
+    if instruction_path == NO_INSTRUCTION_FLAG:
+        return "без инструкций"
+    return os.path.basename(instruction_path)
+
+
+def print_routes(instructions):
+    """
+    Сводка маршрутов пакета (сколько накладных с какой инструкцией) и разбор
+    каждой инструкции заранее — в этом процессе, до запуска пула, чтобы
+    процессы получили шаблоны уже разобранными.
+    """
+    counts = collections.Counter(instructions)
+    print_info("Инструкции по маршрутам: " + ", ".join(
+        f"{describe_instruction(path)} — {n}" for path, n in counts.most_common()
+    ))
+    for path in counts:
+        if path != NO_INSTRUCTION_FLAG:
+            try:
+                TEMPLATE_CACHE.get_reader(path)
+            except Exception as e:
+                print_error(f"Ошибка при чтении '{path}': {e}")
+
+
+# ----------------------------------------------------------------------
+# Параллельная обработка пакета
+# ----------------------------------------------------------------------
+def resolve_workers(workers=None):
+    workers = SETTINGS["workers"] if workers is None else workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def _init_worker(settings):
+    # при запуске через spawn (Windows) модуль импортируется заново,
+    # поэтому настройки родительского процесса передаются явно
+    SETTINGS.update(settings)
+    if DIR_RAILWAY != os.path.join(settings["base_dir"], "Railway"):
+        configure_paths(settings["base_dir"])
+
+
+def run_in_pool(func, tasks, workers, schedule_key=None, error_log=None):
+    """
+    Выполняет func(*args, capture=True) для каждого args из tasks в пуле
+    процессов и по мере готовности отдаёт результаты строго в порядке tasks.
+    schedule_key задаёт порядок запуска (по убыванию), error_log(args, e)
+    строит строку вывода, если процесс упал, не вернув результат.
+    """
+    schedule = sorted(range(len(tasks)), key=lambda i: schedule_key(tasks[i]), reverse=True) \
+        if schedule_key else range(len(tasks))
+    finished = {}
+    next_idx = 0
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(dict(SETTINGS),)
+    ) as pool:
+        futures = {pool.submit(func, *tasks[i], capture=True): i for i in schedule}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                finished[idx] = future.result()
+            except Exception as e:
+                log = error_log(tasks[idx], e) if error_log else f"{Fore.RED}❌ {e}{Style.RESET_ALL}\n"
+                finished[idx] = {"ok": False, "log": log}
+
+            while next_idx in finished:
+                yield finished.pop(next_idx)
+                next_idx += 1
+
+
+# ----------------------------------------------------------------------
+# Сторож: предел времени и памяти на одну накладную
+# ----------------------------------------------------------------------
+WATCHDOG_POLL = 0.2  # как часто сторож проверяет процессы-исполнители, с
+RETRY_DELAY = 1.0  # пауза перед повтором после временного сбоя, с; растёт с каждой попыткой
+
+
+def guard_enabled():
+    return SETTINGS["file_timeout"] > 0 or SETTINGS["file_memory_mb"] > 0
+
+
+def _guarded_worker(conn, func, settings):
+    """Цикл процесса-исполнителя: берёт задачи из conn по одной, пока не придёт None."""
+    _init_worker(settings)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        idx, args = message
+        conn.send((idx, func(*args, capture=True)))
+
+
+class GuardedWorker:
+    """Процесс-исполнитель run_guarded и замеры сторожа по его текущей задаче."""
+
+    def __init__(self, context, func):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_guarded_worker, args=(child_conn, func, dict(SETTINGS)), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+        self.peak_rss = None
+
+    def submit(self, idx, args):
+        self.conn.send((idx, args))
+        self.task, self.started, self.peak_rss = idx, time.monotonic(), None
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def check(self, timeout, memory_limit):
+        """Причина остановить процесс или None, если задача укладывается в пределы."""
+        if timeout and self.elapsed() > timeout:
+            return f"превышено время: {self.elapsed():.0f} с при пределе {timeout:g} с"
+        rss = current_rss(self.process.pid)
+        if rss is None:
+            return None
+        self.peak_rss = max(self.peak_rss or 0, rss)
+        if memory_limit and rss > memory_limit:
+            return f"превышена память: {rss / 1e6:.0f} МБ при пределе {memory_limit / 1e6:.0f} МБ"
+        return None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        with contextlib.suppress(OSError):
+            self.conn.send(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def run_guarded(func, tasks, workers, schedule_key=None, quarantine=None):
+    """
+    То же, что run_in_pool, но под сторожем: процесс-исполнитель берёт по
+    одной задаче, а родитель раз в WATCHDOG_POLL проверяет, сколько она идёт
+    и сколько памяти занял процесс (SETTINGS file_timeout, file_memory_mb).
+    Процесс, вышедший за предел, убивается и заменяется новым, а задача
+    отдаётся quarantine(args, reason, details), которая возвращает строку
+    вывода; остальные задачи идут дальше. Временные сбои (is_transient_error)
+    и аварийное завершение процесса повторяются до SETTINGS["file_retries"]
+    раз с растущей паузой.
+    """
+    timeout = SETTINGS["file_timeout"]
+    memory_limit = SETTINGS["file_memory_mb"] * 1e6
+    retries = SETTINGS["file_retries"]
+    schedule = sorted(range(len(tasks)), key=lambda i: schedule_key(tasks[i]), reverse=True) \
+        if schedule_key else range(len(tasks))
+    pending = collections.deque(schedule)
+    not_before = {}  # задача -> момент, раньше которого её не повторять
+    attempts = collections.Counter()
+    notes = collections.defaultdict(str)  # вывод неудачных попыток — печатается вместе с итогом
+    finished = {}
+    next_idx = 0
+
+    def take_task():
+        now = time.monotonic()
+        for idx in pending:
+            if not_before.get(idx, 0) <= now:
+                pending.remove(idx)
+                return idx
+        return None
+
+    def retry(idx, log):
+        """Возвращает задачу в очередь, если попытки ещё остались."""
+        attempts[idx] += 1
+        if attempts[idx] > retries:
+            return False
+        delay = RETRY_DELAY * attempts[idx]
+        notes[idx] += log + (
+            f"{Fore.YELLOW}↻ Повтор {attempts[idx]} из {retries} через {delay:g} с{Style.RESET_ALL}\n"
+        )
+        not_before[idx] = time.monotonic() + delay
+        pending.append(idx)
+        return True
+
+    def give_up(idx, reason, worker):
+        name = str(tasks[idx][0])
+        details = {"attempts": attempts[idx], "elapsed_s": round(worker.elapsed(), 1)}
+        metrics = {
+            "kind": "file", "name": name, "total_s": details["elapsed_s"],
+            "counters": {"errors": 1, "quarantined": 1},
+        }
+        if worker.peak_rss:
+            details["peak_mb"] = round(worker.peak_rss / 1e6, 1)
+            metrics["memory_mb"] = {"peak": details["peak_mb"]}
+        log = quarantine(tasks[idx], reason, details) if quarantine \
+            else f"{Fore.RED}❌ {name}: {reason}{Style.RESET_ALL}\n"
+        finished[idx] = {"ok": False, "log": notes.pop(idx, "") + log, "metrics": metrics}
+
+    context = multiprocessing.get_context()
+    pool = [GuardedWorker(context, func) for _ in range(workers)]
+    try:
+        while next_idx < len(tasks):
+            for worker in pool:
+                if worker.task is None:
+                    idx = take_task()
+                    if idx is None:
+                        break
+                    worker.submit(idx, tasks[idx])
+
+            busy = {worker.conn: worker for worker in pool if worker.task is not None}
+            if busy:
+                ready = multiprocessing.connection.wait(list(busy), timeout=WATCHDOG_POLL)
+            else:
+                # в очереди только задачи, ждущие повтора
+                time.sleep(WATCHDOG_POLL)
+                ready = []
+
+            for conn in ready:
+                worker = busy[conn]
+                idx = worker.task
+                try:
+                    _, result = conn.recv()
+                except (EOFError, OSError):
+                    worker.process.join(timeout=1)
+                    reason = f"процесс-исполнитель завершился аварийно (код {worker.process.exitcode})"
+                    pool[pool.index(worker)] = GuardedWorker(context, func)
+                    worker.conn.close()
+                    warning = f"{Fore.YELLOW}⚠ {tasks[idx][0]}: {reason}{Style.RESET_ALL}\n"
+                    if not retry(idx, warning):
+                        give_up(idx, reason, worker)
+                    continue
+                worker.task = None
+                if not result["ok"] and result.get("transient") and retry(idx, result["log"]):
+                    continue
+                finished[idx] = dict(result, log=notes.pop(idx, "") + result["log"])
+
+            for i, worker in enumerate(pool):
+                # ответ, пришедший после wait, заберём на следующем круге
+                if worker.task is None or worker.conn.poll():
+                    continue
+                reason = worker.check(timeout, memory_limit)
+                if reason:
+                    idx = worker.task
+                    worker.kill()
+                    pool[i] = GuardedWorker(context, func)
+                    attempts[idx] += 1
+                    give_up(idx, reason, worker)
+
+            while next_idx in finished:
+                yield finished.pop(next_idx)
+                next_idx += 1
+    finally:
+        for worker in pool:
+            worker.stop()
+
+
+# Итоги всех пакетов с момента последнего сброса — по ним сервер решает, успешно ли задание
+BATCH_TOTALS = collections.Counter()
+
+
+def run_batch(func, tasks, workers, scenario, unit="файл", schedule_key=None, error_log=None,
+              runner=None):
+    """
+    Выполняет func(*args) для каждой задачи — своим способом (runner(tasks),
+    если задан: конвейер или сторож), последовательно или в пуле процессов
+    (run_in_pool) — печатает вывод, живую скорость и итог по этапам, пишет
+    трассировку. Возвращает число успешных задач.
+    """
+    progress = BatchProgress(len(tasks), unit)
+    history = open_history(scenario, len(tasks), workers)
+    claims = file_claims()
+    if claims:
+        for folder in (DIR_RAILWAY, DIR_READY):
+            claims.sweep(folder)
+    if runner is not None:
+        results = runner(tasks)
+    elif workers <= 1:
+        results = (func(*task) for task in tasks)
+    else:
+        results = run_in_pool(func, tasks, workers, schedule_key, error_log)
+
+    succeeded = 0
+    skipped = 0
+    for result in results:
+        print(result["log"], end="")
+        metrics = result.get("metrics") or {"counters": {"errors": 1}}
+        progress.update(metrics)
+        write_trace(metrics, scenario)
+        if history:
+            history.add(result, metrics)
+        if result.get("skipped"):
+            skipped += 1
+        elif result["ok"]:
+            succeeded += 1
+    progress.summary()
+    if history:
+        history.finish(progress, succeeded, skipped)
+    cache = derivation_cache()
+    if cache and (progress.cache_hits or progress.cache_misses):
+        evicted, evicted_bytes = cache.evict(SETTINGS["cache_size_mb"] * 1e6)
+        cache.record(
+            hits=progress.cache_hits, misses=progress.cache_misses,
+            bytes_saved=progress.bytes_cached, evicted=evicted, evicted_bytes=evicted_bytes
+        )
+    BATCH_TOTALS["tasks"] += len(tasks)
+    BATCH_TOTALS["failed"] += len(tasks) - succeeded - skipped
+    return succeeded
+
+
+def run_railway_batch(files, instruction_path, template_3_6_path=None, workers=None):
+    """
+    Обрабатывает список файлов из Railway и возвращает число успешных.
+    При workers > 1 файлы раздаются пулу процессов, самые крупные — первыми,
+    чтобы длинные задачи не оказались в хвосте; в одном процессе — конвейером
+    (run_railway_pipeline), если он не отключён. С пределами на файл
+    (--file-timeout, --file-memory) каждый файл собирается в отдельном
+    процессе под сторожем (run_guarded), а зависшие и упавшие накладные
+    уходят в Railway/Quarantine. Вывод по каждому файлу печатается целиком и
+    в исходном порядке списка files. Если есть таблица маршрутов
+    (current_routes), инструкция выбирается для каждого файла по ней, а
+    instruction_path достаётся файлам без подходящего правила.
+    """
+    try:
+        instructions = [route_instruction(f, instruction_path) for f in files]
+    except ValueError as e:
+        print_error(f"Таблица маршрутов: {e}")
+        return 0
+    if current_routes():
+        print_routes(instructions)
+
+    workers = min(resolve_workers(workers), len(files))
+    if guard_enabled():
+        limits = []
+        if SETTINGS["file_timeout"] > 0:
+            limits.append(f"{SETTINGS['file_timeout']:g} с")
+        if SETTINGS["file_memory_mb"] > 0:
+            limits.append(f"{SETTINGS['file_memory_mb']:g} МБ")
+            if current_rss() is None:
+                print_error("Память процессов здесь не измерить (нужен Linux) — предел памяти не действует.")
+        print_info(f"Под сторожем: не более {' и '.join(limits)} на файл, процессов: {workers}")
+    elif workers > 1:
+        print_info(f"Параллельная обработка, процессов: {workers}")
+
+    def file_size(task):
+        try:
+            return os.path.getsize(os.path.join(DIR_RAILWAY, task[0]))
+        except OSError:
+            return 0
+
+    def error_log(task, e):
+        return f"{Fore.RED}❌ Ошибка с файлом {task[0]}: {e}{Style.RESET_ALL}\n"
+
+    scenario = SCENARIO_TWO_SIDED if template_3_6_path else SCENARIO_ONE_SIDED
+    tasks = [(f, instruction, template_3_6_path) for f, instruction in zip(files, instructions)]
+    runner = None
+    if guard_enabled():
+        runner = functools.partial(
+            run_guarded, _railway_task, workers=workers, schedule_key=file_size,
+            quarantine=quarantine_railway_file
+        )
+    elif workers <= 1 and SETTINGS["pipeline_depth"] > 0 and len(files) > 1:
+        runner = run_railway_pipeline
+    return run_batch(_railway_task, tasks, workers, scenario, "файл", file_size, error_log, runner)
+
+
+def quarantine_railway_file(task, reason, details):
+    """
+    Переносит накладную, остановленную сторожем, из Railway в Railway/Quarantine
+    и кладёт рядом <имя>.txt с причиной; недописанный результат в Ready
+    удаляется. Возвращает строку вывода для run_guarded.
+    """
+    filename = task[0]
+    input_path = os.path.join(DIR_RAILWAY, filename)
+    partial_path = os.path.join(DIR_READY, filename) + PARTIAL_SUFFIX
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    os.makedirs(DIR_RAILWAY_QUARANTINE, exist_ok=True)
+    try:
+        shutil.move(input_path, os.path.join(DIR_RAILWAY_QUARANTINE, filename))
+    except OSError as e:
+        return f"{Fore.RED}❌ {filename}: {reason}; перенести в карантин не удалось: {e}{Style.RESET_ALL}\n"
+
+    lines = [
+        f"Файл: {filename}",
+        f"Время: {datetime.datetime.now():%Y-%m-%d %H:%M:%S}",
+        f"Причина: {reason}",
+        f"Попыток: {details['attempts']}",
+        f"Последняя попытка шла: {details['elapsed_s']} с",
+    ]
+    if "peak_mb" in details:
+        lines.append(f"Пик памяти процесса: {details['peak_mb']} МБ")
+    with open(os.path.join(DIR_RAILWAY_QUARANTINE, filename + ".txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    # сборку начал убитый процесс — закрываем её в журнале, чтобы восстановление не ждало файл в Railway
+    JOURNAL.record("file", filename, "rolled_back", reason=reason)
+    claims = file_claims()
+    if claims:
+        # заявку взял убитый процесс — снять её сам он уже не сможет
+        claims.release([input_path], force=True)
+    return f"{Fore.RED}⛔ {filename}: {reason} — перенесён в {DIR_RAILWAY_QUARANTINE}{Style.RESET_ALL}\n"
+
+
+def list_railway_files():
+    return [f for f in os.listdir(DIR_RAILWAY) if f.lower().endswith(".pdf")]
+
+
+# ----------------------------------------------------------------------
+# СЦЕНАРИИ
+# ----------------------------------------------------------------------
+def scenario_two_sided(instruction_path, workers=None, files=None):
+    """Сценарий 1 для всех PDF из Railway или только для files; возвращает число обработанных."""
+    print_info("Запуск сценария: Двухсторонняя Ж/Д накладная")
+    template_3_6_path = TEMPLATE_3_6_PATH
+
+    if not os.path.exists(template_3_6_path):
+        print_error(f"Файл '{template_3_6_path}' не найден!")
+        return 0
+
+    try:
+        TEMPLATE_CACHE.get_reader(template_3_6_path)
+    except Exception as e:
+        print_error(f"Ошибка при чтении '{template_3_6_path}': {e}")
+        return 0
+
+    files = list_railway_files() if files is None else files
+
+    if not files:
+        print_info(f"В папке '{DIR_RAILWAY}' нет PDF файлов.")
+        return 0
+
+    processed_count = run_railway_batch(files, instruction_path, template_3_6_path, workers)
+    print_info(f"Обработано файлов: {processed_count}")
+    return processed_count
+
+
+def scenario_one_sided(instruction_path, workers=None, files=None):
+    """Сценарий 2 для всех PDF из Railway или только для files; возвращает число обработанных."""
+    print_info("Запуск сценария: Односторонняя Ж/Д накладная")
+
+    files = list_railway_files() if files is None else files
+    if not files:
+        print_info(f"В папке '{DIR_RAILWAY}' нет PDF файлов.")
+        return 0
+
+    processed_count = run_railway_batch(files, instruction_path, None, workers)
+    print_info(f"Обработано файлов: {processed_count}")
+    return processed_count
+
+
+def generate_merge_filename(file_tuples):
+    numbers = sorted([item[0] for item in file_tuples])
+    count = len(numbers)
+
+    if not numbers:
+        return f"Railway_Merged_{int(time.time())}.pdf"
+
+    ranges = []
+    range_start = numbers[0]
+    prev = numbers[0]
+
+    for curr in numbers[1:]:
+        if curr == prev + 1:
+            prev = curr
+        else:
+            ranges.append(f"{range_start}" if range_start == prev else f"{range_start}-{prev}")
+            range_start = curr
+            prev = curr
+
+    ranges.append(f"{range_start}" if range_start == prev else f"{range_start}-{prev}")
+    ranges_str = ";".join(ranges)
+    return f"Railway {ranges_str} {count} pcs..pdf"
+
+
+def collect_ready_files(names=None):
+    """Пары (номер, путь) для PDF из Ready, отсортированные по номеру."""
+    files_with_nums = []
+    for fname in os.listdir(DIR_READY) if names is None else names:
+        if fname.lower().endswith(".pdf"):
+            num = extract_number_from_filename(fname)
+            if num is not None:
+                files_with_nums.append((num, os.path.join(DIR_READY, fname)))
+    files_with_nums.sort(key=lambda x: x[0])
+    return files_with_nums
+
+
+class StreamingPdfWriter:
+    """
+    Пишет PDF сразу в выходной файл: объекты каждой страницы копируются в
+    поток по мере чтения и не накапливаются в памяти, как в PdfWriter.
+    Входной файл читается лениво, а кэш разобранных объектов чтения
+    сбрасывается после каждой страницы, поэтому пиковая память ограничена
+    одной страницей, а не всем пакетом. В памяти остаются только таблица
+    смещений, соответствие номеров объектов текущего файла и хэши записанных объектов.
+
+    Объекты записываются после своих потомков, поэтому одинаковые объекты
+    (фон инструкции, страницы 3-6, шрифты, изображения штампов) из разных
+    документов сериализуются одинаково и при dedup пишутся один раз.
+    С compress потоки без сжатия сжимаются Flate, а сжатые Flate потоки
+    содержимого пережимаются с максимальным уровнем, если так выходит меньше.
+    С object_streams объекты, кроме потоков, копятся и пишутся по
+    OBJSTM_CAPACITY штук в сжатые потоки объектов (/ObjStm), а таблица
+    ссылок — сжатым xref-потоком (PDF 1.5): словари страниц, шрифтов и
+    ресурсов занимают в разы меньше места, а просмотрщик читает таблицу
+    ссылок за одно обращение.
+    """
+
+    CATALOG_NUM = 1
+    PAGES_NUM = 2
+    OBJSTM_CAPACITY = 100
+
+    def __init__(self, stream, dedup=None, compress=None, object_streams=None):
+        self.stream = stream
+        self.dedup = SETTINGS["dedup"] if dedup is None else dedup
+        self.compress = SETTINGS["compress_streams"] if compress is None else compress
+        self.object_streams = SETTINGS["object_streams"] if object_streams is None else object_streams
+        self._packed = []  # (номер, байты) объектов, ждущих своего потока объектов
+        self._compressed = {}  # номер -> (номер потока объектов, место в нём)
+        self.objstm_bytes = 0
+        self._offsets = {}
+        self._next_num = 3
+        self._kids = ArrayObject()
+        self._digests = {}
+        self.dedup_objects = 0
+        self.dedup_bytes = 0
+        self.compress_bytes = 0
+        stream.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _alloc(self):
+        num = self._next_num
+        self._next_num += 1
+        return num
+
+    def _write_raw(self, num, data):
+        self._offsets[num] = self.stream.tell()
+        self.stream.write(f"{num} 0 obj\n".encode("ascii"))
+        self.stream.write(data)
+        self.stream.write(b"\nendobj\n")
+
+    def _write_object(self, num, obj):
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer, None)
+        self._store(num, buffer.getvalue(), isinstance(obj, StreamObject))
+
+    def _store(self, num, data, is_stream):
+        if self.object_streams and not is_stream:
+            self._packed.append((num, data))
+            if len(self._packed) >= self.OBJSTM_CAPACITY:
+                self._flush_packed()
+        else:
+            self._write_raw(num, data)
+
+    def _flush_packed(self):
+        """Пишет накопленные объекты одним сжатым потоком объектов."""
+        if not self._packed:
+            return
+        stream_num = self._alloc()
+        header, offset = [], 0
+        for index, (num, data) in enumerate(self._packed):
+            header.append(f"{num} {offset}")
+            offset += len(data) + 1
+            self._compressed[num] = (stream_num, index)
+        first = (" ".join(header) + "\n").encode("ascii")
+        packed = zlib.compress(first + b"\n".join(data for _, data in self._packed) + b"\n")
+
+        start = self._offsets[stream_num] = self.stream.tell()
+        self.stream.write((
+            f"{stream_num} 0 obj\n<< /Type /ObjStm /N {len(self._packed)} /First {len(first)} "
+            f"/Filter /FlateDecode /Length {len(packed)} >>\nstream\n"
+        ).encode("ascii"))
+        self.stream.write(packed)
+        self.stream.write(b"\nendstream\nendobj\n")
+        # столько заняли бы те же объекты отдельно: "N 0 obj ... endobj" и строка в xref
+        classic = sum(len(data) + len(str(num)) + 35 for num, data in self._packed)
+        self.objstm_bytes += classic - (self.stream.tell() - start)
+        self._packed = []
+
+    def _emit(self, obj, num=None):
+        """
+        Записывает объект и возвращает его номер. Без заранее выделенного
+        номера и при dedup вместо повторной записи отдаётся номер уже
+        записанного объекта с теми же байтами.
+        """
+        buffer = io.BytesIO()
+        obj.write_to_stream(buffer, None)
+        data = buffer.getvalue()
+        digest = None
+        if self.dedup and num is None:
+            digest = hashlib.sha1(data).digest()
+            existing = self._digests.get(digest)
+            if existing is not None:
+                self.dedup_objects += 1
+                self.dedup_bytes += len(data)
+                return existing
+        if num is None:
+            num = self._alloc()
+        self._store(num, data, isinstance(obj, StreamObject))
+        if digest is not None:
+            self._digests[digest] = num
+        return num
+
+    def _copy_stream(self, obj, mapping, in_progress):
+        data = obj._data
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        encoded = isinstance(obj, EncodedStreamObject)
+        skip = ("/Length",)
+
+        if self.compress and "/Filter" not in obj:
+            packed = zlib.compress(data, 9)
+            self.compress_bytes += len(data) - len(packed)
+            data, encoded = packed, True
+            copy = EncodedStreamObject()
+            copy[NameObject("/Filter")] = NameObject("/FlateDecode")
+        elif (self.compress and obj.get("/Filter") == "/FlateDecode"
+              and "/DecodeParms" not in obj and obj.get("/Subtype") != "/Image"):
+            try:
+                packed = zlib.compress(zlib.decompress(data), 9)
+            except zlib.error:
+                packed = data
+            if len(packed) < len(data):
+                self.compress_bytes += len(data) - len(packed)
+                data = packed
+            copy = EncodedStreamObject()
+        else:
+            copy = EncodedStreamObject() if encoded else DecodedStreamObject()
+
+        copy._data = data
+        for key, value in obj.items():
+            if key not in skip and key not in copy:
+                copy[NameObject(key)] = self._translate(value, mapping, in_progress)
+        return copy
+
+    def _translate(self, obj, mapping, in_progress, top=False):
+        """
+        Копия объекта с перенумерованными ссылками. Объекты по ссылкам
+        записываются сразу (после своих потомков); при циклических ссылках
+        номер выделяется заранее и такой объект не дедуплицируется.
+        """
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in mapping:
+                return IndirectObject(mapping[key], 0, None)
+            target = obj.get_object()
+            # дерево страниц исходника не переносим: у страниц свой /Parent
+            if isinstance(target, DictionaryObject) and target.get("/Type") == "/Pages":
+                return NullObject()
+            if key in in_progress:
+                mapping[key] = self._alloc()
+                return IndirectObject(mapping[key], 0, None)
+
+            in_progress.add(key)
+            try:
+                if target is None:
+                    copy = NullObject()
+                elif isinstance(target, DictionaryObject) and target.get("/Type") == "/Page":
+                    # страница, на которую ссылаются (например, из ссылок-аннотаций),
+                    # но которая сама в пакет не входит — без /Parent
+                    copy = DictionaryObject(
+                        (NameObject(k), self._translate(v, mapping, in_progress))
+                        for k, v in target.items() if k != "/Parent"
+                    )
+                else:
+                    copy = self._translate(target, mapping, in_progress, top=True)
+            finally:
+                in_progress.discard(key)
+
+            num = self._emit(copy, mapping.get(key))
+            mapping[key] = num
+            return IndirectObject(num, 0, None)
+        if isinstance(obj, StreamObject):
+            copy = self._copy_stream(obj, mapping, in_progress)
+            if top:
+                return copy
+            # поток внутри словаря (так бывает у страниц после merge_page) — отдельным объектом
+            return IndirectObject(self._emit(copy), 0, None)
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject(
+                (NameObject(k), self._translate(v, mapping, in_progress)) for k, v in obj.items()
+            )
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._translate(v, mapping, in_progress) for v in obj)
+        return obj
+
+    def add_document(self, pdf):
+        """Переносит все страницы pdf (PdfReader или собранный PdfWriter)."""
+        mapping = {}
+        pages = list(pdf.pages)
+        # номера страниц выделяются заранее: на них могут ссылаться другие объекты документа
+        numbers = []
+        for page in pages:
+            num = self._alloc()
+            numbers.append(num)
+            ref = page.indirect_reference
+            if ref is not None:
+                mapping[(ref.idnum, ref.generation)] = num
+
+        for page, page_num in zip(pages, numbers):
+            in_progress = set()
+            page_copy = DictionaryObject()
+            for key, value in page.items():
+                if key != "/Parent":
+                    page_copy[NameObject(key)] = self._translate(value, mapping, in_progress)
+            page_copy[NameObject("/Parent")] = IndirectObject(self.PAGES_NUM, 0, None)
+            self._emit(page_copy, page_num)
+            self._kids.append(IndirectObject(page_num, 0, None))
+
+            # всё нужное уже записано — разобранные объекты можно отпустить
+            if hasattr(pdf, "resolved_objects"):
+                release_objects(pdf)
+            sample_memory()
+
+    def add_file(self, path):
+        with open(path, "rb") as f:
+            self.add_document(PdfReader(f))
+
+    @property
+    def page_count(self):
+        return len(self._kids)
+
+    @property
+    def saved_bytes(self):
+        return self.dedup_bytes + self.compress_bytes + self.objstm_bytes
+
+    def close(self):
+        self._write_object(self.PAGES_NUM, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): self._kids,
+            NameObject("/Count"): NumberObject(len(self._kids)),
+        }))
+        self._write_object(self.CATALOG_NUM, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.PAGES_NUM, 0, None),
+        }))
+        if self.object_streams:
+            self._flush_packed()
+            self._write_xref_stream()
+            return
+
+        xref_offset = self.stream.tell()
+        size = self._next_num
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for num in range(1, size):
+            if num in self._offsets:
+                lines.append(f"{self._offsets[num]:010d} 00000 n \n")
+            else:
+                lines.append("0000000000 65535 f \n")
+        lines.append(f"trailer\n<< /Size {size} /Root {self.CATALOG_NUM} 0 R >>\n")
+        lines.append(f"startxref\n{xref_offset}\n%%EOF\n")
+        self.stream.write("".join(lines).encode("ascii"))
+
+    def _write_xref_stream(self):
+        """Таблица ссылок сжатым xref-потоком: записи по 1 + width + 2 байта вместо 20 символов."""
+        xref_num = self._alloc()
+        size = self._next_num
+        xref_offset = self._offsets[xref_num] = self.stream.tell()
+        width = max(1, (max(max(self._offsets.values()), size).bit_length() + 7) // 8)
+        rows = bytearray()
+        for num in range(size):
+            if num in self._compressed:
+                stream_num, index = self._compressed[num]
+                rows += b"\x02" + stream_num.to_bytes(width, "big") + index.to_bytes(2, "big")
+            elif num in self._offsets:
+                rows += b"\x01" + self._offsets[num].to_bytes(width, "big") + b"\x00\x00"
+            else:
+                rows += b"\x00" + bytes(width) + b"\xff\xff"
+        data = zlib.compress(bytes(rows))
+        self.stream.write((
+            f"{xref_num} 0 obj\n<< /Type /XRef /Size {size} /W [1 {width} 2] "
+            f"/Root {self.CATALOG_NUM} 0 R /Filter /FlateDecode /Length {len(data)} >>\nstream\n"
+        ).encode("ascii"))
+        self.stream.write(data)
+        self.stream.write(f"\nendstream\nendobj\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+        classic = len(f"xref\n0 {size}\n") + 20 * size + len(f"trailer\n<< /Size {size} /Root 1 0 R >>\n")
+        self.objstm_bytes += classic - (self.stream.tell() - xref_offset)
+
+
+@contextlib.contextmanager
+def linearized_output(stream):
+    """
+    С --linearize отдаёт для записи временный файл и затем переписывает его в
+    stream линеаризованным (qpdf через pikepdf): первая страница и её объекты
+    в начале файла, и просмотрщик или сервер печати показывает её, не
+    дочитав файл. Без --linearize отдаёт сам stream.
+    """
+    if not SETTINGS["linearize"]:
+        yield stream
+        return
+    with tempfile.TemporaryFile() as tmp:
+        yield tmp
+        tmp.seek(0)
+        with stage("linearize"), pikepdf.open(tmp) as pdf:
+            get_engine(PikepdfEngine.name).save(pdf, stream)
+
 
-DIR_RAILWAY = os.path.join(BASE_DIR, "Railway")
-DIR_TEMPLATE = os.path.join(BASE_DIR, "Template")
-DIR_STAMP = os.path.join(BASE_DIR, "Stamp")
-DIR_READY = os.path.join(BASE_DIR, "Ready")
-DIR_MERGED = os.path.join(BASE_DIR, "Merged Railway")
+def write_pdf(pdf_writer, stream):
+    """
+    Сохраняет собранный PdfWriter через StreamingPdfWriter, чтобы к результатам
+    сценариев применялись те же дедупликация и сжатие, что и к пакетам.
+    Возвращает сэкономленные байты.
+    """
+    with linearized_output(stream) as target:
+        writer = StreamingPdfWriter(target)
+        writer.add_document(pdf_writer)
+        writer.close()
+    count("bytes_saved", writer.saved_bytes)
+    return writer.saved_bytes
 
-DIR_RAILWAY_DONE = os.path.join(DIR_RAILWAY, "Done")
-DIR_READY_DONE = os.path.join(DIR_READY, "Done")
 
-NO_INSTRUCTION_FLAG = "NO_INSTRUCTION"
+def write_parts(parts, stream):
+    """
+    Как write_pdf, но для документа, собранного частями (compose_parts): каждая
+    часть пишется сразу после сборки и отпускается до сборки следующей.
+    """
+    with linearized_output(stream) as target:
+        writer = StreamingPdfWriter(target)
+        for part in parts:
+            with stage("write"):
+                writer.add_document(part)
+            # иначе записанная часть жила бы до сборки следующей
+            del part
+        with stage("write"):
+            writer.close()
+    count("bytes_saved", writer.saved_bytes)
+    return writer.saved_bytes
 
 
-def print_step(text): print(f"\n{Fore.YELLOW}🟧 {text}{Style.RESET_ALL}")
-def print_info(text): print(f"{Fore.CYAN}ℹ️  {text}{Style.RESET_ALL}")
-def print_success(text): print(f"{Fore.GREEN}✅ {text}{Style.RESET_ALL}")
-def print_error(text): print(f"{Fore.RED}❌ {text}{Style.RESET_ALL}")
-def print_bold_input(prompt_text): return input(f"{Style.BRIGHT}{prompt_text}{Style.RESET_ALL} ")
+def merge_chunk(chunk):
+    """Скрепляет один пакет в Merged Railway и переносит исходники в Ready/Done."""
+    output_filename = generate_merge_filename(chunk)
+    output_path = os.path.join(DIR_MERGED, output_filename)
 
+    print(f"  Скрепление: {[os.path.basename(x[1]) for x in chunk]}")
+    inputs = [fpath for _, fpath in chunk]
+    JOURNAL.record(
+        "chunk", output_filename, "started",
+        inputs=inputs, output=output_path, done_folder=DIR_READY_DONE
+    )
+    started = time.perf_counter()
+    with stage("merge"), atomic_output(output_path) as f:
+        writer = get_engine().concatenate(inputs, f)
+    elapsed = time.perf_counter() - started
+    JOURNAL.record("chunk", output_filename, "written")
+    count("pages_in", writer.page_count)
+    count("bytes_in", sum(os.path.getsize(fpath) for fpath in inputs))
+    count("bytes_out", os.path.getsize(output_path))
+    count("bytes_saved", writer.saved_bytes)
 
-def ensure_directories():
-    folders = [
-        DIR_RAILWAY, DIR_TEMPLATE, DIR_STAMP, DIR_READY, DIR_MERGED,
-        DIR_RAILWAY_DONE, DIR_READY_DONE
-    ]
-    for folder in folders:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    print_success(f"Создан: {output_filename}")
+    print(
+        f"    {Fore.MAGENTA}Размер:{Style.RESET_ALL} {os.path.getsize(output_path) / 1e3:.0f} КБ, "
+        f"повторов убрано: {writer.dedup_objects} ({writer.dedup_bytes / 1e3:.0f} КБ), "
+        f"сжатие: {writer.compress_bytes / 1e3:.0f} КБ, "
+        + (f"потоки объектов: {writer.objstm_bytes / 1e3:.0f} КБ, " if writer.objstm_bytes else "")
+        + f"запись {elapsed:.2f} с"
+    )
+    with stage("move"):
+        moved = [move_file_to_done(fpath, DIR_READY_DONE) for fpath in inputs]
+    if all(moved):
+        JOURNAL.record("chunk", output_filename, "done")
 
 
-def move_file_to_done(src_path, done_folder):
-    if not os.path.exists(done_folder):
-        os.makedirs(done_folder)
-    filename = os.path.basename(src_path)
-    dst_path = os.path.join(done_folder, filename)
-    try:
-        shutil.move(src_path, dst_path)
-    except Exception as e:
-        print_error(f"Не удалось переместить {filename} в Done: {e}")
+def _merge_task(chunk, capture=False):
+    buffer = io.StringIO() if capture else None
+    ok = False
+    output_filename = generate_merge_filename(chunk)
+    metrics = FileMetrics(output_filename, kind="chunk")
+    with contextlib.redirect_stdout(buffer) if capture else contextlib.nullcontext(), \
+            track_metrics(metrics), profile_task(metrics):
+        try:
+            # пакет берётся целиком: если хоть один файл у другого обработчика, пакет пропускается
+            with claimed([fpath for _, fpath in chunk], output_filename) as mine:
+                if mine:
+                    merge_chunk(chunk)
+                else:
+                    metrics.count("skipped")
+            ok = True
+        except Exception as e:
+            metrics.count("errors")
+            print_error(f"Ошибка {output_filename}: {e}")
+    return _task_result(ok, metrics, buffer)
 
 
-def extract_number_from_filename(filename):
-    numbers = re.findall(r'\d+', filename)
-    return int(numbers[0]) if numbers else None
+def merge_ready_files(files_with_nums, chunk_size=None, workers=None):
+    """
+    Скрепляет файлы по chunk_size штук в Merged Railway; возвращает число пакетов.
+    Пакеты независимы, поэтому при workers > 1 собираются параллельно,
+    а вывод печатается в порядке пакетов.
+    """
+    chunk_size = chunk_size or SETTINGS["merge_chunk_size"]
+    chunks = [files_with_nums[i:i + chunk_size] for i in range(0, len(files_with_nums), chunk_size)]
 
+    workers = min(resolve_workers(workers), len(chunks))
+    if workers > 1:
+        print_info(f"Параллельное скрепление, процессов: {workers}")
 
-def get_file_creation_date(filepath):
-    timestamp = os.path.getmtime(filepath)
-    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+    def error_log(task, e):
+        return f"{Fore.RED}❌ Ошибка {generate_merge_filename(task[0])}: {e}{Style.RESET_ALL}\n"
 
+    tasks = [(chunk,) for chunk in chunks]
+    return run_batch(_merge_task, tasks, workers, "merge", "пакет", error_log=error_log)
 
-def find_stamp_path(file_number):
-    if not os.path.exists(DIR_STAMP):
-        return None
-    for fname in os.listdir(DIR_STAMP):
-        if fname.lower().endswith(".pdf"):
-            if extract_number_from_filename(fname) == file_number:
-                return os.path.join(DIR_STAMP, fname)
-    return None
+
+def scenario_merge(files=None):
+    """Сценарий 3 для всех PDF из Ready или только для files; возвращает число пакетов."""
+    print_info("Запуск сценария: Скрепление Ж/Д накладных из папки Ready")
+
+    files_with_nums = collect_ready_files(files)
+
+    if not files_with_nums:
+        print_error("В папке Ready нет подходящих файлов.")
+        return 0
+
+    processed_groups = merge_ready_files(files_with_nums)
+    print_info(f"Всего создано файлов: {processed_groups}")
+    return processed_groups
 
 
 # ----------------------------------------------------------------------
-# prepare_base_pages: корректное наложение фона снизу и штампа сверху
+# Обработка и скрепление за один проход: Railway -> Merged Railway без Ready
 # ----------------------------------------------------------------------
-def prepare_base_pages(input_pdf_path, instruction_path):
+def package_chunk(chunk, instruction_path, template_3_6_path=None, keep_ready=False):
     """
-    Возвращает PdfWriter, в котором:
-    - для каждой страницы исходного PDF:
-        1) добавляется инструкция (фон) как базовая страница (если выбрана)
-        2) затем на неё накладывается содержимое исходной страницы (чтобы текст был сверху)
-        3) затем накладывается штамп (если найден) поверх всех слоёв
-    Этот метод избегает использования merge_transformed_page и совместим со сборками PyPDF2,
-    где merge_transformed_page отсутствует.
+    Собирает накладные пакета (пары (номер, путь) из Railway) в памяти и
+    сразу пишет их в пакет Merged Railway — без записи в Ready и повторного
+    разбора. С keep_ready копия каждой накладной пишется в Ready/Done
+    (в Ready её подобрало бы следующее скрепление). Накладные, которые не
+    удалось собрать, остаются в Railway; пакет называется по собранным.
+    Накладные больше бюджета памяти собираются частями во временный файл
+    рядом с пакетом и переносятся в пакет с диска — так же, через временные
+    файлы, пакеты собирает движок, отличный от PyPDF2 (--engine).
     """
-    filename = os.path.basename(input_pdf_path)
-    file_number = extract_number_from_filename(filename)
+    print(f"  Пакет: {[os.path.basename(x[1]) for x in chunk]}")
+    engine = get_engine()
+    memory_budget = file_memory_budget()
+    composed = []
+    temporary = []
+    try:
+        for num, input_path in chunk:
+            filename = os.path.basename(input_path)
+            try:
+                instruction = route_instruction(filename, instruction_path)
+                if engine.name == PyPDF2Engine.name and fits_memory_budget(input_path, memory_budget):
+                    [writer] = compose_railway_parts(input_path, instruction, template_3_6_path)
+                    composed.append(((num, input_path), writer))
+                    continue
+                if keep_ready:
+                    part_path = os.path.join(DIR_READY_DONE, filename)
+                    with atomic_output(part_path) as f:
+                        engine.render(input_path, instruction, template_3_6_path, f)
+                else:
+                    fd, part_path = tempfile.mkstemp(suffix=".pdf" + PARTIAL_SUFFIX, dir=DIR_MERGED)
+                    temporary.append(part_path)
+                    with os.fdopen(fd, "wb") as f:
+                        engine.render(input_path, instruction, template_3_6_path, f)
+                composed.append(((num, input_path), part_path))
+            except Exception as e:
+                count("errors")
+                print_error(f"Ошибка с файлом {filename}: {e}")
 
-    # читаем исходный документ
-    reader = PdfReader(input_pdf_path)
-    output_writer = PdfWriter()
+        if not composed:
+            raise RuntimeError("ни одна накладная пакета не собрана")
+        _write_package(composed, keep_ready)
+    finally:
+        for path in temporary:
+            if os.path.exists(path):
+                os.remove(path)
 
-    # подготовим путь к штампу (если есть)
-    stamp_path = find_stamp_path(file_number)
-    stamp_page = None
-    if stamp_path:
+
+def _write_package(composed, keep_ready):
+    """Пишет собранные накладные пакета (PdfWriter или путь к файлу) в Merged Railway."""
+    members = [member for member, _ in composed]
+    output_filename = generate_merge_filename(members)
+    output_path = os.path.join(DIR_MERGED, output_filename)
+    inputs = [path for _, path in members]
+    JOURNAL.record(
+        "package", output_filename, "started",
+        inputs=inputs, output=output_path, done_folder=DIR_RAILWAY_DONE
+    )
+
+    started = time.perf_counter()
+    with stage("write"), atomic_output(output_path) as f:
+        if all(isinstance(writer, str) for _, writer in composed):
+            package = get_engine().concatenate([writer for _, writer in composed], f)
+        else:
+            with linearized_output(f) as target:
+                package = StreamingPdfWriter(target)
+                for _, writer in composed:
+                    if isinstance(writer, str):
+                        package.add_file(writer)
+                    else:
+                        package.add_document(writer)
+                package.close()
+    elapsed = time.perf_counter() - started
+
+    if keep_ready:
+        with stage("write"):
+            for (_, input_path), writer in composed:
+                if isinstance(writer, str):
+                    # крупная накладная уже записана в Ready/Done при сборке
+                    continue
+                ready_copy = os.path.join(DIR_READY_DONE, os.path.basename(input_path))
+                with atomic_output(ready_copy) as f:
+                    write_pdf(writer, f)
+    JOURNAL.record("package", output_filename, "written")
+    count("bytes_in", sum(os.path.getsize(path) for path in inputs))
+    count("bytes_out", os.path.getsize(output_path))
+    count("bytes_saved", package.saved_bytes)
+
+    print_success(f"Создан: {output_filename}")
+    print(
+        f"    {Fore.MAGENTA}Размер:{Style.RESET_ALL} {os.path.getsize(output_path) / 1e3:.0f} КБ, "
+        f"повторов убрано: {package.dedup_objects} ({package.dedup_bytes / 1e3:.0f} КБ), "
+        f"сжатие: {package.compress_bytes / 1e3:.0f} КБ, "
+        + (f"потоки объектов: {package.objstm_bytes / 1e3:.0f} КБ, " if package.objstm_bytes else "")
+        + f"запись {elapsed:.2f} с"
+    )
+    with stage("move"):
+        moved = [move_file_to_done(path, DIR_RAILWAY_DONE) for path in inputs]
+    if all(moved):
+        JOURNAL.record("package", output_filename, "done")
+
+
+def _package_task(chunk, instruction_path, template_3_6_path, keep_ready, capture=False):
+    buffer = io.StringIO() if capture else None
+    ok = False
+    metrics = FileMetrics(generate_merge_filename(chunk), kind="package")
+    with contextlib.redirect_stdout(buffer) if capture else contextlib.nullcontext(), \
+            track_metrics(metrics), profile_task(metrics):
         try:
-            stamp_reader = PdfReader(stamp_path)
-            if stamp_reader.pages:
-                stamp_page = stamp_reader.pages[0]
-                print(f"    {Fore.MAGENTA}+ Штамп:{Style.RESET_ALL} {os.path.basename(stamp_path)}")
+            with claimed([fpath for _, fpath in chunk], generate_merge_filename(chunk)) as mine:
+                if mine:
+                    package_chunk(chunk, instruction_path, template_3_6_path, keep_ready)
+                else:
+                    metrics.count("skipped")
+            ok = True
         except Exception as e:
-            print_error(f"Ошибка при чтении штампа: {e}")
-            stamp_page = None
+            metrics.count("errors")
+            print_error(f"Ошибка пакета {[os.path.basename(x[1]) for x in chunk]}: {e}")
+    return _task_result(ok, metrics, buffer)
+
+
+def scenario_process_and_merge(instruction_path, two_sided=True, keep_ready=None, workers=None,
+                               files=None):
+    """
+    Сценарии 1/2 и скрепление одним проходом: накладные из Railway в порядке
+    номеров собираются в пакеты по merge_chunk_size и пишутся прямо в
+    Merged Railway с теми же именами, что дало бы скрепление из Ready.
+    Накладные без номера в имени скреплять не по чему — они обрабатываются
+    обычным сценарием в Ready.
+    """
+    title = "Двухсторонняя" if two_sided else "Односторонняя"
+    print_info(f"Запуск сценария: {title} Ж/Д накладная + скрепление (Railway -> Merged Railway)")
+    keep_ready = SETTINGS["package_keep_ready"] if keep_ready is None else keep_ready
+
+    template_3_6_path = None
+    if two_sided:
+        template_3_6_path = TEMPLATE_3_6_PATH
+        if not os.path.exists(template_3_6_path):
+            print_error(f"Файл '{template_3_6_path}' не найден!")
+            return 0
+
+    files = list_railway_files() if files is None else files
+    if not files:
+        print_info(f"В папке '{DIR_RAILWAY}' нет PDF файлов.")
+        return 0
+
+    files_with_nums = sorted(
+        ((extract_number_from_filename(f), os.path.join(DIR_RAILWAY, f)) for f in files
+         if extract_number_from_filename(f) is not None),
+        key=lambda x: x[0],
+    )
+    unnumbered = [f for f in files if extract_number_from_filename(f) is None]
+    if unnumbered:
+        print_info(f"Без номера в имени, будут обработаны в Ready: {', '.join(unnumbered)}")
+        run_railway_batch(unnumbered, instruction_path, template_3_6_path, workers)
+
+    if not files_with_nums:
+        return 0
+    try:
+        routes = current_routes()
+        if routes:
+            print_routes([routes.route(os.path.basename(path), instruction_path) for _, path in files_with_nums])
+    except ValueError as e:
+        print_error(f"Таблица маршрутов: {e}")
+        return 0
+
+    chunk_size = SETTINGS["merge_chunk_size"]
+    chunks = [files_with_nums[i:i + chunk_size] for i in range(0, len(files_with_nums), chunk_size)]
+    workers = min(resolve_workers(workers), len(chunks))
+    if workers > 1:
+        print_info(f"Параллельная сборка пакетов, процессов: {workers}")
+
+    def error_log(task, e):
+        return f"{Fore.RED}❌ Ошибка пакета {generate_merge_filename(task[0])}: {e}{Style.RESET_ALL}\n"
+
+    tasks = [(chunk, instruction_path, template_3_6_path, keep_ready) for chunk in chunks]
+    scenario = "package-" + (SCENARIO_TWO_SIDED if two_sided else SCENARIO_ONE_SIDED)
+    processed_groups = run_batch(_package_task, tasks, workers, scenario, "пакет", error_log=error_log)
+    print_info(f"Всего создано файлов: {processed_groups}")
+    return processed_groups
+
+
+# ----------------------------------------------------------------------
+# План (--plan): что будет с каждым файлом — без сборки PDF
+# ----------------------------------------------------------------------
+# сколько листов ждёт двухсторонняя раскладка: обороты из 3-6.pdf — у 3-го и 6-го
+DUPLEX_SHEETS = max(DUPLEX_LAYOUT["backs"])
+# меньше файлов читаются в одном процессе: запуск пула дольше самого чтения
+PLAN_POOL_THRESHOLD = 64
+PLAN_FIELDS = ("file", "number", "pages", "stamp", "instruction", "output", "package", "issues")
+
+
+def count_pdf_pages(path):
+    """
+    Число страниц по /Count корня дерева страниц. PdfReader по открытому
+    файлу читает только трейлер и xref, а из объектов — каталог и корень
+    дерева страниц; сами страницы не разбираются.
+    """
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        return int(reader.trailer["/Root"]["/Pages"]["/Count"])
+
+
+def _page_count_task(path):
+    try:
+        return count_pdf_pages(path), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+def read_page_counts(paths, workers=1):
+    """Пары (страниц, ошибка) для каждого из paths; при многих файлах — в пуле процессов."""
+    if workers > 1 and len(paths) >= PLAN_POOL_THRESHOLD:
+        chunksize = max(1, len(paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_page_count_task, paths, chunksize=chunksize))
+    return [_page_count_task(path) for path in paths]
+
+
+def build_plan(scenario=SCENARIO_TWO_SIDED, files=None, workers=None):
+    """
+    План обработки файлов из Railway (или только files) выбранным сценарием:
+    для каждого файла — номер, число листов, штамп, куда ляжет результат
+    и в какой пакет попадёт при скреплении, плюс список замечаний. Пакеты
+    считаются так, как их соберёт скрепление Ready после обработки.
+    """
+    two_sided = scenario == SCENARIO_TWO_SIDED
+    files = sorted(list_railway_files() if files is None else files)
+    counts = read_page_counts([os.path.join(DIR_RAILWAY, f) for f in files], resolve_workers(workers))
+    duplicates = STAMP_INDEX.duplicates()
+    in_ready = {f for f in os.listdir(DIR_READY) if f.lower().endswith(".pdf")}
+
+    problems = []
+    if two_sided and not os.path.exists(TEMPLATE_3_6_PATH):
+        problems.append(f"Файл '{TEMPLATE_3_6_PATH}' не найден — двухсторонний сценарий не запустится")
+    try:
+        routes = current_routes()
+    except ValueError as e:
+        routes = None
+        problems.append(f"Таблица маршрутов: {e}")
+
+    records = []
+    for filename, (pages, error) in zip(files, counts):
+        number = extract_number_from_filename(filename)
+        stamp_path = find_stamp_path(number)
+        issues = []
+        if error:
+            issues.append(f"не читается: {error}")
+        if number is None:
+            issues.append("нет номера в имени — не попадёт в пакет")
+        elif stamp_path is None:
+            issues.append("нет штампа")
+        elif number in duplicates:
+            issues.append(f"несколько штампов: {', '.join(duplicates[number])}")
+        if two_sided and pages is not None and pages != DUPLEX_SHEETS:
+            issues.append(f"листов {pages}, двухсторонняя раскладка рассчитана на {DUPLEX_SHEETS}")
+        if filename in in_ready:
+            issues.append("в Ready уже есть файл с таким именем — будет заменён")
+        # None — инструкция, выбранная для запуска
+        instruction = routes.route(filename) if routes else None
+        records.append({
+            "file": filename,
+            "number": number,
+            "pages": pages,
+            "stamp": os.path.basename(stamp_path) if stamp_path else None,
+            "instruction": describe_instruction(instruction) if instruction else None,
+            "output": os.path.join(DIR_READY, filename),
+            "package": None,
+            "issues": issues,
+        })
+
+    # Ready после обработки: то, что там уже лежит, плюс результаты из Railway
+    members = {f: num for num, f in ((n, os.path.basename(p)) for n, p in collect_ready_files())}
+    members.update((r["file"], r["number"]) for r in records if r["number"] is not None and r["pages"] is not None)
+    ordered = sorted(((num, os.path.join(DIR_READY, f)) for f, num in members.items()), key=lambda x: x[0])
+    chunk_size = SETTINGS["merge_chunk_size"]
+    by_file = {r["file"]: r for r in records}
+    packages = []
+    for start in range(0, len(ordered), chunk_size):
+        chunk = ordered[start:start + chunk_size]
+        name = generate_merge_filename(chunk)
+        names = [os.path.basename(path) for _, path in chunk]
+        packages.append({
+            "name": name,
+            "files": names,
+            "exists": os.path.exists(os.path.join(DIR_MERGED, name)),
+        })
+        for member in names:
+            if member in by_file:
+                by_file[member]["package"] = name
+
+    return {"scenario": scenario, "files": records, "packages": packages, "problems": problems}
+
+
+def print_plan(plan, elapsed=None, limit=20):
+    """Печатает замечания по файлам, итог и пакеты; полный план — в export_plan."""
+    records = plan["files"]
+    print_step(f"План: сценарий {plan['scenario']}, файлов в Railway: {len(records)}")
+    for problem in plan["problems"]:
+        print_error(problem)
+
+    flagged = [r for r in records if r["issues"]]
+    for record in flagged:
+        print(f"  {Fore.YELLOW}{record['file']}{Style.RESET_ALL}: {'; '.join(record['issues'])}")
+
+    def with_issue(prefix):
+        return sum(1 for r in records if any(issue.startswith(prefix) for issue in r["issues"]))
+
+    print_info(
+        f"Листов: {sum(r['pages'] or 0 for r in records)}, со штампом: "
+        f"{sum(1 for r in records if r['stamp'])}, без штампа: {with_issue('нет штампа')}, "
+        f"без номера: {with_issue('нет номера')}, не по раскладке: {with_issue('листов')}, "
+        f"не читаются: {with_issue('не читается')}, без замечаний: {len(records) - len(flagged)}"
+    )
+
+    packages = plan["packages"]
+    print_info(f"Пакетов при скреплении по {SETTINGS['merge_chunk_size']} шт.: {len(packages)}")
+    for package in packages[:limit]:
+        note = f" {Fore.RED}(уже есть в Merged Railway — будет заменён){Style.RESET_ALL}" if package["exists"] else ""
+        print(f"  {package['name']} <- {', '.join(package['files'])}{note}")
+    if len(packages) > limit:
+        print(f"  ... ещё {len(packages) - limit} (полный список — --plan-output)")
+    if elapsed is not None:
+        print_info(f"План построен за {elapsed:.2f} с")
+
+
+def export_plan(plan, path):
+    """Сохраняет план: .csv — по строке на файл, иначе JSON целиком (с пакетами)."""
+    with atomic_output(path) as f:
+        if path.lower().endswith(".csv"):
+            text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+            writer = csv.DictWriter(text, PLAN_FIELDS)
+            writer.writeheader()
+            for record in plan["files"]:
+                writer.writerow(dict(record, issues="; ".join(record["issues"])))
+            text.flush()
+            text.detach()
+        else:
+            f.write(json.dumps(plan, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+# ----------------------------------------------------------------------
+# Режим наблюдения: обработка накладных по мере появления в Railway/Ready
+# ----------------------------------------------------------------------
+class _Inotify:
+    """Минимальная обёртка над inotify (Linux) через ctypes — только как сигнал "что-то изменилось"."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
 
-    # если инструкция указана — сохраним путь (чтобы при каждой странице брать "чистую" копию)
-    bg_path = None if instruction_path == NO_INSTRUCTION_FLAG else instruction_path
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for folder in folders:
+            if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, f"inotify_add_watch {folder}")
 
-    # Обрабатываем страницы: для каждой страницы создаём результирующую страницу,
-    # на которой сначала фон (если есть), затем содержимое исходной страницы, затем штамп.
-    for page_idx, orig_page in enumerate(reader.pages, start=1):
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # сами события не разбираем: после пробуждения папки всё равно пересканируются
         try:
-            if bg_path:
-                # читаем фон заново для каждой страницы, чтобы иметь "чистую" базовую страницу
-                bg_reader = PdfReader(bg_path)
-                if not bg_reader.pages:
-                    # если вдруг не удалось прочитать фон — просто используем оригинал
-                    target_page = orig_page
-                else:
-                    bg_page = bg_reader.pages[0]
-                    # на базовую страницу накладываем содержимое исходной страницы (оригинал сверху)
-                    try:
-                        bg_page.merge_page(orig_page)
-                        target_page = bg_page
-                    except Exception as e:
-                        # Если merge_page сработал некорректно, откат — используем оригинальную страницу
-                        print_error(f"Не удалось наложить страницу поверх фона (стр. {page_idx}): {e}")
-                        target_page = orig_page
-            else:
-                target_page = orig_page
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_pdf_complete(path):
+    """Файл открывается на чтение и заканчивается маркером %%EOF."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 1024))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+
+class FolderWatcher:
+    """
+    Следит за папками и отдаёт PDF, запись которых завершена: размер и mtime
+    не менялись settle секунд и файл заканчивается %%EOF. Изменения ловит
+    inotify, если он доступен, иначе папки опрашиваются раз в poll_interval секунд.
+    Файлы, которые не удалось обработать (mark_failed), больше не отдаются,
+    пока их не заменят или не изменят.
+    """
+
+    def __init__(self, folders, settle, poll_interval):
+        self.folders = folders
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self._pending = {}
+        self._failed = {}  # путь -> (размер, mtime) на момент неудачной обработки
+        self._unsettled = {}
+        self._notify = None
+        if sys.platform.startswith("linux"):
+            try:
+                self._notify = _Inotify(folders)
+            except OSError as e:
+                print_error(f"inotify недоступен ({e}), используется опрос папок")
+
+    @property
+    def mode(self):
+        return "inotify" if self._notify else f"опрос каждые {self.poll_interval} с"
 
-            # затем накладываем штамп поверх (если есть)
-            if stamp_page:
+    def ready_files(self, folder):
+        """Имена PDF в folder, которые можно обрабатывать."""
+        now = time.time()
+        ready = []
+        present = set()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(".pdf") or not entry.is_file():
+                    continue
                 try:
-                    target_page.merge_page(stamp_page)
-                except Exception as e:
-                    print_error(f"Ошибка при наложении штампа (стр. {page_idx}): {e}")
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                present.add(entry.path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if entry.path in self._failed:
+                    if self._failed[entry.path] == signature:
+                        continue
+                    del self._failed[entry.path]
+                known = self._pending.get(entry.path)
+                if known is None or known[0] != signature:
+                    self._pending[entry.path] = (signature, now)
+                elif now - known[1] >= self.settle and is_pdf_complete(entry.path):
+                    ready.append(entry.name)
 
-            # добавляем в writer
-            output_writer.add_page(target_page)
-        except Exception as e:
-            print_error(f"Критическая ошибка при обработке страницы {page_idx} файла {filename}: {e}")
+        for known in (self._pending, self._failed):
+            for path in [p for p in known if os.path.dirname(p) == folder and p not in present]:
+                del known[path]
+        self._unsettled[folder] = len(present) - len(ready) - sum(
+            os.path.dirname(p) == folder for p in self._failed
+        )
+        return sorted(ready)
 
-    return output_writer
+    def mark_failed(self, folder, names):
+        """
+        Запоминает файлы names, которые после обработки остались в folder
+        (ошибка или файл взят другим обработчиком): до изменения файла они не
+        отдаются. Возвращает их число.
+        """
+        failed = 0
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self._failed[path] = (stat.st_size, stat.st_mtime_ns)
+            failed += 1
+            print_info(f"Пропускается, пока файл не изменится: {name}")
+        return failed
+
+    def has_pending(self):
+        return any(self._unsettled.values())
+
+    def wait(self):
+        # пока есть недописанные файлы, просыпаемся не реже settle, чтобы их перепроверить
+        timeout = min(self.poll_interval, self.settle) if self.has_pending() else self.poll_interval
+        if self._notify:
+            self._notify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def close(self):
+        if self._notify:
+            self._notify.close()
+            self._notify = None
+
+
+def watch_folders(instruction_path, scenario=SCENARIO_TWO_SIDED, merge=True):
+    """
+    Работает до Ctrl+C: новые накладные в Railway обрабатываются выбранным
+    сценарием, готовые файлы в Ready скрепляются пакетами по merge_chunk_size. Неполный пакет
+    скрепляется, если в Ready ничего не менялось watch_merge_idle секунд
+    (0 — ждать, пока не наберётся полный пакет).
+    """
+    chunk_size = SETTINGS["merge_chunk_size"]
+    template_3_6_path = None
+    if scenario == SCENARIO_TWO_SIDED:
+        template_3_6_path = TEMPLATE_3_6_PATH
+        if not os.path.exists(template_3_6_path):
+            print_error(f"Файл '{template_3_6_path}' не найден!")
+            return
+
+    watcher = FolderWatcher(
+        [DIR_RAILWAY, DIR_READY], SETTINGS["watch_settle"], SETTINGS["watch_poll"]
+    )
+    print_step("Режим наблюдения за папками (Ctrl+C — выход)")
+    print_info(f"Сценарий: {scenario}, скрепление: {'да' if merge else 'нет'}, отслеживание: {watcher.mode}")
+
+    last_ready = ()
+    last_ready_change = time.time()
+    try:
+        while True:
+            processed = failed = 0
+            railway_files = watcher.ready_files(DIR_RAILWAY)
+            if railway_files:
+                processed_count = run_railway_batch(railway_files, instruction_path, template_3_6_path)
+                print_info(f"Обработано файлов: {processed_count}")
+                processed += processed_count
+                failed += watcher.mark_failed(DIR_RAILWAY, railway_files)
+
+            if merge:
+                ready_files = collect_ready_files(watcher.ready_files(DIR_READY))
+                if tuple(ready_files) != last_ready:
+                    last_ready, last_ready_change = tuple(ready_files), time.time()
+
+                full = len(ready_files) - len(ready_files) % chunk_size
+                idle = SETTINGS["watch_merge_idle"]
+                if full == 0 and ready_files and idle > 0 and time.time() - last_ready_change >= idle:
+                    full = len(ready_files)
+                if full:
+                    processed_groups = merge_ready_files(ready_files[:full], chunk_size)
+                    print_info(f"Всего создано файлов: {processed_groups}")
+                    processed += processed_groups
+                    failed += watcher.mark_failed(
+                        DIR_READY, [os.path.basename(path) for _, path in ready_files[:full]]
+                    )
+
+            if failed and not processed:
+                # проход из одних ошибок: собственные записи (.part, журнал) не должны
+                # будить наблюдение сразу же
+                time.sleep(watcher.poll_interval)
+            watcher.wait()
+    except KeyboardInterrupt:
+        print_info("Наблюдение остановлено.")
+    finally:
+        watcher.close()
 
 
 # ----------------------------------------------------------------------
-# СЦЕНАРИИ (без изменений логики — только используют исправленное prepare_base_pages)
+# Режим сервера: задания по локальному HTTP или Unix-сокету
 # ----------------------------------------------------------------------
-def scenario_two_sided(instruction_path):
-    print_info("Запуск сценария: Двухсторонняя Ж/Д накладная")
-    template_3_6_path = os.path.join(DIR_TEMPLATE, "3-6.pdf")
+SERVER_DEFAULT_PORT = 8765
+SERVER_TOKEN_ENV = "RAILWAY_TOKEN"  # ключ доступа к серверу, если не задан --token
+SCENARIO_MERGE = "merge"
 
-    if not os.path.exists(template_3_6_path):
-        print_error(f"Файл '{template_3_6_path}' не найден!")
-        return
+# сценарий задания -> функция(инструкция, файлы), возвращающая число обработанных
+JOB_SCENARIOS = {
+    SCENARIO_TWO_SIDED: lambda instruction, files: scenario_two_sided(instruction, files=files),
+    SCENARIO_ONE_SIDED: lambda instruction, files: scenario_one_sided(instruction, files=files),
+    SCENARIO_MERGE: lambda instruction, files: scenario_merge(files),
+    "package-" + SCENARIO_TWO_SIDED:
+        lambda instruction, files: scenario_process_and_merge(instruction, True, files=files),
+    "package-" + SCENARIO_ONE_SIDED:
+        lambda instruction, files: scenario_process_and_merge(instruction, False, files=files),
+}
 
-    processed_count = 0
-    files = [f for f in os.listdir(DIR_RAILWAY) if f.lower().endswith(".pdf")]
+# настройки, которые задание может переопределить на время своего выполнения
+JOB_SETTINGS = {
+    "workers": int,
+    "nup": int,
+    "merge_chunk_size": int,
+    "package_keep_ready": bool,
+    "stamp_overlay": bool,
+    "dedup": bool,
+    "compress_streams": bool,
+    "object_streams": bool,
+    "stamp_dpi": float,
+    "stamp_gray": bool,
+    "pipeline_depth": int,
+    "memory_budget_mb": float,
+    "cache_size_mb": float,
+    "file_timeout": float,
+    "file_memory_mb": float,
+    "file_retries": int,
+    "claims": bool,
+}
 
-    if not files:
-        print_info(f"В папке '{DIR_RAILWAY}' нет PDF файлов.")
-        return
 
-    for filename in files:
-        input_path = os.path.join(DIR_RAILWAY, filename)
-        output_path = os.path.join(DIR_READY, filename)
+def is_within(path, root):
+    """Лежит ли path (после раскрытия ссылок) внутри папки root."""
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
 
-        try:
-            print(f"Обработка: {filename}...")
-            base_writer = prepare_base_pages(input_path, instruction_path)
 
-            writer_with_blanks = PdfWriter()
-            for i, page in enumerate(base_writer.pages, start=1):
-                writer_with_blanks.add_page(page)
-                if i != 3 and i != 6:
-                    writer_with_blanks.add_blank_page()
+def is_loopback_host(host):
+    """Все адреса host — локальные (127.0.0.1, ::1): снаружи к серверу не подключиться."""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except (OSError, UnicodeError):
+        return False
+    return bool(infos) and all(
+        ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in infos
+    )
 
-            reader_3_6 = PdfReader(template_3_6_path)
-            final_writer = PdfWriter()
-            insert_positions = {5: reader_3_6.pages[0], 10: reader_3_6.pages[1]}
 
-            for i, page in enumerate(writer_with_blanks.pages, start=1):
-                final_writer.add_page(page)
-                if i in insert_positions:
-                    final_writer.add_page(insert_positions[i])
+def parse_job(payload, root):
+    """
+    Проверяет задание от клиента и возвращает его в нормализованном виде:
+    {"scenario", "instruction", "files", "folder", "settings"}. Файлы — имена
+    в Railway (для merge — в Ready); без files берутся все PDF из папки.
+    Папка задания и инструкция, заданная путём, должны лежать внутри root —
+    рабочей папки сервера (относительные пути отсчитываются от неё).
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("задание должно быть JSON-объектом")
+    scenario = payload.get("scenario")
+    if scenario not in JOB_SCENARIOS:
+        raise ValueError(f"неизвестный сценарий {scenario!r}, допустимы: {', '.join(JOB_SCENARIOS)}")
 
-            with open(output_path, "wb") as f:
-                final_writer.write(f)
+    instruction = payload.get("instruction")
+    if scenario != SCENARIO_MERGE and not isinstance(instruction, str):
+        raise ValueError("не указана инструкция (имя в Template, путь или 'none')")
+    if isinstance(instruction, str) and os.path.basename(instruction) != instruction:
+        instruction = os.path.join(root, instruction)
+        if not is_within(instruction, root):
+            raise ValueError(f"инструкция {payload['instruction']!r} вне рабочей папки сервера")
 
-            print_success(f"Готово -> {DIR_READY}")
-            move_file_to_done(input_path, DIR_RAILWAY_DONE)
-            processed_count += 1
+    files = payload.get("files")
+    if files is not None:
+        if not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+            raise ValueError("files должен быть списком имён файлов")
+        for name in files:
+            if name in ("", ".", "..") or os.path.basename(name) != name:
+                raise ValueError(f"'{name}': ожидается имя файла без папки")
 
-        except Exception as e:
-            print_error(f"Ошибка с файлом {filename}: {e}")
+    folder = payload.get("folder")
+    if folder is not None:
+        if not isinstance(folder, str) or not os.path.isdir(os.path.join(root, folder)):
+            raise ValueError(f"папка {folder!r} не найдена")
+        folder = os.path.join(root, folder)
+        if not is_within(folder, root):
+            raise ValueError(f"папка {payload['folder']!r} вне рабочей папки сервера")
 
-    print_info(f"Обработано файлов: {processed_count}")
+    settings = {}
+    for key, value in (payload.get("settings") or {}).items():
+        kind = JOB_SETTINGS.get(key)
+        if kind is None:
+            raise ValueError(f"настройку '{key}' нельзя менять из задания")
+        if isinstance(value, bool) != (kind is bool) or not isinstance(value, (bool, int, float)):
+            raise ValueError(f"настройка '{key}': ожидается {kind.__name__}")
+        settings[key] = kind(value)
+    if "nup" in settings and settings["nup"] not in NUP_CHOICES:
+        raise ValueError(f"nup: допустимы {', '.join(map(str, NUP_CHOICES))}")
+    if "merge_chunk_size" in settings:
+        settings["merge_chunk_size"] = max(1, settings["merge_chunk_size"])
 
+    return {"scenario": scenario, "instruction": instruction, "files": files,
+            "folder": folder and os.path.abspath(folder), "settings": settings}
 
-def scenario_one_sided(instruction_path):
-    print_info("Запуск сценария: Односторонняя Ж/Д накладная")
-    processed_count = 0
 
-    files = [f for f in os.listdir(DIR_RAILWAY) if f.lower().endswith(".pdf")]
-    if not files:
-        print_info(f"В папке '{DIR_RAILWAY}' нет PDF файлов.")
-        return
+class JobStream:
+    """
+    Вывод одного задания: каждая строка уходит клиенту JSON-событием
+    {"event": "log", "text": ...} и дублируется в консоль сервера. Если клиент
+    отключился, задание всё равно доводится до конца — файлы не бросаются
+    на полпути.
+    """
+
+    def __init__(self, wfile, console):
+        self.wfile = wfile
+        self.console = console
+        self.connected = True
+        self._pending = ""
 
-    for filename in files:
-        input_path = os.path.join(DIR_RAILWAY, filename)
-        output_path = os.path.join(DIR_READY, filename)
+    def write(self, text):
+        self.console.write(text)
+        lines = (self._pending + text).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self.send({"event": "log", "text": line})
+        return len(text)
 
+    def flush(self):
+        self.console.flush()
+
+    def send(self, event):
+        if not self.connected:
+            return
         try:
-            print(f"Обработка: {filename}...")
-            writer = prepare_base_pages(input_path, instruction_path)
+            self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        except OSError:
+            self.connected = False
 
-            with open(output_path, "wb") as f:
-                writer.write(f)
+    def close(self, event):
+        if self._pending:
+            self.send({"event": "log", "text": self._pending})
+            self._pending = ""
+        self.send(event)
 
-            print_success(f"Готово -> {DIR_READY}")
-            move_file_to_done(input_path, DIR_RAILWAY_DONE)
-            processed_count += 1
 
-        except Exception as e:
-            print_error(f"Ошибка с файлом {filename}: {e}")
+class RailwayServer:
+    """
+    Постоянно работающий процесс: 3-6, инструкции и индекс штампов разобраны
+    заранее и остаются в памяти между заданиями. Задания выполняются по
+    одному — у них общие папки, SETTINGS и кэши; следующий клиент ждёт
+    в очереди и видит об этом сообщение. С token принимаются только запросы
+    с заголовком "Authorization: Bearer <token>".
+    """
 
-    print_info(f"Обработано файлов: {processed_count}")
+    def __init__(self, base_dir, token=None):
+        self.base_dir = base_dir
+        self.token = token
+        self.started = time.time()
+        self.jobs = 0
+        self.waiting = 0
+        self.current = None
+        self.output = ThreadOutput(sys.stdout)
+        self._lock = threading.Lock()
 
+    def warm_up(self):
+        started = time.perf_counter()
+        ensure_directories()
+        recover_interrupted_jobs()
+        templates = [TEMPLATE_3_6_PATH] + [os.path.join(DIR_TEMPLATE, f) for f in list_instruction_files()]
+        for path in templates:
+            if not os.path.exists(path):
+                continue
+            try:
+                TEMPLATE_CACHE.get_reader(path)
+            except Exception as e:
+                print_error(f"Ошибка при чтении '{path}': {e}")
+        STAMP_INDEX.refresh()
+        print_info(f"Шаблонов разобрано: {len(templates)}, подготовка {time.perf_counter() - started:.2f} с")
 
-def generate_merge_filename(file_tuples):
-    numbers = sorted([item[0] for item in file_tuples])
-    count = len(numbers)
+    def status(self):
+        return {
+            "busy": self.current is not None,
+            "current": self.current,
+            "waiting": self.waiting,
+            "jobs": self.jobs,
+            "uptime_s": round(time.time() - self.started, 1),
+            "base_dir": self.base_dir,
+            "scenarios": list(JOB_SCENARIOS),
+        }
 
-    if not numbers:
-        return f"Railway_Merged_{int(time.time())}.pdf"
+    def run(self, job, stream):
+        """Выполняет задание, направив его вывод в stream; возвращает итоговое событие."""
+        with self.output.capture(stream):
+            if not self._lock.acquire(blocking=False):
+                self.waiting += 1
+                print_info(f"Сервер занят заданием {self.current}, ожидание очереди...")
+                self._lock.acquire()
+                self.waiting -= 1
+            started = time.perf_counter()
+            self.current = job["scenario"]
+            try:
+                result = self._run(job)
+            except Exception as e:
+                print_error(f"Ошибка задания: {e}")
+                result = {"ok": False, "processed": 0, "failed": 0, "error": str(e)}
+            finally:
+                self.current = None
+                self.jobs += 1
+                self._lock.release()
+        result["elapsed_s"] = round(time.perf_counter() - started, 3)
+        return dict(event="done", **result)
 
-    ranges = []
-    range_start = numbers[0]
-    prev = numbers[0]
+    def _run(self, job):
+        saved = dict(SETTINGS)
+        folder = job["folder"]
+        try:
+            if folder and folder != self.base_dir:
+                configure_paths(folder)
+                ensure_directories()
+                recover_interrupted_jobs()
+            SETTINGS.update(job["settings"])
 
-    for curr in numbers[1:]:
-        if curr == prev + 1:
-            prev = curr
+            instruction = None
+            if job["scenario"] != SCENARIO_MERGE:
+                instruction = resolve_instruction(job["instruction"])
+                if not instruction:
+                    return {"ok": False, "processed": 0, "failed": 0,
+                            "error": f"инструкция '{job['instruction']}' не найдена"}
+
+            files = job["files"]
+            if job["scenario"] == SCENARIO_MERGE:
+                pending = len(collect_ready_files(files))
+            else:
+                files = list_railway_files() if files is None else files
+                pending = len(files)
+
+            BATCH_TOTALS.clear()
+            processed = JOB_SCENARIOS[job["scenario"]](instruction, files)
+            failed = BATCH_TOTALS["failed"]
+            # сценарий мог отказаться работать ещё до пакета (нет 3-6.pdf и т.п.)
+            ok = failed == 0 and (BATCH_TOTALS["tasks"] > 0 or pending == 0)
+            return {"ok": ok, "processed": processed, "failed": failed}
+        finally:
+            SETTINGS.clear()
+            SETTINGS.update(saved)
+            if folder and folder != self.base_dir:
+                configure_paths(self.base_dir)
+
+    def authorized(self, header):
+        """Заголовок Authorization запроса подходит (или ключ доступа не задан)."""
+        if not self.token:
+            return True
+        return hmac.compare_digest((header or "").encode("utf-8"), f"Bearer {self.token}".encode("utf-8"))
+
+    def serve(self, host="127.0.0.1", port=SERVER_DEFAULT_PORT, socket_path=None):
+        """
+        Принимает задания до Ctrl+C: по Unix-сокету socket_path или по HTTP на
+        host:port. Задание читает и пишет файлы в рабочей папке, поэтому на
+        адресе, доступном из сети, сервер запускается только с ключом доступа.
+        """
+        if not socket_path and not self.token and not is_loopback_host(host):
+            print_error(
+                f"Адрес {host!r} доступен из сети: задайте ключ доступа (--token или {SERVER_TOKEN_ENV}) "
+                f"или слушайте 127.0.0.1."
+            )
+            return
+        if socket_path:
+            if not hasattr(socket, "AF_UNIX"):
+                print_error("Unix-сокеты не поддерживаются в этой системе, используйте --port.")
+                return
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = RailwayUnixServer(socket_path, RailwayRequestHandler)
+            address = f"unix:{socket_path}"
         else:
-            ranges.append(f"{range_start}" if range_start == prev else f"{range_start}-{prev}")
-            range_start = curr
-            prev = curr
+            server = http.server.ThreadingHTTPServer((host, port), RailwayRequestHandler)
+            address = f"http://{host}:{server.server_address[1]}"
+        server.railway = self
 
-    ranges.append(f"{range_start}" if range_start == prev else f"{range_start}-{prev}")
-    ranges_str = ";".join(ranges)
-    return f"Railway {ranges_str} {count} pcs..pdf"
+        sys.stdout = self.output
+        print_step(f"Сервер накладных: {address} (Ctrl+C — выход)")
+        try:
+            server.serve_forever()
+        finally:
+            sys.stdout = self.output.stream
+            server.server_close()
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
 
 
-def scenario_merge():
-    print_info("Запуск сценария: Скрепление Ж/Д накладных из папки Ready")
+if hasattr(socket, "AF_UNIX"):
+    class RailwayUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
 
-    files_with_nums = []
-    for fname in os.listdir(DIR_READY):
-        if fname.lower().endswith(".pdf"):
-            num = extract_number_from_filename(fname)
-            if num is not None:
-                files_with_nums.append((num, os.path.join(DIR_READY, fname)))
 
-    if not files_with_nums:
-        print_error("В папке Ready нет подходящих файлов.")
-        return
+class RailwayRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /status — состояние сервера; POST /jobs — JSON-задание (см. parse_job),
+    ответ — поток JSON Lines: события "log" по мере работы и итоговое "done"
+    с ok, processed, failed и elapsed_s.
+    """
 
-    files_with_nums.sort(key=lambda x: x[0])
-    chunk_size = 4
-    chunks = [files_with_nums[i:i + chunk_size] for i in range(0, len(files_with_nums), chunk_size)]
+    server_version = "Railway"
 
-    processed_groups = 0
+    def address_string(self):
+        # у Unix-сокета адреса клиента нет
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
 
-    for chunk in chunks:
-        writer = PdfWriter()
-        output_filename = generate_merge_filename(chunk)
-        output_path = os.path.join(DIR_MERGED, output_filename)
+    def log_message(self, format, *args):
+        pass
 
-        try:
-            print(f"  Скрепление: {[os.path.basename(x[1]) for x in chunk]}")
-            for _, fpath in chunk:
-                reader = PdfReader(fpath)
-                for page in reader.pages:
-                    writer.add_page(page)
+    def _send_json(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
 
-            with open(output_path, "wb") as f:
-                writer.write(f)
+    def _authorized(self):
+        if self.server.railway.authorized(self.headers.get("Authorization")):
+            return True
+        self._send_json(401, {"error": "нужен ключ доступа (--token клиента)"})
+        return False
 
-            print_success(f"Создан: {output_filename}")
-            for _, fpath in chunk:
-                move_file_to_done(fpath, DIR_READY_DONE)
-            processed_groups += 1
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip("/") == "/status":
+            self._send_json(200, self.server.railway.status())
+        else:
+            self._send_json(404, {"error": "неизвестный адрес, есть /status и /jobs"})
 
-        except Exception as e:
-            print_error(f"Ошибка {output_filename}: {e}")
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "неизвестный адрес, есть /status и /jobs"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            job = parse_job(json.loads(self.rfile.read(length) or b"null"), self.server.railway.base_dir)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
 
-    print_info(f"Всего создано файлов: {processed_groups}")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.end_headers()
+        self.close_connection = True
+        railway = self.server.railway
+        stream = JobStream(self.wfile, railway.output.stream)
+        stream.close(railway.run(job, stream))
+
+
+def list_instruction_files():
+    return sorted(
+        f for f in os.listdir(DIR_TEMPLATE)
+        if f.lower().startswith("instruction (china)") and f.lower().endswith(".pdf")
+    )
 
 
 def select_instruction():
@@ -305,11 +4907,7 @@ def select_instruction():
         print_error(f"Папка '{DIR_TEMPLATE}' не найдена.")
         return None
 
-    files = [
-        f for f in os.listdir(DIR_TEMPLATE)
-        if f.lower().startswith("instruction (china)") and f.lower().endswith(".pdf")
-    ]
-    files.sort()
+    files = list_instruction_files()
 
     print(f"Найдены следующие варианты:")
     for idx, filename in enumerate(files, 1):
@@ -341,6 +4939,7 @@ def select_instruction():
 
 def main():
     ensure_directories()
+    recover_interrupted_jobs()
     current_instruction = None
 
     while True:
@@ -360,10 +4959,19 @@ def main():
             instr_display = os.path.basename(current_instruction)
 
         print(f"Активная инструкция: {Fore.CYAN}{instr_display}{Style.RESET_ALL}")
+        try:
+            routes = current_routes()
+            if routes:
+                print(f"Маршруты инструкций: {Fore.CYAN}{os.path.basename(routes.path)}{Style.RESET_ALL} "
+                      f"({len(routes)} правил; активная — для файлов без правила)")
+        except ValueError as e:
+            print_error(f"Таблица маршрутов: {e}")
         print("-" * 30)
         print("1. Двухсторонняя Ж/Д накладная (Авто: Штамп + Фон + Вставки)")
         print("2. Односторонняя Ж/Д накладная (Авто: Штамп + Фон)")
         print("3. Скрепление Ж/Д накладных (из Ready -> Merged Railway)")
+        print("4. Двухсторонняя + скрепление (из Railway сразу в Merged Railway)")
+        print("5. Односторонняя + скрепление (из Railway сразу в Merged Railway)")
         print("0. Вернуться к выбору инструкций")
         print("-" * 30)
 
@@ -375,6 +4983,10 @@ def main():
             scenario_one_sided(current_instruction)
         elif choice == "3":
             scenario_merge()
+        elif choice == "4":
+            scenario_process_and_merge(current_instruction, two_sided=True)
+        elif choice == "5":
+            scenario_process_and_merge(current_instruction, two_sided=False)
         elif choice == "0":
             current_instruction = None
             continue
@@ -384,11 +4996,298 @@ def main():
         print("\n" + "=" * 40 + "\n")
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Обработка Ж/Д накладных (СМГС)")
+    parser.add_argument(
+        "--workers", type=int,
+        help=f"число параллельных процессов для сценариев 1–5 (0 — по числу ядер, "
+             f"по умолчанию {SETTINGS['workers']}; план --plan — по числу ядер)"
+    )
+    parser.add_argument(
+        "--base-dir", default=SETTINGS["base_dir"],
+        help="рабочая папка с Railway, Template, Stamp, Ready и Merged Railway (по умолчанию — папка скрипта)"
+    )
+    parser.add_argument(
+        "--nup", type=int, choices=NUP_CHOICES, default=SETTINGS["nup"],
+        help="сколько страниц накладной размещать на одном печатном листе (сценарии 1 и 2)"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=SETTINGS["merge_chunk_size"],
+        help="сколько накладных скреплять в один пакет (сценарий 3)"
+    )
+    parser.add_argument(
+        "--keep-ready", action="store_true",
+        help="сценарии 4 и 5: сохранять копию каждой накладной в Ready/Done"
+    )
+    parser.add_argument(
+        "--merge-stamps", action="store_true",
+        help="накладывать штампы через merge_page с разбором содержимого страниц, как раньше"
+    )
+    parser.add_argument(
+        "--engine", choices=sorted(PDF_ENGINES), default=SETTINGS["pdf_engine"],
+        help="движок PDF: pypdf2 (по умолчанию) или pikepdf (qpdf) — быстрее, "
+             "но без дедупликации при скреплении; нужен pip install pikepdf"
+    )
+    parser.add_argument(
+        "--no-dedup", action="store_true",
+        help="не объединять одинаковые объекты при записи результатов"
+    )
+    parser.add_argument(
+        "--compress", action="store_true",
+        help="сжимать Flate несжатые потоки и пережимать потоки содержимого при записи"
+    )
+    parser.add_argument(
+        "--object-streams", action="store_true",
+        help="писать результаты и пакеты с потоками объектов и xref-потоком (PDF 1.5): "
+             "файлы меньше и быстрее открываются"
+    )
+    parser.add_argument(
+        "--linearize", action="store_true",
+        help="линеаризовать результаты и пакеты («быстрый веб-просмотр»: первая страница "
+             "видна до загрузки всего файла); нужен pip install pikepdf"
+    )
+    parser.add_argument(
+        "--stamp-dpi", type=float, default=SETTINGS["stamp_dpi"], metavar="DPI",
+        help="облегчать штампы: изображения обрезать по содержимому и уменьшать до этого "
+             "разрешения печати (например 300); копии хранятся в Stamp/.optimized; нужен pip install pillow"
+    )
+    parser.add_argument(
+        "--stamp-format", choices=("jpeg", "flate"), default=SETTINGS["stamp_format"],
+        help="сжатие облегчённых изображений штампа: jpeg (по умолчанию) или flate (без потерь)"
+    )
+    parser.add_argument(
+        "--stamp-gray", action="store_true",
+        help="облегчённые штампы — в оттенках серого"
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=SETTINGS["pipeline_depth"], metavar="N",
+        help="сценарии 1 и 2 в одном процессе: читать до N следующих накладных, пока "
+             "собирается текущая, и записывать готовые в фоне (0 — по одной)"
+    )
+    parser.add_argument(
+        "--memory-budget", type=float, default=SETTINGS["memory_budget_mb"], metavar="МБ",
+        help="память на сборку накладных (делится между процессами); файлы, которые в неё "
+             "не укладываются, собираются и пишутся частями (0 — без ограничения)"
+    )
+    parser.add_argument(
+        "--cache", type=float, default=SETTINGS["cache_size_mb"], metavar="МБ",
+        help="сценарии 1 и 2: хранить готовые накладные в папке Cache (не больше МБ, давно не "
+             "нужные вытесняются) и не пересобирать файлы, у которых не изменились исходник, "
+             "штамп, инструкция, 3-6.pdf и настройки (0 — без кэша)"
+    )
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="показать размер кэша, долю попаданий и сколько выдано готовым")
+    parser.add_argument(
+        "--file-timeout", type=float, default=SETTINGS["file_timeout"], metavar="С",
+        help="сценарии 1 и 2: собирать каждую накладную в отдельном процессе и убирать в "
+             "Railway/Quarantine ту, что собирается дольше С секунд (0 — без предела)"
+    )
+    parser.add_argument(
+        "--file-memory", type=float, default=SETTINGS["file_memory_mb"], metavar="МБ",
+        help="то же для памяти: предел памяти процесса, собирающего одну накладную (0 — без предела)"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=SETTINGS["file_retries"], metavar="N",
+        help="при --file-timeout/--file-memory: сколько раз повторять накладную после временного "
+             "сбоя (ошибка ввода-вывода, аварийное завершение процесса)"
+    )
+    parser.add_argument(
+        "--claims", action="store_true",
+        help="несколько запусков на общих папках (разные рабочие места или процессы): каждый файл "
+             "и каждый пакет берётся в работу через заявку в .claims, поэтому не обрабатывается дважды"
+    )
+    parser.add_argument(
+        "--claim-ttl", type=float, default=SETTINGS["claim_ttl"], metavar="С",
+        help="при --claims: заявка, не обновлявшаяся столько секунд (обработчик упал, машина "
+             "выключена), снимается, и файл забирает другой обработчик"
+    )
+    parser.add_argument(
+        "--trace", metavar="FILE",
+        help="дописывать метрики каждого файла (время этапов, страницы, байты) в JSON Lines файл"
+    )
+    parser.add_argument(
+        "--history", metavar="FILE",
+        help=f"файл SQLite-истории запусков (по умолчанию {HISTORY_FILENAME} в рабочей папке)"
+    )
+    parser.add_argument(
+        "--no-history", action="store_true",
+        help="не записывать запуски и файлы в историю"
+    )
+    parser.add_argument(
+        "--history-report", type=int, nargs="?", const=30, metavar="ДНЕЙ",
+        help="сводка истории за последние ДНЕЙ (по умолчанию 30): страниц в час, перцентили "
+             "времени на файл по дням и сценариям, самые медленные штампы — и выход"
+    )
+    parser.add_argument(
+        "--profile", metavar="ПАПКА",
+        help="профилировать обработку: cProfile и tracemalloc по каждой накладной и пакету; в папку "
+             "пишутся profile.pstats и profile.collapsed (для flamegraph), в конце печатаются самые "
+             "долгие функции и места выделения памяти"
+    )
+    parser.add_argument(
+        "--profile-slowest", type=int, default=SETTINGS["profile_slowest"], metavar="N",
+        help="при --profile: сводка только по N самым долгим накладным и пакетам"
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="режим наблюдения: обрабатывать накладные по мере появления в Railway и Ready"
+    )
+    parser.add_argument(
+        "--scenario", choices=[SCENARIO_TWO_SIDED, SCENARIO_ONE_SIDED], default=SCENARIO_TWO_SIDED,
+        help="сценарий для режима наблюдения и плана (--plan)"
+    )
+    parser.add_argument(
+        "--instruction",
+        help="файл инструкции (имя в папке Template или путь); 'none' — без инструкций"
+    )
+    parser.add_argument(
+        "--routes", metavar="FILE",
+        help=f"таблица маршрутов инструкций (CSV: номер, диапазон 1000-1999, префикс имени KZ* или * "
+             f"и инструкция/none) — своя инструкция для каждой накладной; по умолчанию "
+             f"Template/{ROUTES_FILENAME}, если есть"
+    )
+    parser.add_argument(
+        "--no-merge", action="store_true",
+        help="в режиме наблюдения не скреплять файлы из Ready"
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="не обрабатывать, а показать план для файлов в Railway (сценарий — --scenario): "
+             "номера, штампы, число листов, имена результатов и пакетов, замечания"
+    )
+    parser.add_argument("--plan-output", metavar="FILE",
+                        help="сохранить план в FILE (.csv — по строке на файл, иначе JSON)")
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="режим сервера: держать шаблоны и штампы в памяти и принимать задания "
+             "(см. railway_client.py) по HTTP на localhost или по Unix-сокету"
+    )
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="адрес для режима сервера; адрес не из 127.0.0.1/::1 — только с --token")
+    parser.add_argument("--token", default=os.environ.get(SERVER_TOKEN_ENV),
+                        help=f"режим сервера: ключ доступа, который клиенты передают в --token "
+                             f"(по умолчанию — из переменной {SERVER_TOKEN_ENV})")
+    parser.add_argument("--port", type=int, default=SERVER_DEFAULT_PORT,
+                        help="порт для режима сервера (0 — любой свободный)")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="в режиме сервера слушать Unix-сокет PATH вместо HTTP-порта")
+    parser.add_argument("--poll", type=float, default=SETTINGS["watch_poll"],
+                        help="интервал опроса папок в режиме наблюдения, с")
+    parser.add_argument("--settle", type=float, default=SETTINGS["watch_settle"],
+                        help="сколько секунд файл не должен меняться, чтобы считаться дописанным")
+    parser.add_argument("--merge-idle", type=float, default=SETTINGS["watch_merge_idle"],
+                        help="через сколько секунд без новых файлов скреплять неполный пакет (0 — никогда)")
+    return parser.parse_args(argv)
+
+
+def resolve_instruction(value):
+    """Путь к инструкции по аргументу командной строки или None, если файл не найден."""
+    instruction_path = find_instruction(value)
+    if instruction_path is None:
+        print_error(f"Файл инструкции '{value}' не найден.")
+    return instruction_path
+
+
+def run_watch(args):
+    ensure_directories()
+    recover_interrupted_jobs()
+    if args.instruction:
+        instruction_path = resolve_instruction(args.instruction)
+    else:
+        instruction_path = select_instruction()
+    if not instruction_path:
+        return
+    watch_folders(instruction_path, args.scenario, merge=not args.no_merge)
+
+
+def run_plan(args):
+    ensure_directories()
+    started = time.perf_counter()
+    # план только читает файлы, поэтому без явного --workers занимает все ядра
+    plan = build_plan(args.scenario, workers=0 if args.workers is None else args.workers)
+    print_plan(plan, time.perf_counter() - started)
+    if args.plan_output:
+        export_plan(plan, args.plan_output)
+        print_success(f"План сохранён: {args.plan_output}")
+
+
+def run_serve(args):
+    server = RailwayServer(SETTINGS["base_dir"], args.token)
+    server.warm_up()
+    server.serve(args.host, args.port, args.socket)
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    configure_paths(args.base_dir)
+    SETTINGS.update({
+        "workers": SETTINGS["workers"] if args.workers is None else args.workers,
+        "nup": args.nup,
+        "merge_chunk_size": max(1, args.chunk_size),
+        "trace_path": os.path.abspath(args.trace) if args.trace else None,
+        "history": not args.no_history,
+        "history_path": os.path.abspath(args.history) if args.history else None,
+        "profile_dir": os.path.abspath(args.profile) if args.profile else None,
+        "profile_slowest": max(0, args.profile_slowest),
+        "memory_budget_mb": max(0.0, args.memory_budget),
+        "pipeline_depth": max(0, args.prefetch),
+        "cache_size_mb": max(0.0, args.cache),
+        "file_timeout": max(0.0, args.file_timeout),
+        "file_memory_mb": max(0.0, args.file_memory),
+        "file_retries": max(0, args.retries),
+        "claims": args.claims,
+        "claim_ttl": max(1.0, args.claim_ttl),
+        "dedup": not args.no_dedup,
+        "stamp_overlay": not args.merge_stamps,
+        "pdf_engine": args.engine,
+        "routes_path": os.path.abspath(args.routes) if args.routes else None,
+        "package_keep_ready": args.keep_ready,
+        "compress_streams": args.compress,
+        "object_streams": args.object_streams,
+        "linearize": args.linearize,
+        "stamp_dpi": max(0.0, args.stamp_dpi),
+        "stamp_format": args.stamp_format,
+        "stamp_gray": args.stamp_gray,
+        "watch_poll": args.poll,
+        "watch_settle": args.settle,
+        "watch_merge_idle": args.merge_idle,
+    })
+    if args.routes and not os.path.isfile(args.routes):
+        print_error(f"Таблица маршрутов '{args.routes}' не найдена.")
+        sys.exit(1)
+    if args.linearize and not engine_available(PikepdfEngine.name):
+        print_error("Для --linearize нужен pikepdf: pip install pikepdf")
+        sys.exit(1)
+    if args.stamp_dpi > 0 and Image is None:
+        print_error("Для --stamp-dpi нужен Pillow: pip install pillow")
+        sys.exit(1)
+    if not engine_available(args.engine):
+        print_error(f"Движок '{args.engine}' не установлен: pip install {args.engine}")
+        sys.exit(1)
+    interactive = False
     try:
-        main()
+        if args.cache_stats:
+            print_cache_stats()
+        elif args.history_report is not None:
+            print_history_report(args.history_report)
+        elif args.plan or args.plan_output:
+            run_plan(args)
+        elif args.serve:
+            run_serve(args)
+        elif args.watch:
+            with profiled_run():
+                run_watch(args)
+        else:
+            interactive = True
+            with profiled_run():
+                main()
     except KeyboardInterrupt:
         print("\nПрограмма завершена пользователем.")
     except Exception as e:
         print(f"\n{Fore.RED}КРИТИЧЕСКАЯ ОШИБКА: {e}{Style.RESET_ALL}")
-        input("Нажмите Enter для выхода...")
+        # окно меню, открытое двойным щелчком, не должно закрыться сразу; в режиме
+        # сервера, наблюдения и без терминала ждать Enter некому
+        if interactive and sys.stdin is not None and sys.stdin.isatty():
+            with contextlib.suppress(EOFError, KeyboardInterrupt):
+                input("Нажмите Enter для выхода...")
+        sys.exit(1)
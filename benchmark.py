@@ -0,0 +1,558 @@
+"""
+Замер производительности Railway.py на синтетических накладных.
+
+Генерирует набор файлов (6-листовые накладные, штампы с растровым
+изображением, фон инструкции, шаблон 3-6), прогоняет сценарии на 10/100/1000
+файлах и печатает файлы/с, страницы/с, пиковую память и объём результата.
+Результаты сохраняются в JSON и могут сравниваться с прошлым прогоном:
+
+    python benchmark.py --sizes 10 100 --output bench.json
+    python benchmark.py --baseline bench.json
+
+Каждый сценарий выполняется в отдельном процессе, чтобы пиковая память
+(ru_maxrss) относилась только к нему. Работает без сети и без интерфейса.
+
+С --engine pikepdf замеряется движок pikepdf, а --parity сверяет движки
+между собой: на одних и тех же накладных порядок страниц, их размеры и
+порядок слоёв (что и в каком порядке рисуется) должны совпадать:
+
+    python benchmark.py --parity --sizes 20
+
+--layouts сравнивает раскладку результатов: классическую таблицу ссылок,
+потоки объектов (--object-streams) и линеаризацию (--linearize) — размер,
+время обработки и время открытия результата до и после:
+
+    python benchmark.py --layouts --sizes 100
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zlib
+import functools
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+from PyPDF2 import PageObject, PdfReader, PdfWriter, __version__ as PYPDF2_VERSION
+from PyPDF2.generic import (
+    ContentStream, DecodedStreamObject, DictionaryObject, EncodedStreamObject, NameObject, NumberObject
+)
+
+import Railway as R
+
+SCENARIOS = (R.SCENARIO_TWO_SIDED, R.SCENARIO_ONE_SIDED, "merge")
+DEFAULT_SIZES = (10, 100, 1000)
+INSTRUCTION_NAME = "Instruction (China) bench.pdf"
+# раскладка результатов -> настройки Railway.py
+LAYOUTS = {
+    "classic": {},
+    "objstm": {"object_streams": True},
+    "linearized": {"object_streams": True, "linearize": True},
+}
+PAGE_W, PAGE_H = 595, 842
+# доля накладных, для которых есть штамп
+STAMP_RATIO = 0.7
+
+
+# ----------------------------------------------------------------------
+# Генерация синтетических PDF
+# ----------------------------------------------------------------------
+def _font(writer):
+    return writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+        NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    }))
+
+
+def _add_page(writer, content, font=None, xobjects=None):
+    page = PageObject.create_blank_page(None, PAGE_W, PAGE_H)
+    stream = DecodedStreamObject()
+    stream.set_data(content.encode("latin-1"))
+    page[NameObject("/Contents")] = writer._add_object(stream.flate_encode())
+    resources = DictionaryObject()
+    if font is not None:
+        resources[NameObject("/Font")] = DictionaryObject({NameObject("/F1"): font})
+    if xobjects:
+        resources[NameObject("/XObject")] = DictionaryObject(
+            (NameObject(name), ref) for name, ref in xobjects.items()
+        )
+    page[NameObject("/Resources")] = resources
+    writer.add_page(page)
+
+
+def _form_grid(rng, rows, cols, top=800, left=30):
+    """Сетка граф бланка СМГС: линии и подписи ячеек."""
+    ops = ["0.5 w"]
+    cell_w = (PAGE_W - 2 * left) / cols
+    cell_h = (top - 40) / rows
+    for r in range(rows):
+        for c in range(cols):
+            x = left + c * cell_w
+            y = top - (r + 1) * cell_h
+            ops.append(f"{x:.1f} {y:.1f} {cell_w:.1f} {cell_h:.1f} re S")
+            label = f"{r * cols + c + 1} " + "".join(
+                rng.choice("ABCDEFGHIKLMNOPRSTUVXYZ ") for _ in range(rng.randint(6, 18))
+            )
+            ops.append(f"BT /F1 6 Tf {x + 2:.1f} {y + cell_h - 8:.1f} Td ({label}) Tj ET")
+    return "\n".join(ops)
+
+
+def _write(writer, path):
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def make_waybill(path, number, rng, sheets=6):
+    writer = PdfWriter()
+    font = _font(writer)
+    for sheet in range(1, sheets + 1):
+        content = _form_grid(rng, 12, 4) + (
+            f"\nBT /F1 14 Tf 40 810 Td (SMGS No {number}  sheet {sheet}) Tj ET"
+        )
+        _add_page(writer, content, font)
+    _write(writer, path)
+
+
+@functools.lru_cache(maxsize=None)
+def _stamp_pixels(width, height, seed):
+    """Кольцо штампа на зашумлённом светлом фоне, как у скана."""
+    rng = random.Random(seed)
+    rows = []
+    for y in range(height):
+        row = bytearray()
+        for x in range(width):
+            ring = abs(((x - width / 2) ** 2 + (y - height / 2) ** 2) ** 0.5 - width / 3) < 6
+            row.append(40 if ring else 235 + rng.randint(0, 20))
+        rows.append(bytes(row))
+    return b"".join(rows)
+
+
+def _image_xobject(writer, rng, width, height):
+    """Серое растровое изображение — имитация скана штампа (несколько вариантов шума)."""
+    image = EncodedStreamObject()
+    image._data = zlib.compress(_stamp_pixels(width, height, rng.randint(0, 7)))
+    image.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(width),
+        NameObject("/Height"): NumberObject(height),
+        NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+        NameObject("/Filter"): NameObject("/FlateDecode"),
+    })
+    return writer._add_object(image)
+
+
+def make_stamp(path, number, rng, size=300):
+    writer = PdfWriter()
+    font = _font(writer)
+    image = _image_xobject(writer, rng, size, size)
+    content = (
+        f"q 140 0 0 140 400 60 cm /Im1 Do Q\n"
+        f"BT /F1 9 Tf 410 50 Td (RELEASED {number}) Tj ET"
+    )
+    _add_page(writer, content, font, {"/Im1": image})
+    _write(writer, path)
+
+
+def make_instruction(path, rng):
+    writer = PdfWriter()
+    font = _font(writer)
+    lines = [
+        f"BT /F1 7 Tf 300 {780 - i * 9} Td ({' '.join(rng.choice(['SHOU', 'HUO', 'REN', 'DI', 'ZHI', 'YUN']) for _ in range(10))}) Tj ET"
+        for i in range(60)
+    ]
+    _add_page(writer, "0.8 g\n" + "\n".join(lines), font)
+    _write(writer, path)
+
+
+def make_template_3_6(path, rng):
+    writer = PdfWriter()
+    font = _font(writer)
+    for _ in range(2):
+        _add_page(writer, _form_grid(rng, 10, 4), font)
+    _write(writer, path)
+
+
+def generate_corpus(root, count, seed=1):
+    """Рабочая папка с count накладными, штампами и шаблонами."""
+    rng = random.Random(seed)
+    for folder in ("Railway", "Template", "Stamp", "Ready", "Merged Railway"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    make_instruction(os.path.join(root, "Template", INSTRUCTION_NAME), rng)
+    make_template_3_6(os.path.join(root, "Template", "3-6.pdf"), rng)
+
+    first = 10001
+    for number in range(first, first + count):
+        make_waybill(os.path.join(root, "Railway", f"{number} SMGS.pdf"), number, rng)
+        if rng.random() < STAMP_RATIO:
+            make_stamp(os.path.join(root, "Stamp", f"Stamp {number}.pdf"), number, rng)
+
+
+# ----------------------------------------------------------------------
+# Прогон одного сценария (в отдельном процессе)
+# ----------------------------------------------------------------------
+def _pdf_stats(folder):
+    files = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".pdf")]
+    pages = sum(len(PdfReader(f).pages) for f in files)
+    size = sum(os.path.getsize(f) for f in files)
+    return len(files), pages, size
+
+
+def _open_ms(folder):
+    """Среднее время открытия результата до первой страницы (чтение таблицы ссылок и дерева страниц), мс."""
+    files = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".pdf")]
+    started = time.perf_counter()
+    for path in files:
+        with open(path, "rb") as f:
+            PdfReader(f).pages[0].get_contents()
+    return round((time.perf_counter() - started) * 1000 / max(len(files), 1), 2)
+
+
+def _peak_rss_mb():
+    import resource
+    usage = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Linux отдаёт килобайты, macOS — байты
+    return round(usage / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_case(workspace, scenario, workers, engine=R.PyPDF2Engine.name, layout="classic"):
+    R.configure_paths(workspace)
+    R.SETTINGS["workers"] = workers
+    R.SETTINGS["pdf_engine"] = engine
+    R.SETTINGS.update(LAYOUTS[layout])
+    instruction = os.path.join(R.DIR_TEMPLATE, INSTRUCTION_NAME)
+
+    if scenario == "merge":
+        input_folder, output_folder = R.DIR_READY, R.DIR_MERGED
+    else:
+        input_folder, output_folder = R.DIR_RAILWAY, R.DIR_READY
+    files_in, pages_in, bytes_in = _pdf_stats(input_folder)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        if scenario == R.SCENARIO_TWO_SIDED:
+            R.scenario_two_sided(instruction)
+        elif scenario == R.SCENARIO_ONE_SIDED:
+            R.scenario_one_sided(instruction)
+        else:
+            R.scenario_merge()
+        elapsed = time.perf_counter() - started
+
+    _, pages_out, bytes_out = _pdf_stats(output_folder)
+    return {
+        "scenario": scenario,
+        "engine": engine,
+        "layout": layout,
+        "files": files_in,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(files_in / elapsed, 2) if elapsed else None,
+        "pages_in": pages_in,
+        "pages_out": pages_out,
+        "pages_per_s": round(pages_in / elapsed, 2) if elapsed else None,
+        "bytes_in": bytes_in,
+        "output_bytes": bytes_out,
+        "open_ms": _open_ms(output_folder),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_case_subprocess(workspace, scenario, workers, engine, layout="classic"):
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-case", workspace, scenario,
+           "--workers", str(workers), "--engine", engine, "--layout", layout]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+# ----------------------------------------------------------------------
+# Набор замеров
+# ----------------------------------------------------------------------
+def run_suite(sizes, scenarios, workers, engine, keep=False, layout="classic"):
+    results = []
+    tmp_root = tempfile.mkdtemp(prefix="railway_bench_")
+    try:
+        for size in sizes:
+            corpus = os.path.join(tmp_root, f"corpus_{size}")
+            R.print_step(f"Набор из {size} накладных")
+            started = time.perf_counter()
+            generate_corpus(corpus, size)
+            R.print_info(f"Сгенерирован за {time.perf_counter() - started:.1f} с")
+
+            # двухсторонний сценарий готовит Ready для скрепления, как в реальной работе
+            duplex_ws = None
+            for scenario in scenarios:
+                if scenario == "merge":
+                    workspace = duplex_ws
+                    if workspace is None:
+                        workspace = os.path.join(tmp_root, f"ws_{size}_merge_prep")
+                        shutil.copytree(corpus, workspace)
+                        _run_case_subprocess(workspace, R.SCENARIO_TWO_SIDED, workers, engine, layout)
+                else:
+                    workspace = os.path.join(tmp_root, f"ws_{size}_{scenario}")
+                    shutil.copytree(corpus, workspace)
+                    if scenario == R.SCENARIO_TWO_SIDED:
+                        duplex_ws = workspace
+
+                result = _run_case_subprocess(workspace, scenario, workers, engine, layout)
+                result["size"] = size
+                results.append(result)
+                print_result(result)
+    finally:
+        if keep:
+            R.print_info(f"Рабочие папки сохранены: {tmp_root}")
+        else:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+    return results
+
+
+def run_layouts(size, scenarios, workers, engine, keep=False):
+    """Прогоняет сценарии во всех раскладках LAYOUTS и печатает разницу с классической."""
+    layouts = list(LAYOUTS)
+    if not R.engine_available(R.PikepdfEngine.name):
+        R.print_info("pikepdf не установлен — линеаризация пропущена")
+        layouts.remove("linearized")
+    results = []
+    for layout in layouts:
+        R.print_step(f"Раскладка {layout}")
+        results += run_suite([size], scenarios, workers, engine, keep, layout)
+
+    R.print_step(f"Раскладки на {size} накладных (к classic)")
+    base = {r["scenario"]: r for r in results if r["layout"] == "classic"}
+    for result in results:
+        reference = base[result["scenario"]]
+
+        def delta(key):
+            if result is reference or not reference[key]:
+                return ""
+            return f" ({(result[key] / reference[key] - 1) * 100:+.0f}%)"
+
+        print(
+            f"  {result['scenario']:<10} {result['layout']:<10} "
+            f"обработка {result['seconds']:.2f} с{delta('seconds')}, "
+            f"результат {result['output_bytes'] / 1e6:.2f} МБ{delta('output_bytes')}, "
+            f"открытие {result['open_ms']:.1f} мс{delta('open_ms')}"
+        )
+    return results
+
+
+# ----------------------------------------------------------------------
+# Сверка движков PDF
+# ----------------------------------------------------------------------
+# (название, сценарий, nup, скреплять ли Ready после сценария)
+PARITY_CASES = (
+    ("two-sided + merge", R.SCENARIO_TWO_SIDED, 1, True),
+    ("one-sided", R.SCENARIO_ONE_SIDED, 1, False),
+    ("two-sided 2-up", R.SCENARIO_TWO_SIDED, 2, False),
+    ("one-sided 4-up", R.SCENARIO_ONE_SIDED, 4, False),
+)
+
+
+def _paint_order(pdf, stream, resources, out):
+    """Дописывает в out, что и в каком порядке рисует поток: тексты и изображения, с заходом в Form XObject."""
+    resources = resources.get_object() if resources is not None else DictionaryObject()
+    xobjects = resources.get("/XObject", DictionaryObject()).get_object()
+    for operands, operator in ContentStream(stream, pdf).operations:
+        if operator in (b"Tj", b"TJ", b"'", b'"'):
+            out.append(("text", repr(operands[-1])))
+        elif operator == b"INLINE IMAGE":
+            out.append(("image", zlib.crc32(operands["data"])))
+        elif operator == b"Do":
+            xobject = xobjects[operands[0]].get_object()
+            if xobject.get("/Subtype") == "/Form":
+                _paint_order(pdf, xobject, xobject.get("/Resources", resources), out)
+            else:
+                out.append(("image", xobject.get("/Width"), xobject.get("/Height"), zlib.crc32(xobject.get_data())))
+
+
+def page_signature(pdf, page):
+    """Размер страницы и порядок слоёв на ней — то, что должно совпадать у движков."""
+    layers = []
+    if "/Contents" in page:
+        _paint_order(pdf, page["/Contents"].get_object(), page.get("/Resources"), layers)
+    return tuple(round(float(v)) for v in page.mediabox), tuple(layers)
+
+
+def folder_signatures(*folders):
+    """Подписи страниц всех PDF в папках (вместе с Done): {относительный путь: [подпись страницы]}."""
+    result = {}
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in sorted(files):
+                if name.lower().endswith(".pdf"):
+                    path = os.path.join(root, name)
+                    pdf = PdfReader(path)
+                    key = os.path.relpath(path, os.path.dirname(folder))
+                    result[key] = [page_signature(pdf, page) for page in pdf.pages]
+    return result
+
+
+def first_difference(expected, actual):
+    """Описание первого расхождения подписей или None, если они совпадают."""
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual or key not in expected:
+            return f"{key}: есть только у одного движка"
+        if len(expected[key]) != len(actual[key]):
+            return f"{key}: страниц {len(expected[key])} и {len(actual[key])}"
+        for number, (a, b) in enumerate(zip(expected[key], actual[key]), 1):
+            if a[0] != b[0]:
+                return f"{key}, стр. {number}: размер {a[0]} и {b[0]}"
+            if a[1] != b[1]:
+                return f"{key}, стр. {number}: слои различаются ({len(a[1])} и {len(b[1])} элементов)"
+    return None
+
+
+def engine_signatures(corpus, tmp_root, scenario, nup, merge):
+    """
+    Прогоняет сценарий каждым движком на своей копии corpus (в tmp_root) и
+    возвращает ({движок: подписи страниц Ready и Merged Railway}, {движок: время, с}).
+    """
+    signatures, timings = {}, {}
+    for engine in R.PDF_ENGINES:
+        workspace = os.path.join(tmp_root, f"{engine}_{scenario}_{nup}")
+        shutil.copytree(corpus, workspace)
+        R.configure_paths(workspace)
+        R.SETTINGS.update(pdf_engine=engine, nup=nup)
+        instruction = os.path.join(R.DIR_TEMPLATE, INSTRUCTION_NAME)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            if scenario == R.SCENARIO_TWO_SIDED:
+                R.scenario_two_sided(instruction)
+            else:
+                R.scenario_one_sided(instruction)
+            if merge:
+                R.scenario_merge()
+            timings[engine] = time.perf_counter() - started
+        signatures[engine] = folder_signatures(R.DIR_READY, R.DIR_MERGED)
+    return signatures, timings
+
+
+def run_parity(size, keep=False):
+    """
+    Прогоняет PARITY_CASES обоими движками на одном наборе накладных и
+    сверяет результаты постранично. Возвращает True, если расхождений нет.
+    """
+    if not R.engine_available(R.PikepdfEngine.name):
+        R.print_error("Для сверки нужен движок pikepdf: pip install pikepdf")
+        return False
+
+    tmp_root = tempfile.mkdtemp(prefix="railway_parity_")
+    ok = True
+    try:
+        corpus = os.path.join(tmp_root, "corpus")
+        R.print_step(f"Сверка движков на {size} накладных")
+        generate_corpus(corpus, size)
+        for title, scenario, nup, merge in PARITY_CASES:
+            signatures, timings = engine_signatures(corpus, tmp_root, scenario, nup, merge)
+            reference, *others = R.PDF_ENGINES
+            times = ", ".join(f"{engine} {seconds:.2f} с" for engine, seconds in timings.items())
+            for engine in others:
+                difference = first_difference(signatures[reference], signatures[engine])
+                if difference is None:
+                    pages = sum(len(p) for p in signatures[engine].values())
+                    R.print_success(f"{title}: {engine} совпадает с {reference} ({pages} стр.; {times})")
+                else:
+                    ok = False
+                    R.print_error(f"{title}: {engine} расходится с {reference}: {difference}")
+    finally:
+        if keep:
+            R.print_info(f"Рабочие папки сохранены: {tmp_root}")
+        else:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+    return ok
+
+
+def print_result(result, baseline=None):
+    line = (
+        f"  {result['scenario']:<10} {result['size']:>5} файлов: "
+        f"{result['files_per_s']:>8} файл/с, {result['pages_per_s']:>9} стр/с, "
+        f"пик {result['peak_rss_mb']:>7} МБ, результат {result['output_bytes'] / 1e6:.2f} МБ"
+    )
+    if result.get("layout", "classic") != "classic":
+        line += f" [{result['layout']}]"
+    if baseline:
+        delta = (result["files_per_s"] / baseline["files_per_s"] - 1) * 100
+        color = R.Fore.GREEN if delta >= 0 else R.Fore.RED
+        line += f"  {color}{delta:+.1f}% к базовому{R.Style.RESET_ALL}"
+    print(line)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    base = {(r["scenario"], r["size"], r.get("layout", "classic")): r for r in baseline["results"]}
+    R.print_step(f"Сравнение с {baseline_path}")
+    for result in results:
+        print_result(result, base.get((result["scenario"], result["size"], result["layout"])))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замер производительности Railway.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="размеры наборов (число накладных)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=1, help="как --workers у Railway.py")
+    parser.add_argument("--engine", choices=sorted(R.PDF_ENGINES), default=R.PyPDF2Engine.name,
+                        help="как --engine у Railway.py")
+    parser.add_argument("--layout", choices=list(LAYOUTS), default="classic",
+                        help="раскладка результатов: classic, objstm (--object-streams), "
+                             "linearized (--object-streams --linearize)")
+    parser.add_argument("--layouts", action="store_true",
+                        help="сравнить все раскладки на наборе из первого размера --sizes")
+    parser.add_argument("--parity", action="store_true",
+                        help="вместо замера сверить движки PDF на наборе из первого размера --sizes")
+    parser.add_argument("--output", default="benchmark_results.json", help="куда сохранить результаты")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные папки")
+    parser.add_argument("--run-case", nargs=2, metavar=("WORKSPACE", "SCENARIO"), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case[0], args.run_case[1], args.workers, args.engine, args.layout)))
+        return
+    if args.parity:
+        sys.exit(0 if run_parity(args.sizes[0], args.keep) else 1)
+    if not R.engine_available(args.engine):
+        R.print_error(f"Движок '{args.engine}' не установлен: pip install {args.engine}")
+        sys.exit(1)
+
+    if args.layouts:
+        results = run_layouts(args.sizes[0], args.scenarios, args.workers, args.engine, args.keep)
+    else:
+        results = run_suite(args.sizes, args.scenarios, args.workers, args.engine, args.keep, args.layout)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pypdf2": PYPDF2_VERSION,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": args.workers,
+            "engine": args.engine,
+            "layout": "all" if args.layouts else args.layout,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    R.print_success(f"Результаты сохранены: {args.output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Тонкий клиент для сервера накладных (python Railway.py --serve): отправляет
+задание и печатает ход обработки по мере работы. Использует только
+стандартную библиотеку — запуск не платит за импорт PyPDF2 и разбор шаблонов.
+
+    python railway_client.py two-sided --instruction "Instruction (China) A.pdf"
+    python railway_client.py one-sided --instruction none "123 waybill.pdf" "124 waybill.pdf"
+    python railway_client.py merge --socket /tmp/railway.sock
+    python railway_client.py status
+
+Код выхода: 0 — задание выполнено без ошибок, 1 — были ошибки, 2 — сервер
+недоступен или отклонил задание.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import http.client
+
+DEFAULT_PORT = 8765
+TOKEN_ENV = "RAILWAY_TOKEN"
+SCENARIOS = ("two-sided", "one-sided", "merge", "package-two-sided", "package-one-sided")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP-соединение поверх Unix-сокета."""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def build_job(args):
+    settings = {}
+    if args.workers is not None:
+        settings["workers"] = args.workers
+    if args.nup is not None:
+        settings["nup"] = args.nup
+    if args.chunk_size is not None:
+        settings["merge_chunk_size"] = args.chunk_size
+    if args.keep_ready:
+        settings["package_keep_ready"] = True
+
+    job = {"scenario": args.scenario, "settings": settings}
+    if args.instruction is not None:
+        job["instruction"] = args.instruction
+    if args.files:
+        job["files"] = args.files
+    if args.folder:
+        job["folder"] = args.folder
+    return job
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Отправка задания серверу накладных (Railway.py --serve)")
+    parser.add_argument("scenario", choices=SCENARIOS + ("status",),
+                        help="сценарий задания или status — состояние сервера")
+    parser.add_argument("files", nargs="*",
+                        help="имена файлов в Railway (для merge — в Ready); по умолчанию — все")
+    parser.add_argument("--instruction",
+                        help="файл инструкции (имя в папке Template или путь); 'none' — без инструкций")
+    parser.add_argument("--folder",
+                        help="рабочая папка задания внутри папки сервера (по умолчанию — сама папка сервера)")
+    parser.add_argument("--workers", type=int, help="число процессов для задания")
+    parser.add_argument("--nup", type=int, choices=(1, 2, 4), help="страниц накладной на печатный лист")
+    parser.add_argument("--chunk-size", type=int, help="сколько накладных скреплять в один пакет")
+    parser.add_argument("--keep-ready", action="store_true",
+                        help="сценарии package-*: сохранять копию каждой накладной в Ready/Done")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес сервера")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="порт сервера")
+    parser.add_argument("--socket", metavar="PATH", help="Unix-сокет сервера вместо HTTP-порта")
+    parser.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                        help=f"ключ доступа сервера (по умолчанию — из переменной {TOKEN_ENV})")
+    parser.add_argument("--json", action="store_true",
+                        help="печатать события сервера как есть (JSON Lines)")
+    # имена файлов можно писать и после ключей
+    return parser.parse_intermixed_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    conn = connect(args)
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    try:
+        if args.scenario == "status":
+            conn.request("GET", "/status", headers=headers)
+        else:
+            body = json.dumps(build_job(args), ensure_ascii=False).encode("utf-8")
+            conn.request("POST", "/jobs", body, {"Content-Type": "application/json", **headers})
+        response = conn.getresponse()
+    except OSError as e:
+        print(f"Сервер недоступен: {e}", file=sys.stderr)
+        return 2
+
+    if response.status != 200:
+        try:
+            error = json.loads(response.read()).get("error")
+        except ValueError:
+            error = response.reason
+        print(f"Сервер отклонил задание: {error}", file=sys.stderr)
+        return 2
+
+    if args.scenario == "status":
+        print(json.dumps(json.loads(response.read()), ensure_ascii=False, indent=2))
+        return 0
+
+    done = None
+    for line in response:
+        event = json.loads(line)
+        if args.json:
+            print(line.decode("utf-8"), end="", flush=True)
+        elif event["event"] == "log":
+            print(event["text"], flush=True)
+        if event["event"] == "done":
+            done = event
+    if done is None:
+        print("Соединение с сервером оборвалось до конца задания.", file=sys.stderr)
+        return 2
+    return 0 if done["ok"] else 1
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        # сервер доведёт задание до конца и без клиента
+        sys.exit(130)
@@ -0,0 +1,67 @@
+"""
+Сверка движков PDF: на одном наборе синтетических накладных PyPDF2Engine и
+PikepdfEngine должны давать одинаковые страницы — тот же порядок, размеры и
+порядок слоёв (что и в каком порядке рисуется). Без pikepdf тесты пропускаются.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Railway as R  # noqa: E402
+import benchmark  # noqa: E402
+
+CORPUS_SIZE = 4
+
+
+@unittest.skipUnless(R.engine_available(R.PikepdfEngine.name), "нужен pip install pikepdf")
+class EngineParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_root = tempfile.mkdtemp(prefix="railway_parity_test_")
+        cls.corpus = os.path.join(cls.tmp_root, "corpus")
+        benchmark.generate_corpus(cls.corpus, CORPUS_SIZE)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_root, ignore_errors=True)
+
+    def setUp(self):
+        self.settings = dict(R.SETTINGS)
+
+    def tearDown(self):
+        R.SETTINGS.clear()
+        R.SETTINGS.update(self.settings)
+        R.configure_paths(self.settings["base_dir"])
+
+    def test_engines_match(self):
+        reference, *others = R.PDF_ENGINES
+        self.assertTrue(others, "зарегистрирован только один движок")
+        for title, scenario, nup, merge in benchmark.PARITY_CASES:
+            with self.subTest(case=title):
+                signatures, _ = benchmark.engine_signatures(self.corpus, self.tmp_root, scenario, nup, merge)
+                expected = signatures[reference]
+                self.assertTrue(expected, "движок не создал ни одного PDF")
+                for engine in others:
+                    self.assertIsNone(benchmark.first_difference(expected, signatures[engine]), engine)
+
+    def test_signature_sees_paint_order(self):
+        """Подпись различает порядок слоёв, иначе сверка ничего бы не проверяла."""
+        signatures, _ = benchmark.engine_signatures(
+            self.corpus, os.path.join(self.tmp_root, "order"), R.SCENARIO_ONE_SIDED, 1, False
+        )
+        pages = next(iter(signatures[R.PyPDF2Engine.name].values()))
+        box, layers = pages[0]
+        self.assertGreater(len(layers), 1)
+        swapped = {"file.pdf": [(box, tuple(reversed(layers)))]}
+        self.assertIsNotNone(benchmark.first_difference({"file.pdf": [pages[0]]}, swapped))
+
+
+if __name__ == "__main__":
+    unittest.main()